@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+DEFAULT = object()
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PriorityClass:
+    """Scheduling settings for one class of requests; a lower `priority` is served first.
+
+    At most `max_queued` requests of the class wait for a slot, each for at most
+    `max_wait` seconds (None waits indefinitely) before being turned away.
+    """
+
+    def __init__(self, priority: int, max_queued: int = 100, max_wait: float | None = 10):
+        self.priority = priority
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+
+
+class Ticket:
+    """An admitted request's slot; release() is idempotent."""
+
+    def __init__(self, controller: "AdmissionController", name: str, waited: float):
+        self.controller = controller
+        self.name = name
+        self.waited = waited
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.controller._release(time.monotonic() - self.started)
+
+
+class AdmissionController:
+    """Bounds how many pipelines run at once and hands free slots to waiting requests by priority class.
+
+    Within a class waiters are served first come, first served. A request that
+    finds its class queue full, or waits past the class's `max_wait`, gets
+    AdmissionRejected with a Retry-After estimate instead of hanging.
+    """
+
+    def __init__(self, capacity: int, classes: dict[str, PriorityClass], alpha: float = 0.1):
+        self.capacity = capacity
+        self.classes = classes
+        self.alpha = alpha
+        self.running = 0
+        self.hold_ewma: float | None = None
+        self.queued = {name: 0 for name in classes}
+        self.admitted = {name: 0 for name in classes}
+        self.rejected: dict[tuple[str, str], int] = {}
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = itertools.count()
+
+    def retry_after(self, name: str) -> float:
+        """Rough seconds until a slot frees up for a new request of class `name`."""
+        ahead = sum(count for other, count in self.queued.items()
+                    if self.classes[other].priority <= self.classes[name].priority)
+        return max(1.0, math.ceil((self.hold_ewma or 1.0) * (ahead + 1) / max(self.capacity, 1)))
+
+    async def acquire(self, name: str, max_wait: float | None = DEFAULT) -> Ticket:
+        policy = self.classes[name]
+        max_wait = policy.max_wait if max_wait is DEFAULT else max_wait
+        if self.running < self.capacity and not self._waiters:
+            self.running += 1
+            self.admitted[name] += 1
+            return Ticket(self, name, 0.0)
+        if self.queued[name] >= policy.max_queued:
+            self._reject(name, "full")
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (policy.priority, next(self._sequence), waiter))
+        self.queued[name] += 1
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(waiter, max_wait)
+        except asyncio.TimeoutError:
+            self._reject(name, "timeout")
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._release(None)  # a slot was handed over just as the caller went away; pass it on
+            raise
+        finally:
+            self.queued[name] -= 1
+            self._discard(waiter)
+        self.admitted[name] += 1
+        return Ticket(self, name, time.monotonic() - start)
+
+    @asynccontextmanager
+    async def slot(self, name: str, max_wait: float | None = DEFAULT) -> AsyncIterator[Ticket]:
+        ticket = await self.acquire(name, max_wait)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def _reject(self, name: str, reason: str) -> None:
+        self.rejected[(name, reason)] = self.rejected.get((name, reason), 0) + 1
+        raise AdmissionRejected(f"Server is busy ({name} queue {reason}), retry later", self.retry_after(name))
+
+    def _discard(self, waiter: asyncio.Future) -> None:
+        for index, entry in enumerate(self._waiters):
+            if entry[2] is waiter:
+                self._waiters[index] = self._waiters[-1]
+                self._waiters.pop()
+                heapq.heapify(self._waiters)
+                return
+
+    def _release(self, held: float | None) -> None:
+        if held is not None:
+            self.hold_ewma = held if self.hold_ewma is None else self.hold_ewma + self.alpha * (held - self.hold_ewma)
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)  # the slot moves straight to the waiter; `running` is unchanged
+                return
+        self.running -= 1
+
+    def stats(self) -> dict:
+        return {"running": self.running, "capacity": self.capacity, "holdEwma": self.hold_ewma}
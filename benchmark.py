@@ -0,0 +1,237 @@
+"""Offline load test for the story API, run against the local mock provider in mock_llm.py.
+
+Boots the mock provider and the FastAPI app on local ports, points story_writer
+at the mock, then drives each scenario at a fixed concurrency and reports
+throughput, latency percentiles and memory per request.
+
+    python benchmark.py --concurrency 50 --requests 500
+    python benchmark.py --baseline bench_baseline.json                    # exit 1 on regression
+    python benchmark.py --baseline bench_baseline.json --update-baseline  # record a new baseline
+"""
+import argparse
+import asyncio
+import json
+import resource
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+
+import httpx
+import uvicorn
+
+import mock_llm
+import story_writer
+from ratelimit import AdaptiveConcurrencyLimiter, ClientTokenBudgets, UpstreamLimiter
+from router import Backend, ModelRouter
+
+SCENARIOS = ("story", "develop-story", "story-stream", "batch")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ServerThread:
+    def __init__(self, app, port: int):
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning",
+                                                   lifespan="on", backlog=4096))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def story_payload(index: int, args) -> dict:
+    plot = "A hero saves the world." if args.repeat_plots else f"A hero saves world number {index}."
+    return {"plot": plot, "genre": "Adventure", "imageNeeded": args.image, "totalWords": 200, "totalParagraphs": 2}
+
+
+async def run_request(client: httpx.AsyncClient, scenario: str, index: int, args) -> tuple[bool, float | None]:
+    """Issue one request; returns (ok, time to first byte for streamed scenarios)."""
+    payload = story_payload(index, args)
+    if scenario == "story":
+        response = await client.post("/story", json=payload)
+        return response.status_code == 200 and response.json()["error"] is None, None
+    if scenario == "develop-story":
+        payload["summary"] = "A hero saved the world but now must find peace."
+        response = await client.post("/develop-story", json=payload)
+        return response.status_code == 200 and response.json()["error"] is None, None
+    if scenario == "story-stream":
+        start, first_token, ok = time.perf_counter(), None, False
+        async with client.stream("POST", "/story/stream", json=payload) as response:
+            async for line in response.aiter_lines():
+                if line == "event: token" and first_token is None:
+                    first_token = time.perf_counter() - start
+                elif line == "event: done":
+                    ok = True
+                elif line == "event: error":
+                    ok = False
+        return ok and response.status_code == 200, first_token
+    if scenario == "batch":
+        items = [story_payload(index * args.batch_size + offset, args) for offset in range(args.batch_size)]
+        response = await client.post("/stories/batch", json={"items": items})
+        return response.status_code == 200 and all(r["error"] is None for r in response.json()["results"]), None
+    raise ValueError(f"Unknown scenario {scenario}")
+
+
+async def run_scenario(base_url: str, scenario: str, args) -> dict:
+    latencies: list[float] = []
+    first_tokens: list[float] = []
+    errors = 0
+    next_index = iter(range(args.requests))
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        async def worker():
+            nonlocal errors
+            for index in next_index:
+                start = time.perf_counter()
+                try:
+                    ok, first_token = await run_request(client, scenario, index, args)
+                except httpx.HTTPError:
+                    ok, first_token = False, None
+                latencies.append(time.perf_counter() - start)
+                if first_token is not None:
+                    first_tokens.append(first_token)
+                errors += not ok
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        traced_before = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        traced_after = tracemalloc.get_traced_memory()[0] if args.tracemalloc else 0
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    result = {
+        "requests": args.requests,
+        "errors": errors,
+        "throughput": args.requests / elapsed,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "maxRssGrowthKbPerRequest": (rss_after - rss_before) / args.requests,
+    }
+    if first_tokens:
+        result["ttftP50"] = percentile(first_tokens, 0.50)
+        result["ttftP95"] = percentile(first_tokens, 0.95)
+    if args.tracemalloc:
+        result["retainedBytesPerRequest"] = (traced_after - traced_before) / args.requests
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for scenario, expected in baseline.items():
+        actual = results.get(scenario)
+        if actual is None:
+            continue
+        if actual["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(f"{scenario}: throughput {actual['throughput']:.1f} req/s "
+                               f"< baseline {expected['throughput']:.1f} req/s")
+        for key in ("p95", "p99"):
+            if actual[key] > expected[key] * (1 + tolerance):
+                regressions.append(f"{scenario}: {key} {actual[key] * 1000:.0f} ms "
+                                   f"> baseline {expected[key] * 1000:.0f} ms")
+        if actual["errors"] > expected["errors"]:
+            regressions.append(f"{scenario}: {actual['errors']} errors > baseline {expected['errors']}")
+    return regressions
+
+
+def print_report(results: dict) -> None:
+    print(f"{'scenario':<15}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ttft ms':>10}{'errors':>8}")
+    for scenario, r in results.items():
+        ttft = f"{r['ttftP50'] * 1000:.0f}" if "ttftP50" in r else "-"
+        print(f"{scenario:<15}{r['throughput']:>10.1f}{r['p50'] * 1000:>10.0f}{r['p95'] * 1000:>10.0f}"
+              f"{r['p99'] * 1000:>10.0f}{ttft:>10}{r['errors']:>8}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--batch-size", type=int, default=5)
+    parser.add_argument("--image", action="store_true", help="set imageNeeded on every request")
+    parser.add_argument("--repeat-plots", action="store_true", help="reuse one plot so the cache and single-flight engage")
+    parser.add_argument("--latency", type=float, default=0.05, help="mock median completion latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="log-normal sigma of the mock latency")
+    parser.add_argument("--image-latency", type=float, default=0.1)
+    parser.add_argument("--completion-tokens", type=int, default=200)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of mock calls answered with 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="fraction of mock calls answered with 503")
+    parser.add_argument("--backends", type=int, default=1, help="mock backends registered per role")
+    parser.add_argument("--routing", choices=("least-latency", "weighted"), default="least-latency")
+    parser.add_argument("--upstream-rpm", type=float, default=1_000_000, help="upstream limiter requests/min during the run")
+    parser.add_argument("--client-tpm", type=float, default=1e9, help="per-client token budget during the run (every request comes from one client)")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report retained Python allocations per request")
+    parser.add_argument("--baseline", help="JSON file of previous results to compare against")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results to --baseline instead of comparing")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    settings = mock_llm.MockSettings(latency=args.latency, latency_sigma=args.latency_sigma,
+                                     completion_tokens=args.completion_tokens, image_latency=args.image_latency,
+                                     rate_limit_rate=args.rate_limit_rate, server_error_rate=args.server_error_rate,
+                                     seed=0)
+    mock_port, app_port = free_port(), free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    story_writer.model_router = ModelRouter({
+        role: [Backend(f"mock-{index}", mock_url, f"mock-{role}", "mock") for index in range(args.backends)]
+        for role in ("story", "summary", "image")
+    }, strategy=args.routing)
+    story_writer.upstream_limiter = UpstreamLimiter(
+        args.upstream_rpm, args.upstream_rpm * 10_000,
+        AdaptiveConcurrencyLimiter(story_writer.UPSTREAM_INITIAL_CONCURRENCY, story_writer.UPSTREAM_MIN_CONCURRENCY,
+                                   story_writer.MAX_CONNECTIONS))
+
+    import main as app_module
+    app_module.client_budgets = ClientTokenBudgets(args.client_tpm)
+    app = app_module.app
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    results = {}
+    with ServerThread(mock_llm.create_app(settings), mock_port), ServerThread(app, app_port):
+        for scenario in args.scenarios:
+            results[scenario] = asyncio.run(run_scenario(f"http://127.0.0.1:{app_port}", scenario, args))
+
+    print_report(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if not args.baseline:
+        return 0
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+import functools
+import hashlib
+import inspect
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+from ratelimit import call_backend
+
+
+def normalize(value: Any) -> Any:
+    if hasattr(value, "model_dump"):
+        return normalize(value.model_dump())
+    if isinstance(value, str):
+        return " ".join(value.split())
+    if isinstance(value, float):
+        return round(value, 4)
+    if isinstance(value, dict):
+        return {k: normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize(v) for v in value]
+    return value
+
+
+def make_cache_key(kind: str, params: dict) -> str:
+    payload = json.dumps({"kind": kind, **normalize(params)}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """In-process LRU tier; entries also expire after ttl_seconds."""
+    blocking = False
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteCache:
+    """On-disk tier that survives restarts; values are stored as JSON and expired rows are pruned on each write."""
+    blocking = True
+
+    def __init__(self, path: str, ttl_seconds: float = 86400):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")  # lets worker processes sharing the file read while one writes
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            row = self._conn.execute("SELECT expires_at, value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[0] < time.time():
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+        return json.loads(row[1])
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)",
+                (key, now + self.ttl_seconds, json.dumps(value)),
+            )
+            self._conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class ResponseCache:
+    """Tiered cache for deterministic generations with per-kind hit/miss counters."""
+
+    def __init__(self, tiers: list, cache_nonzero_temperature: bool = False):
+        self.tiers = tiers
+        self.cache_nonzero_temperature = cache_nonzero_temperature
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+
+    async def get(self, kind: str, key: str) -> Any | None:
+        for index, tier in enumerate(self.tiers):
+            value = await call_backend(tier, "get", key)
+            if value is not None:
+                for faster_tier in self.tiers[:index]:
+                    await call_backend(faster_tier, "set", key, value)
+                self.hits[kind] = self.hits.get(kind, 0) + 1
+                return value
+        self.misses[kind] = self.misses.get(kind, 0) + 1
+        return None
+
+    async def set(self, key: str, value: Any) -> None:
+        for tier in self.tiers:
+            await call_backend(tier, "set", key, value)
+
+    def stats(self) -> dict:
+        return {
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+            "entries": [len(tier) for tier in self.tiers],
+        }
+
+    def cached(self, kind: str, key_extra: Callable[[], dict] = dict):
+        """Cache an async function on its bound arguments plus key_extra().
+
+        Calls made with a non-zero ``temperature`` argument skip the cache unless
+        cache_nonzero_temperature is set, and any call can pass ``bypass_cache=True``.
+        """
+        def decorator(fn):
+            signature = inspect.signature(fn)
+
+            @functools.wraps(fn)
+            async def wrapper(*args, bypass_cache: bool = False, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                params = dict(bound.arguments)
+                if bypass_cache or not self.tiers or (params.get("temperature") and not self.cache_nonzero_temperature):
+                    return await fn(*args, **kwargs)
+                key = make_cache_key(kind, {**params, **key_extra()})
+                value = await self.get(kind, key)
+                if value is not None:
+                    return value
+                value = await fn(*args, **kwargs)
+                if value is not None:
+                    await self.set(key, value)
+                return value
+
+            return wrapper
+
+        return decorator
@@ -0,0 +1,212 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import Awaitable, Callable
+
+try:
+    from PIL import Image
+except ImportError:  # optional dependency, only needed for thumbnails
+    Image = None
+
+NAME = re.compile(r"^[0-9a-f]{64}(-thumb\d+)?$")
+
+
+class BlobStore:
+    """Content-addressed files: blobs/<sha256 of the bytes>, plus refs/<name> files naming a blob.
+
+    Identical bytes are stored once, and a blob never changes once written, so
+    its digest doubles as a strong ETag. Small marker files (pending/<name>,
+    failed/<name>) let worker processes sharing the directory see each other's work.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._ready = False
+
+    def _dirs(self) -> None:
+        if not self._ready:
+            os.makedirs(os.path.join(self.root, "blobs"), exist_ok=True)
+            for directory in ("refs", "pending", "failed"):
+                os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+            self._ready = True
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, "blobs", digest)
+
+    def put(self, data: bytes) -> str:
+        self._dirs()
+        digest = hashlib.sha256(data).hexdigest()
+        if not os.path.exists(self.path(digest)):
+            self._write(self.path(digest), data)
+        return digest
+
+    def link(self, name: str, digest: str) -> None:
+        self._dirs()
+        self._write(os.path.join(self.root, "refs", name), digest.encode())
+
+    def resolve(self, name: str) -> str | None:
+        """Digest of the blob `name` refers to, or None if there is none (or the name is not a valid ref)."""
+        marker = self.marker("refs", name)
+        return marker[0] if marker else None
+
+    def mark(self, kind: str, name: str, text: str = "") -> None:
+        self._dirs()
+        self._write(os.path.join(self.root, kind, name), text.encode())
+
+    def unmark(self, kind: str, name: str) -> None:
+        try:
+            os.unlink(os.path.join(self.root, kind, name))
+        except FileNotFoundError:
+            pass
+
+    def marker(self, kind: str, name: str) -> tuple[str, float] | None:
+        """(contents, age in seconds) of a refs/pending/failed file, or None."""
+        if not NAME.match(name):
+            return None
+        path = os.path.join(self.root, kind, name)
+        try:
+            with open(path) as f:
+                return f.read().strip(), time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path: str, data: bytes) -> None:
+        # write-then-rename so readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class ImageStore:
+    """Generates images in background tasks and keeps them in a BlobStore under a stable ID.
+
+    The ID is a hash of what was asked for (prompt, size, model), so it is known
+    before the image exists and identical requests share one generation and one
+    file, also across worker processes sharing the BlobStore directory. A pending
+    marker older than `pending_seconds` is taken to belong to a process that died.
+    """
+
+    def __init__(self, blobs: BlobStore, pending_seconds: float = 300, poll_interval: float = 0.2):
+        self.blobs = blobs
+        self.pending_seconds = pending_seconds
+        self.poll_interval = poll_interval
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._interest: dict[str, int] = {}  # requests still waiting on each running generation
+        self.generated = 0
+        self.deduplicated = 0
+        self.abandoned = 0
+
+    def _pending_elsewhere(self, image_id: str) -> bool:
+        marker = self.blobs.marker("pending", image_id)
+        return marker is not None and marker[1] < self.pending_seconds
+
+    def submit(self, image_id: str, generate: Callable[[], Awaitable[bytes]], replace: bool = False) -> None:
+        """Start generating `image_id` unless it is already stored or in progress (or `replace` is set)."""
+        if image_id in self._tasks:
+            self._interest[image_id] += 1
+        if image_id in self._tasks or self._pending_elsewhere(image_id) or (not replace and self.blobs.resolve(image_id)):
+            self.deduplicated += 1
+            return
+        self.blobs.mark("pending", image_id)
+        self.blobs.unmark("failed", image_id)
+        self._interest[image_id] = 1
+        self._tasks[image_id] = asyncio.create_task(self._run(image_id, generate))
+
+    def abandon(self, image_id: str) -> None:
+        """The request that submitted `image_id` failed; cancel the generation if no other request wants it."""
+        if image_id not in self._tasks:
+            return
+        self._interest[image_id] -= 1
+        if self._interest[image_id] <= 0:
+            self.abandoned += 1
+            self._tasks[image_id].cancel()
+
+    async def _run(self, image_id: str, generate: Callable[[], Awaitable[bytes]]) -> None:
+        try:
+            data = await generate()
+            digest = await asyncio.to_thread(self.blobs.put, data)
+            self.blobs.link(image_id, digest)
+            self.generated += 1
+        except Exception as e:
+            logging.exception("Error in generating image %s", image_id)
+            self.blobs.mark("failed", image_id, str(e) or type(e).__name__)
+        finally:
+            self.blobs.unmark("pending", image_id)
+            self._tasks.pop(image_id, None)
+            self._interest.pop(image_id, None)
+
+    def status(self, image_id: str) -> str | None:
+        if image_id in self._tasks or self._pending_elsewhere(image_id):
+            return "pending"
+        if self.blobs.resolve(image_id):
+            return "ready"
+        if self.blobs.marker("failed", image_id):
+            return "failed"
+        return None
+
+    def failure(self, image_id: str) -> str | None:
+        marker = self.blobs.marker("failed", image_id)
+        return marker[0] if marker else None
+
+    async def wait(self, image_id: str, timeout: float) -> str | None:
+        """Wait up to `timeout` seconds for a pending image; returns its blob digest once stored."""
+        task = self._tasks.get(image_id)
+        if task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(task), timeout)
+            except asyncio.TimeoutError:
+                return None
+            except asyncio.CancelledError:
+                if not task.cancelled():  # this waiter was cancelled, not the abandoned generation
+                    raise
+        deadline = time.monotonic() + timeout
+        while self._pending_elsewhere(image_id) and time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+        return None if self._pending_elsewhere(image_id) else self.blobs.resolve(image_id)
+
+    async def thumbnail(self, image_id: str, max_pixels: int) -> str | None:
+        """Digest of a downscaled copy (made once, then stored like any image); None without Pillow or the image."""
+        name = f"{image_id}-thumb{max_pixels}"
+        digest = self.blobs.resolve(name)
+        if digest or Image is None:
+            return digest
+        source = self.blobs.resolve(image_id)
+        if source is None:
+            return None
+        try:
+            digest = await asyncio.to_thread(self._downscale, source, max_pixels)
+        except Exception:
+            logging.exception("Error in making a thumbnail of image %s", image_id)
+            return None
+        self.blobs.link(name, digest)
+        return digest
+
+    def _downscale(self, digest: str, max_pixels: int) -> str:
+        with Image.open(self.blobs.path(digest)) as image:
+            image.thumbnail((max_pixels, max_pixels))
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG", optimize=True)
+        return self.blobs.put(buffer.getvalue())
+
+    async def aclose(self, drain_timeout: float = 0) -> None:
+        """Give pending generations up to drain_timeout seconds to finish, then cancel the rest."""
+        tasks = list(self._tasks.values())
+        if tasks and drain_timeout > 0:
+            await asyncio.wait(tasks, timeout=drain_timeout)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._tasks), "generated": self.generated, "deduplicated": self.deduplicated,
+                "abandoned": self.abandoned}
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable
+
+from pydantic import BaseModel
+
+from ratelimit import call_backend
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class MemoryJobBackend:
+    """Keeps jobs in a dict; finished jobs are dropped after ttl_seconds."""
+    blocking = False
+
+    def __init__(self, ttl_seconds: float = 3600):
+        self.ttl_seconds = ttl_seconds
+        self._jobs: dict[str, dict] = {}
+
+    def create(self, job: dict) -> None:
+        self._prune()
+        self._jobs[job["id"]] = dict(job)
+
+    def get(self, job_id: str) -> dict | None:
+        job = self._jobs.get(job_id)
+        return dict(job) if job else None
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        if job_id in self._jobs:
+            self._jobs[job_id].update(fields)
+
+    def unfinished(self) -> list[dict]:
+        return [dict(job) for job in self._jobs.values() if job["status"] in ("queued", "running")]
+
+    def claim(self, job_id: str, stale_before: float) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None or not (job["status"] == "queued" or (job["status"] == "running" and job["startedAt"] < stale_before)):
+            return False
+        job.update(status="running", startedAt=time.time())
+        return True
+
+    def _prune(self) -> None:
+        cutoff = time.time() - self.ttl_seconds
+        for job_id in [k for k, job in self._jobs.items() if (job.get("finishedAt") or time.time()) < cutoff]:
+            del self._jobs[job_id]
+
+
+class SqliteJobBackend:
+    """File-backed job table, so queued jobs survive a restart and can be inspected by other processes."""
+    blocking = True
+
+    COLUMNS = ("id", "kind", "status", "payload", "result", "createdAt", "startedAt", "finishedAt")
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, status TEXT NOT NULL, "
+            "payload TEXT NOT NULL, result TEXT, createdAt REAL, startedAt REAL, finishedAt REAL)"
+        )
+        self._conn.commit()
+
+    def create(self, job: dict) -> None:
+        self._write("INSERT INTO jobs (id, kind, status, payload, createdAt) VALUES (?, ?, ?, ?, ?)",
+                    (job["id"], job["kind"], job["status"], json.dumps(job["payload"]), job["createdAt"]))
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_job(row) if row else None
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        assignments = ", ".join(f"{name} = ?" for name in fields if name in self.COLUMNS)
+        self._write(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def unfinished(self) -> list[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE status IN ('queued', 'running') ORDER BY createdAt"
+            ).fetchall()
+        return [self._to_job(row) for row in rows]
+
+    def claim(self, job_id: str, stale_before: float) -> bool:
+        """Mark a job running unless another process already has it; abandoned runs older than stale_before are retaken."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'running', startedAt = ? WHERE id = ? "
+                "AND (status = 'queued' OR (status = 'running' AND startedAt < ?))",
+                (time.time(), job_id, stale_before))
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def _write(self, sql: str, params: tuple) -> None:
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._conn.commit()
+
+    def _to_job(self, row: tuple) -> dict:
+        job = dict(zip(self.COLUMNS, row))
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+class JobQueue:
+    """Bounded in-process queue drained by asyncio workers.
+
+    `runners` maps a job kind to a coroutine function taking the job payload and
+    returning a pydantic model, which is stored as the job result. Several
+    processes may share one SqliteJobBackend: each job is claimed before it runs,
+    and a run older than `stale_after` seconds is treated as abandoned.
+    """
+
+    def __init__(self, backend, runners: dict[str, Callable[[dict], Awaitable[BaseModel]]],
+                 workers: int = 4, max_queued: int = 100, stale_after: float = 600):
+        self.backend = backend
+        self.runners = runners
+        self.worker_count = workers
+        self.max_queued = max_queued
+        self.stale_after = stale_after
+        self._queue: asyncio.Queue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._busy: set[asyncio.Task] = set()
+        self._stopping = False
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop  # set before the first await, so concurrent callers start the workers only once
+        self._stopping = False
+        self._queue = asyncio.Queue()
+        for job in await call_backend(self.backend, "unfinished"):
+            self._queue.put_nowait(job["id"])
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.worker_count)]
+
+    async def stop(self, drain_timeout: float = 0) -> None:
+        """Stop the workers, giving jobs that are already running up to drain_timeout seconds to finish.
+
+        Jobs still queued, or cut off when the timeout passes, go back to "queued"
+        and are picked up again on the next start with a SQLite backend.
+        """
+        self._stopping = True
+        busy = [worker for worker in self._workers if worker in self._busy]
+        for worker in self._workers:
+            if worker not in self._busy:
+                worker.cancel()
+        if busy and drain_timeout > 0:
+            await asyncio.wait(busy, timeout=drain_timeout)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._loop = None
+
+    async def submit(self, kind: str, payload: dict) -> dict:
+        await self.start()
+        if self._queue.qsize() >= self.max_queued:
+            raise JobQueueFull(f"{self._queue.qsize()} jobs already queued")
+        job = {"id": uuid.uuid4().hex, "kind": kind, "status": "queued", "payload": payload,
+               "result": None, "createdAt": time.time(), "startedAt": None, "finishedAt": None}
+        await call_backend(self.backend, "create", job)
+        self._queue.put_nowait(job["id"])
+        return job
+
+    async def get(self, job_id: str) -> dict | None:
+        return await call_backend(self.backend, "get", job_id)
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def _work(self) -> None:
+        worker = asyncio.current_task()
+        while not self._stopping:
+            job_id = await self._queue.get()
+            self._busy.add(worker)
+            try:
+                await self._run(job_id)
+            except Exception:
+                logging.exception("Error in running job %s", job_id)
+            finally:
+                self._busy.discard(worker)
+                self._queue.task_done()
+
+    async def _run(self, job_id: str) -> None:
+        job = await call_backend(self.backend, "get", job_id)
+        if job is None or not await call_backend(self.backend, "claim", job_id, time.time() - self.stale_after):
+            return
+        try:
+            result = (await self.runners[job["kind"]](job["payload"])).model_dump()
+            status = "failed" if result.get("error") else "succeeded"
+        except asyncio.CancelledError:
+            # Not off the loop: the worker is being cancelled, and awaiting here could be cancelled in turn.
+            self.backend.update(job_id, status="queued", startedAt=None)
+            raise
+        except Exception as e:
+            logging.exception("Error in job %s", job_id)
+            result, status = {"error": str(e)}, "failed"
+        await call_backend(self.backend, "update", job_id, status=status, result=result, finishedAt=time.time())
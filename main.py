@@ -1,9 +1,143 @@
-from fastapi import FastAPI, Body
-from schemas import DevelopStoryRequest ,StoryRequest
+import asyncio
+import functools
+import inspect
+import json
+import math
+import time
+import weakref
+from contextlib import aclosing, asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Callable, Literal
+
+from fastapi import FastAPI, Body, Header, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel
+import metrics
+from admission import DEFAULT, AdmissionController, AdmissionRejected, PriorityClass, Ticket
+from jobs import JobQueue, JobQueueFull, MemoryJobBackend, SqliteJobBackend
+from ratelimit import ClientTokenBudgets, UsageMeter, local_bucket, metering, request_usage
+from schemas import BatchStoryRequest, BatchStoryResponse, DevelopStoryRequest, JobResponse ,StoryRequest, StoryResponse, StoredStoryResponse
 from fastapi.middleware.cors import CORSMiddleware
-from story_writer import StoryWriter
+from fastapi.routing import APIRoute
+from profiler import ProfilingMiddleware, RequestProfiler, folded
+import story_writer
+from story_writer import StoryWriter, tracer
+from tracing import TracingMiddleware
+
+JOB_WORKERS = 4
+JOB_MAX_QUEUED = 100
+JOB_DB_PATH = story_writer.shared_path("jobs.sqlite3")  # or e.g. "story_jobs.sqlite3" to keep jobs across restarts
+SHUTDOWN_DRAIN_SECONDS = 30  # how long running jobs and image generations get to finish on shutdown
+
+ADMISSION_CAPACITY = 64  # pipelines running at once in this worker process; the rest queue by priority class
+ADMISSION_CLASSES = {
+    "interactive": PriorityClass(0, max_queued=200, max_wait=10),
+    "interactive-image": PriorityClass(1, max_queued=100, max_wait=15),
+    "batch": PriorityClass(2, max_queued=1000, max_wait=120),
+    "jobs": PriorityClass(3, max_queued=JOB_WORKERS, max_wait=None),  # already bounded by the job queue
+}
+
+admission = AdmissionController(ADMISSION_CAPACITY, ADMISSION_CLASSES)
+
+metrics.registry.register(metrics.CallbackMetric(
+    "story_admission_queue_depth", "Requests waiting for an admission slot, by priority class.",
+    lambda: {(name,): count for name, count in admission.queued.items()}, ("class",)))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_admission_running", "Requests holding an admission slot.", lambda: {(): admission.running}))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_admission_rejections_total", "Requests turned away because their class queue was full or they waited too long.",
+    lambda: dict(admission.rejected), ("class", "reason"), type="counter"))
+
+
+async def run_admitted(name: str, generate: Callable[..., Awaitable], request, max_wait: float | None = DEFAULT):
+    """Run `generate(request)` once an admission slot of class `name` is free; raises AdmissionRejected."""
+    async with admission.slot(name, max_wait) as ticket:
+        record_admission_wait(name, ticket)
+        return await generate(request)
+
+
+job_queue = JobQueue(
+    SqliteJobBackend(JOB_DB_PATH) if JOB_DB_PATH else MemoryJobBackend(),
+    runners={
+        "story": lambda payload: run_admitted("jobs", StoryWriter.new_story, StoryRequest.model_construct(**payload)),
+        "develop-story": lambda payload: run_admitted(
+            "jobs", StoryWriter.develop_story, DevelopStoryRequest.model_construct(**payload)),
+    },
+    workers=JOB_WORKERS,
+    max_queued=JOB_MAX_QUEUED,
+)
+
+metrics.registry.register(metrics.CallbackMetric(
+    "story_job_queue_depth", "Jobs waiting for a worker.", lambda: {(): job_queue.depth()}))
+
+CLIENT_TOKENS_PER_MINUTE = 60_000
+CLIENT_ID_HEADER = "X-Client-Id"
+# Off by default: a caller could send a new ID with every request and get a fresh budget each time. Only turn it on
+# behind an authenticating proxy that sets the header; budgets are otherwise keyed on the client IP.
+TRUST_CLIENT_ID_HEADER = False
+
+client_budgets = ClientTokenBudgets(
+    CLIENT_TOKENS_PER_MINUTE, bucket=story_writer.shared_buckets.bucket if story_writer.shared_buckets else local_bucket)
+
+metrics.registry.register(metrics.CallbackMetric(
+    "story_client_budget_rejections_total", "Requests refused because the client's token budget was spent.",
+    lambda: {(): client_budgets.rejected}, type="counter"))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await StoryWriter.start()
+    await job_queue.start()
+    yield
+    # uvicorn has already drained in-flight requests; finish background work before closing the clients.
+    await job_queue.stop(SHUTDOWN_DRAIN_SECONDS)
+    await StoryWriter.aclose(SHUTDOWN_DRAIN_SECONDS)
+
+
+PROFILER_ENABLED = False  # exposes GET /debug/profile; leave off unless chasing a latency problem
+PROFILER_MAX_SECONDS = 300
+
+profiler = RequestProfiler()
+
+handler_started: ContextVar[int | None] = ContextVar("handler_started", default=None)
+
+
+class TracedRoute(APIRoute):
+    """Route that traces request parsing and validation separately from the endpoint itself."""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        if not inspect.iscoroutinefunction(endpoint):  # sync endpoints run in the threadpool; leave them as they are
+            super().__init__(path, endpoint, **kwargs)
+            return
 
-app = FastAPI()
+        @functools.wraps(endpoint)
+        async def traced_endpoint(*args, **values):
+            # FastAPI has read and validated the body (and headers/query) by the time the endpoint is called.
+            if handler_started.get() is not None:
+                tracer.record("request.validate", handler_started.get(), time.time_ns())
+            with tracer.span(f"endpoint.{endpoint.__name__}"):
+                return await endpoint(*args, **values)
+
+        super().__init__(path, traced_endpoint, **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def traced_handler(request: Request) -> Response:
+            token = handler_started.set(time.time_ns())
+            try:
+                return await handler(request)
+            finally:
+                handler_started.reset(token)
+
+        return traced_handler
+
+
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = TracedRoute
+
+app.add_middleware(ProfilingMiddleware, profiler=profiler)
+app.add_middleware(TracingMiddleware, tracer=tracer)
 
 app.add_middleware(
     CORSMiddleware,
@@ -13,13 +147,294 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+class ModelResponse(JSONResponse):
+    """Renders a pydantic model to JSON bytes in pydantic-core.
+
+    Endpoints return it instead of the bare model, which FastAPI would first walk
+    with jsonable_encoder and then encode again with json.dumps.
+    """
+
+    def render(self, content) -> bytes:
+        with tracer.span("response.serialize"):
+            if isinstance(content, BaseModel):
+                return content.model_dump_json().encode("utf-8")
+            return super().render(content)
+
+
+async def server_sent_events(events: AsyncIterator[tuple[str, dict]]) -> AsyncIterator[str]:
+    async for event, data in events:
+        yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def event_stream_response(events: AsyncIterator[tuple[str, dict]]) -> StreamingResponse:
+    return StreamingResponse(
+        server_sent_events(events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def client_id(http_request: Request) -> str:
+    if TRUST_CLIENT_ID_HEADER and http_request.headers.get(CLIENT_ID_HEADER):
+        return http_request.headers[CLIENT_ID_HEADER]
+    return http_request.client.host if http_request.client else "unknown"
+
+
+async def reserve_tokens(http_request: Request, *requests: StoryRequest) -> tuple[str, int]:
+    """Reserve the requests' worst-case token usage against the caller's budget, or refuse with 429."""
+    client = client_id(http_request)
+    # A bucket holds at most a minute's worth, so that is the most a reservation can take (and later settle).
+    estimate = min(sum(StoryWriter.estimate_request_tokens(request) for request in requests),
+                   client_budgets.tokens_per_minute)
+    retry_after = await client_budgets.reserve(client, estimate)
+    if retry_after:
+        raise HTTPException(status_code=429, detail="Token budget for this client is spent, retry later",
+                            headers={"Retry-After": str(math.ceil(retry_after))})
+    return client, estimate
+
+
+def priority_class(request: StoryRequest) -> str:
+    # Text-only requests are the quick ones; serving them first keeps interactive latency low under load.
+    return "interactive-image" if request.imageNeeded else "interactive"
+
+
+async def admit(request: StoryRequest, client: str, estimate: int) -> Ticket:
+    """Wait for an admission slot, or refund the reservation and refuse with 503 once the class's queue gives up."""
+    name = priority_class(request)
+    try:
+        ticket = await admission.acquire(name)
+    except AdmissionRejected as e:
+        await client_budgets.adjust(client, -estimate)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+    except BaseException:  # e.g. the client went away while queued
+        await client_budgets.adjust(client, -estimate)
+        raise
+    record_admission_wait(name, ticket)
+    return ticket
+
+
+def record_admission_wait(name: str, ticket: Ticket) -> None:
+    metrics.admission_wait.observe(ticket.waited, name)
+    if ticket.waited:
+        now = time.time_ns()
+        tracer.record("admission.wait", now - int(ticket.waited * 1e9), now, **{"admission.class": name})
+
+
+def releasing(events: AsyncIterator[tuple[str, dict]], ticket: Ticket,
+              refund: Callable[[], Awaitable[None]]) -> AsyncIterator[tuple[str, dict]]:
+    """Hold the admission slot until the stream ends, or until it is dropped without ever being started.
+
+    A stream dropped unstarted never settles its token reservation, so refund() is scheduled instead.
+    """
+    loop = asyncio.get_running_loop()
+    started = False
+
+    async def hold():
+        nonlocal started
+        started = True
+        try:
+            async with aclosing(events):
+                async for item in events:
+                    yield item
+        finally:
+            ticket.release()
+
+    def dropped():
+        ticket.release()
+        if not started and not loop.is_closed():
+            loop.call_soon_threadsafe(run_in_background, refund)
+
+    stream = hold()
+    weakref.finalize(stream, dropped)
+    return stream
+
+
+background_tasks: set[asyncio.Task] = set()
+
+
+def run_in_background(start: Callable[[], Awaitable[None]]) -> None:
+    task = asyncio.ensure_future(start())
+    background_tasks.add(task)  # the loop only keeps weak references to tasks
+    task.add_done_callback(background_tasks.discard)
+
+
+async def settle_events(events: AsyncIterator[tuple[str, dict]], client: str, estimate: int) -> AsyncIterator[tuple[str, dict]]:
+    """Charge the client for the upstream tokens the stream used, including those streamed before a disconnect."""
+    meter = UsageMeter()
+    # Not reset: the generator may be closed from another context. It is iterated by the response's own task.
+    request_usage.set(meter)
+    try:
+        async for event, data in events:
+            yield event, data
+    finally:
+        # Close the stream here, so a call it cuts short charges what it streamed to this meter before settling.
+        request_usage.set(meter)
+        await events.aclose()
+        await client_budgets.adjust(client, meter.tokens - estimate)
+
+
 @app.post("/story")
-def create_story(request: StoryRequest = Body(...)):
-    result = StoryWriter.new_story(request)
-    return result
+async def create_story(http_request: Request, request: StoryRequest = Body(...)):
+    client, estimate = await reserve_tokens(http_request, request)
+    ticket = await admit(request, client, estimate)
+    try:
+        with metering() as meter:
+            result = await StoryWriter.new_story(request)
+    finally:
+        ticket.release()
+        await client_budgets.adjust(client, meter.tokens - estimate)
+    return ModelResponse(result)
+
+
+@app.post("/story/stream")
+async def create_story_stream(http_request: Request, request: StoryRequest = Body(...)):
+    client, estimate = await reserve_tokens(http_request, request)
+    ticket = await admit(request, client, estimate)
+    return event_stream_response(releasing(settle_events(StoryWriter.stream_new_story(request), client, estimate), ticket,
+                                           lambda: client_budgets.adjust(client, -estimate)))
+
+
+@app.post("/stories/batch")
+async def create_stories(http_request: Request, request: BatchStoryRequest = Body(...), stream: bool = False, accept: str | None = Header(None)):
+    client, estimate = await reserve_tokens(http_request, *request.items)
+
+    async def run_item(item: StoryRequest) -> StoryResponse:
+        try:
+            return await run_admitted("batch", StoryWriter.new_story, item)
+        except AdmissionRejected as e:
+            return StoryResponse(error=str(e))
+
+    # The items run in tasks started on the first iteration, so they charge the meter current at that point.
+    completed = StoryWriter.new_stories(request.items, request.concurrency, runner=run_item)
+    if stream or (accept and "application/x-ndjson" in accept):
+        async def ndjson_lines():
+            meter = UsageMeter()
+            request_usage.set(meter)  # not reset, as in settle_events
+            try:
+                async for index, result in completed:
+                    yield json.dumps({"index": index, **result.model_dump(mode="json")}) + "\n"
+            finally:
+                await client_budgets.adjust(client, meter.tokens - estimate)
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+    results = [None] * len(request.items)
+    with metering() as meter:
+        try:
+            async for index, result in completed:
+                results[index] = result
+        finally:
+            await client_budgets.adjust(client, meter.tokens - estimate)
+    return ModelResponse(BatchStoryResponse(results=results))
+
+
+async def require_story(request: DevelopStoryRequest) -> None:
+    if request.storyId and await story_writer.story_store.get(request.storyId) is None:
+        raise HTTPException(status_code=404, detail="Story not found")
 
 
 @app.post("/develop-story")
-def develop_story(request: DevelopStoryRequest = Body(...)):
-    result = StoryWriter.develop_story(request)
-    return result
+async def develop_story(http_request: Request, request: DevelopStoryRequest = Body(...)):
+    await require_story(request)
+    client, estimate = await reserve_tokens(http_request, request)
+    ticket = await admit(request, client, estimate)
+    try:
+        with metering() as meter:
+            result = await StoryWriter.develop_story(request)
+    finally:
+        ticket.release()
+        await client_budgets.adjust(client, meter.tokens - estimate)
+    return ModelResponse(result)
+
+
+@app.post("/develop-story/stream")
+async def develop_story_stream(http_request: Request, request: DevelopStoryRequest = Body(...)):
+    await require_story(request)
+    client, estimate = await reserve_tokens(http_request, request)
+    ticket = await admit(request, client, estimate)
+    return event_stream_response(
+        releasing(settle_events(StoryWriter.stream_develop_story(request), client, estimate), ticket,
+                  lambda: client_budgets.adjust(client, -estimate)))
+
+
+async def submit_job(kind: str, request: StoryRequest, http_request: Request) -> JobResponse:
+    # Jobs are charged their reserved estimate; the runner has no client to reconcile against.
+    client, estimate = await reserve_tokens(http_request, request)
+    # The payload is stored already validated (experimentBoundary is scaled), so runners rebuild it with model_construct.
+    try:
+        job = await job_queue.submit(kind, request.model_dump())
+    except JobQueueFull:
+        await client_budgets.adjust(client, -estimate)
+        raise HTTPException(status_code=503, detail="Job queue is full, retry later", headers={"Retry-After": "5"})
+    return ModelResponse(JobResponse(**job), status_code=202)
+
+
+@app.post("/jobs/story", status_code=202)
+async def create_story_job(http_request: Request, request: StoryRequest = Body(...)):
+    return await submit_job("story", request, http_request)
+
+
+@app.post("/jobs/develop-story", status_code=202)
+async def develop_story_job(http_request: Request, request: DevelopStoryRequest = Body(...)):
+    await require_story(request)
+    return await submit_job("develop-story", request, http_request)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return ModelResponse(JobResponse(**job))
+
+
+@app.get("/stories/{story_id}")
+async def get_story(story_id: str):
+    story = await story_writer.story_store.get(story_id)
+    if story is None:
+        raise HTTPException(status_code=404, detail="Story not found")
+    return ModelResponse(StoredStoryResponse(**story))
+
+
+IMAGE_WAIT_SECONDS = 30
+THUMBNAIL_PIXELS = 256
+
+
+@app.get("/images/{image_id}")
+async def get_image(image_id: str, thumbnail: bool = False, if_none_match: str | None = Header(None)):
+    """Serve a generated image, waiting briefly if it is still being generated; supports Range and ETag."""
+    image_store = story_writer.image_store
+    if image_store.status(image_id) is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    digest = await image_store.wait(image_id, IMAGE_WAIT_SECONDS)
+    if digest is None:
+        if image_store.status(image_id) == "failed":
+            raise HTTPException(status_code=502, detail=f"Image generation failed: {image_store.failure(image_id)}")
+        return Response(status_code=202, headers={"Retry-After": "5"})
+    if thumbnail:
+        digest = await image_store.thumbnail(image_id, THUMBNAIL_PIXELS) or digest
+    etag = f'"{digest}"'
+    # Not immutable: a bypassCache request regenerates the image behind the same URL.
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(image_store.blobs.path(digest), media_type="image/png", headers=headers)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/profile")
+async def get_profile(seconds: float = Query(10, gt=0, le=PROFILER_MAX_SECONDS), top: int = Query(5, ge=1, le=100),
+                      format: Literal["folded", "json"] = "folded"):
+    """Sample in-flight requests for `seconds` and return the stacks of the slowest `top` that finished meanwhile."""
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        profiles = await profiler.run(seconds, top)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if format == "json":
+        return {"profiles": profiles}
+    return PlainTextResponse(folded(profiles))
@@ -0,0 +1,131 @@
+"""Minimal Prometheus-style instruments rendered in the text exposition format.
+
+Recording is a dict lookup plus an in-place list/number update, so the hot path
+never builds label dicts or strings; those are only produced when /metrics is scraped.
+"""
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+def format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self._values.items():
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels, value: float) -> None:
+        self._values[labels] = value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label set: one count per bucket, one for +Inf, then the running sum
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(series[-1])}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class CallbackMetric:
+    """Gauge (or counter) whose values are read from `fn` at scrape time, e.g. cache or queue stats."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], dict[tuple, float]], labelnames: tuple[str, ...] = (),
+                 type: str = "gauge"):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.labelnames = labelnames
+        self.fn = fn
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self.fn().items():
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+stage_latency = registry.register(Histogram(
+    "story_stage_latency_seconds", "Wall-clock latency of each pipeline stage.", ("stage",)))
+upstream_tokens = registry.register(Counter(
+    "story_upstream_tokens_total", "Tokens reported by the provider, split by stage and prompt/completion.", ("stage", "type")))
+upstream_errors = registry.register(Counter(
+    "story_upstream_errors_total", "Failed upstream calls by stage and exception type.", ("stage", "error")))
+pipeline_errors = registry.register(Counter(
+    "story_pipeline_errors_total", "Requests that ended in an error response, by pipeline and exception type.", ("pipeline", "error")))
+in_flight = registry.register(Gauge(
+    "story_in_flight", "Pipelines currently executing.", ("pipeline",)))
+truncated_completions = registry.register(Counter(
+    "story_truncated_completions_total", "Completions cut off at their max_tokens ceiling, by stage.", ("stage",)))
+admission_wait = registry.register(Histogram(
+    "story_admission_wait_seconds", "Time requests spent queued for an admission slot, by priority class.", ("class",)))
+semantic_cache_lookup = registry.register(Histogram(
+    "story_semantic_cache_lookup_seconds", "Embedding plus index search time of near-duplicate cache lookups, by stage.",
+    ("stage",), buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05)))
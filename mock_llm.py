@@ -0,0 +1,122 @@
+"""Local stand-in for an OpenAI-compatible provider, used by benchmark.py.
+
+Serves /chat/completions (plain and streamed) and /images/generations with a
+configurable log-normal latency, completion size and 429/5xx injection.
+
+    uvicorn mock_llm:app --port 9000
+"""
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Body
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 1x1 transparent PNG, so clients that decode b64_json get a real image
+PIXEL_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+WORDS = ("the", "hero", "walked", "through", "a", "quiet", "village", "where", "nobody", "remembered", "her", "name")
+
+
+class MockSettings:
+    def __init__(self, latency: float = 0.5, latency_sigma: float = 0.3, completion_tokens: int = 200,
+                 image_latency: float = 2.0, rate_limit_rate: float = 0.0, server_error_rate: float = 0.0,
+                 seed: int | None = None):
+        self.latency = latency  # median seconds for a full completion
+        self.latency_sigma = latency_sigma
+        self.completion_tokens = completion_tokens
+        self.image_latency = image_latency
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.random = random.Random(seed)
+
+    def sample_latency(self, median: float) -> float:
+        return median * self.random.lognormvariate(0, self.latency_sigma) if median > 0 else 0
+
+    def injected_error(self) -> JSONResponse | None:
+        roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return JSONResponse({"error": {"message": "Rate limit exceeded", "type": "rate_limit"}}, status_code=429,
+                                headers={"Retry-After": "1"})
+        if roll < self.rate_limit_rate + self.server_error_rate:
+            return JSONResponse({"error": {"message": "Upstream overloaded", "type": "server_error"}}, status_code=503)
+        return None
+
+
+def create_app(settings: MockSettings | None = None) -> FastAPI:
+    mock = FastAPI()
+    mock.state.settings = settings = settings or MockSettings()
+    mock.state.calls = {"chat": 0, "stream": 0, "image": 0}
+
+    def completion_text(tokens: int) -> list[str]:
+        return [settings.random.choice(WORDS) for _ in range(tokens)]
+
+    def usage(prompt: str, completion_tokens: int) -> dict:
+        prompt_tokens = max(1, len(prompt) // 4)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+    @mock.post("/chat/completions")
+    async def chat_completions(body: dict = Body(...)):
+        error = settings.injected_error()
+        if error:
+            return error
+        prompt = " ".join(message.get("content", "") for message in body.get("messages", []))
+        tokens = min(settings.completion_tokens, body.get("max_tokens") or settings.completion_tokens)
+        finish_reason = "length" if tokens < settings.completion_tokens else "stop"
+        words = completion_text(tokens)
+        if body.get("response_format", {}).get("type") == "json_object":
+            words = [json.dumps({"story": " ".join(words), "summary": " ".join(words[:30])})]
+        latency = settings.sample_latency(settings.latency)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = body.get("model", "mock")
+
+        if not body.get("stream"):
+            mock.state.calls["chat"] += 1
+            await asyncio.sleep(latency)
+            return {
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "finish_reason": finish_reason,
+                             "message": {"role": "assistant", "content": " ".join(words)}}],
+                "usage": usage(prompt, tokens),
+            }
+
+        mock.state.calls["stream"] += 1
+
+        async def events():
+            delay = latency / max(1, len(words))
+            for index, word in enumerate(words):
+                await asyncio.sleep(delay)
+                last = index == len(words) - 1
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": word if index == 0 else " " + word},
+                                      "finish_reason": finish_reason if last else None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            if (body.get("stream_options") or {}).get("include_usage"):
+                chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                         "choices": [], "usage": usage(prompt, tokens)}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @mock.post("/images/generations")
+    async def images_generations(body: dict = Body(...)):
+        error = settings.injected_error()
+        if error:
+            return error
+        mock.state.calls["image"] += 1
+        await asyncio.sleep(settings.sample_latency(settings.image_latency))
+        return {"created": int(time.time()),
+                "data": [{"url": f"https://mock.invalid/{uuid.uuid4().hex}.png",
+                          "b64_json": base64.b64encode(PIXEL_PNG).decode()}]}
+
+    return mock
+
+
+app = create_app()
@@ -0,0 +1,145 @@
+"""On-demand sampling profiler for the slowest requests.
+
+While a capture is running, a background thread samples every in-flight request
+every `interval` seconds. A request that is executing contributes the event
+loop thread's Python stack; one that is suspended contributes its chain of
+awaiting coroutines, prefixed with "[await]", so time spent waiting on
+upstream calls, locks or queues shows up as well as CPU time. Stacks are kept in
+the folded "frame;frame;frame count" format that flamegraph.pl, speedscope and
+inferno read directly.
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from tracing import current_span
+
+
+def frame_name(frame) -> str:
+    return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+
+def await_chain(coro) -> list[str]:
+    """Outermost-first frames of a suspended coroutine and whatever it is awaiting."""
+    names = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+        if frame is None:
+            break
+        names.append(frame_name(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+    return names
+
+
+def thread_stack(frame, stop_code) -> list[str]:
+    """Outermost-first frames of a running thread stack, from the task's own coroutine frame inwards."""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        if frame.f_code is stop_code:
+            break
+        frame = frame.f_back
+    return names[::-1]
+
+
+class Capture:
+    def __init__(self, seconds: float, top: int):
+        self.deadline = time.monotonic() + seconds
+        self.top = top
+        self.slowest: list[tuple[float, int, dict]] = []  # min-heap of (duration, tiebreak, profile)
+        self._sequence = itertools.count()
+
+    def add(self, profile: dict) -> None:
+        entry = (profile["durationSeconds"], next(self._sequence), profile)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, entry)
+        elif entry[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def profiles(self) -> list[dict]:
+        return [profile for _, _, profile in sorted(self.slowest, key=lambda entry: entry[0], reverse=True)]
+
+
+class RequestProfiler:
+    """Samples the stacks of in-flight requests during a capture and keeps the slowest `top` of them."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.capture: Capture | None = None
+        self._requests: dict[asyncio.Task, tuple[str, float, str | None, Counter]] = {}
+        self._loop_thread: int | None = None
+
+    async def run(self, seconds: float, top: int) -> list[dict]:
+        """Capture for `seconds`; returns the slowest `top` requests that finished meanwhile, slowest first."""
+        if self.capture is not None:
+            raise RuntimeError("A profile is already being captured")
+        self.capture = capture = Capture(seconds, top)
+        self._loop_thread = threading.get_ident()
+        sampler = threading.Thread(target=self._sample_until, args=(capture,), daemon=True)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.capture = None
+            await asyncio.to_thread(sampler.join)
+        return capture.profiles()
+
+    def begin(self, name: str) -> asyncio.Task | None:
+        """Track the current request task while a capture runs; pass the result to finish()."""
+        if self.capture is None:
+            return None
+        task = asyncio.current_task()
+        span = current_span.get()
+        self._requests[task] = (name, time.perf_counter(), getattr(span, "trace_id", None), Counter())
+        return task
+
+    def finish(self, task: asyncio.Task | None) -> None:
+        if task is None:
+            return
+        name, started, trace_id, stacks = self._requests.pop(task)
+        if self.capture is not None and stacks:
+            self.capture.add({"name": name, "durationSeconds": time.perf_counter() - started, "traceId": trace_id,
+                              "samples": sum(stacks.values()), "stacks": dict(stacks)})
+
+    def _sample_until(self, capture: Capture) -> None:
+        while self.capture is capture and time.monotonic() < capture.deadline:
+            time.sleep(self.interval)
+            loop_frame = sys._current_frames().get(self._loop_thread)
+            for task, (_, _, _, stacks) in list(self._requests.items()):
+                coro = task.get_coro()
+                if getattr(coro, "cr_running", False) and loop_frame is not None:
+                    stack = thread_stack(loop_frame, coro.cr_code)
+                else:
+                    stack = ["[await]", *await_chain(coro)]
+                stacks[";".join(stack)] += 1
+
+
+def folded(profiles: list[dict]) -> str:
+    """All profiles as one folded-stack file, each request under a root frame naming it."""
+    lines = []
+    for profile in profiles:
+        root = f"{profile['name']} {profile['durationSeconds'] * 1000:.0f}ms trace={profile['traceId'] or '-'}"
+        lines += [f"{root};{stack} {count}" for stack, count in profile["stacks"].items()]
+    return "\n".join(lines) + "\n"
+
+
+class ProfilingMiddleware:
+    """ASGI middleware registering each HTTP request with the profiler while a capture is running."""
+
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.profiler.capture is None:
+            return await self.app(scope, receive, send)
+        task = self.profiler.begin(f"{scope['method']} {scope['path']}")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.finish(task)
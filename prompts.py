@@ -0,0 +1,129 @@
+import hashlib
+import string
+
+from tokens import count_tokens
+
+
+class PromptTooLarge(ValueError):
+    pass
+
+
+def estimate_tokens(text: str) -> int:
+    return count_tokens(text)
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """Keep the end of `text` (the most recent part of a running summary) within roughly max_tokens."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    words = text.split()
+    # binary search for the longest tail of words that fits
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens("... " + " ".join(words[-middle:])) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return "... " + " ".join(words[len(words) - low:])
+
+
+class PromptTemplate:
+    """A prompt compiled once at import.
+
+    Static instructions go in the system message and the user message lists the
+    short parameters before the long free text, so requests share the longest
+    possible prefix for provider-side prompt caching.
+    """
+
+    def __init__(self, name: str, version: str, user: str, system: str | None = None, weight: float = 0.0):
+        self.name = name
+        self.version = version
+        self.weight = weight
+        self._user = string.Template(user)
+        self._system_message = {"role": "system", "content": system} if system else None
+        self._static_tokens = estimate_tokens((system or "") + self._user.safe_substitute({}))
+        self.fields = tuple(self._user.get_identifiers())
+
+    def messages(self, **values) -> list[dict]:
+        user_message = {"role": "user", "content": self._user.substitute(values)}
+        return [self._system_message, user_message] if self._system_message else [user_message]
+
+    def text(self, **values) -> str:
+        """Single-string form for endpoints without chat roles, such as image generation."""
+        return "\n\n".join(message["content"] for message in self.messages(**values))
+
+    def estimate_tokens(self, **values) -> int:
+        """Prompt-token estimate without rendering, so oversized inputs can be rejected before any work."""
+        return self._static_tokens + sum(estimate_tokens(str(value)) for value in values.values())
+
+
+class PromptRegistry:
+    def __init__(self):
+        self._templates: dict[str, dict[str, PromptTemplate]] = {}
+
+    def register(self, template: PromptTemplate) -> PromptTemplate:
+        self._templates.setdefault(template.name, {})[template.version] = template
+        return template
+
+    def versions(self, name: str) -> list[str]:
+        return list(self._templates[name])
+
+    def select(self, name: str, version: str | None = None, key: str = "") -> PromptTemplate:
+        """Return the requested version, or A/B-pick among weighted versions, stable for the same key."""
+        templates = self._templates[name]
+        if version is not None:
+            if version not in templates:
+                raise ValueError(f"Unknown {name} prompt version {version!r}")
+            return templates[version]
+        candidates = [template for template in templates.values() if template.weight > 0]
+        if len(candidates) == 1:
+            return candidates[0]
+        total = sum(template.weight for template in candidates)
+        point = int(hashlib.sha256(key.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF * total
+        for template in candidates:
+            point -= template.weight
+            if point <= 0:
+                return template
+        return candidates[-1]
+
+
+prompt_registry = PromptRegistry()
+
+# v1 keeps the original ad-hoc wording for comparison; v2 is the prefix-cache friendly layout and the default.
+prompt_registry.register(PromptTemplate(
+    "story", "v1",
+    "Write a $genre story based on the following plot: $plot. Include $characters main character(s), "
+    "$paragraphs paragraph(s), and aim for about $words words. "))
+prompt_registry.register(PromptTemplate(
+    "story", "v2",
+    "Main characters: $characters\nParagraphs: $paragraphs\nTarget length: about $words words\n"
+    "Genre: $genre\nPlot: $plot",
+    system="You are a skilled fiction writer. Write an original story in the given genre that follows the given plot. "
+           "Use exactly the requested number of main characters and paragraphs, stay close to the target length, "
+           "and reply with the story text only.",
+    weight=1.0))
+prompt_registry.register(PromptTemplate(
+    "develop", "v1",
+    "Use the following summary of the story: $summary of type $genre anduse the $plot to develop the story further. "
+    "Include $characters main character(s), $paragraphs paragraph(s), and aim for about $words words."))
+prompt_registry.register(PromptTemplate(
+    "develop", "v2",
+    "Main characters: $characters\nParagraphs: $paragraphs\nTarget length: about $words words\n"
+    "Genre: $genre\nDirection: $plot\nStory so far: $summary",
+    system="You are a skilled fiction writer continuing an existing story. Write the next part of the story from the "
+           "summary of the story so far, taking it in the given direction. Use exactly the requested number of main "
+           "characters and paragraphs, stay close to the target length, and reply with the story text only.",
+    weight=1.0))
+prompt_registry.register(PromptTemplate(
+    "summary", "v1",
+    "Summarize the following $genre story in 3-4 sentences: $story"))
+prompt_registry.register(PromptTemplate(
+    "summary", "v2",
+    "Genre: $genre\nStory: $story",
+    system="Summarize the story you are given in 3-4 sentences. Reply with the summary only.",
+    weight=1.0))
+prompt_registry.register(PromptTemplate(
+    "image", "v1",
+    "Generate an illustration for this $genre story: $plot",
+    weight=1.0))
@@ -0,0 +1,316 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Iterator
+
+import openai
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """True for provider push-back (429, 5xx, timeouts) that should shrink the concurrency limit."""
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError)):
+        return True
+    status_code = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+class TokenBucket:
+    """Refills `rate_per_minute` units per minute up to `capacity` (one minute's worth by default)."""
+    blocking = False
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate_per_second)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1) -> float:
+        """Wait until `amount` units are available and take them; returns the time spent waiting."""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                delay = (amount - self.tokens) / self.rate_per_second
+                await asyncio.sleep(delay)
+                waited += delay
+
+    def try_acquire(self, amount: float = 1) -> float:
+        """Take `amount` units if they are available now and return 0, else return the seconds until they would be."""
+        amount = min(amount, self.capacity)
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate_per_second
+
+    def adjust(self, amount: float) -> None:
+        """Charge (or refund, if negative) the difference between an estimate and actual usage."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class SqliteBuckets:
+    """Token buckets kept in one SQLite file, so every worker process on a host draws from the same buckets."""
+
+    def __init__(self, path: str, idle_seconds: float = 3600):
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def bucket(self, name: str, rate_per_minute: float, capacity: float | None = None) -> "SharedTokenBucket":
+        return SharedTokenBucket(self, name, rate_per_minute, capacity)
+
+    def update(self, name: str, capacity: float, rate_per_second: float, change: Callable[[float], tuple[float, float]]) -> float:
+        """Refill bucket `name`, then let change(tokens) return (new tokens, result) inside one write transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                row = self._conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate_per_second)
+                tokens, result = change(tokens)
+                self._conn.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                                   (name, tokens, now))
+                if row is None:  # a new bucket: drop long-idle ones, which would have refilled to capacity anyway
+                    self._conn.execute("DELETE FROM buckets WHERE updated < ?", (now - self.idle_seconds,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+
+class SharedTokenBucket:
+    """TokenBucket whose level lives in a SqliteBuckets row instead of process memory.
+
+    try_acquire() and adjust() may wait on another worker's SQLite lock; async
+    code calls them through call_backend().
+    """
+    blocking = True
+
+    def __init__(self, store: SqliteBuckets, name: str, rate_per_minute: float, capacity: float | None = None,
+                 poll_interval: float = 0.05):
+        self.store = store
+        self.name = name
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.poll_interval = poll_interval
+
+    def try_acquire(self, amount: float = 1) -> float:
+        amount = min(amount, self.capacity)
+
+        def take(tokens: float) -> tuple[float, float]:
+            if tokens >= amount:
+                return tokens - amount, 0.0
+            return tokens, (amount - tokens) / self.rate_per_second
+
+        return self.store.update(self.name, self.capacity, self.rate_per_second, take)
+
+    async def acquire(self, amount: float = 1) -> float:
+        waited = 0.0
+        while True:
+            delay = await asyncio.to_thread(self.try_acquire, amount)
+            if not delay:
+                return waited
+            # other processes draw from the same bucket, so re-check rather than sleeping the whole deficit
+            delay = max(self.poll_interval, min(delay, 1.0))
+            await asyncio.sleep(delay)
+            waited += delay
+
+    def adjust(self, amount: float) -> None:
+        self.store.update(self.name, self.capacity, self.rate_per_second,
+                          lambda tokens: (min(self.capacity, tokens - amount), 0.0))
+
+
+def local_bucket(name: str, rate_per_minute: float) -> TokenBucket:
+    return TokenBucket(rate_per_minute)
+
+
+async def call_backend(backend: Any, method: str, *args, **kwargs) -> Any:
+    """backend.<method>(*args, **kwargs), in a worker thread when the backend sets `blocking`.
+
+    SQLite-backed buckets, caches, story stores and job queues set it: their
+    file is shared with other worker processes, and waiting on another
+    process's lock must not stall the event loop.
+    """
+    fn = getattr(backend, method)
+    return await asyncio.to_thread(fn, *args, **kwargs) if backend.blocking else fn(*args, **kwargs)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD limit on in-flight upstream calls.
+
+    Each success grows the limit by 1/limit (about +1 per window of calls) and an
+    overload error halves it, at most once per `backoff_interval` seconds so a burst
+    of failures from the same window only counts once. Other failures and
+    cancellations say nothing about upstream capacity and leave it unchanged.
+    """
+
+    def __init__(self, initial: int = 32, minimum: int = 1, maximum: int = 200,
+                 decrease_factor: float = 0.5, backoff_interval: float = 1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.backoff_interval = backoff_interval
+        self.in_flight = 0
+        self._last_backoff = 0.0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, overloaded: bool = False, succeeded: bool = True) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded:
+                if now - self._last_backoff >= self.backoff_interval:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._last_backoff = now
+            elif succeeded:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class UpstreamUsage:
+    def __init__(self):
+        self.tokens: int | None = None
+
+
+class UsageMeter:
+    """Tokens a request actually spent upstream; cache hits and calls coalesced onto another request's add nothing."""
+
+    def __init__(self):
+        self.tokens = 0
+
+
+# The meter of the request being served. Tasks the request starts inherit it, so a single-flight leader's call
+# is charged to the request that made it.
+request_usage: ContextVar[UsageMeter | None] = ContextVar("request_usage", default=None)
+
+
+@contextmanager
+def metering() -> Iterator[UsageMeter]:
+    meter = UsageMeter()
+    token = request_usage.set(meter)
+    try:
+        yield meter
+    finally:
+        request_usage.reset(token)
+
+
+def charge_usage(tokens: int) -> None:
+    meter = request_usage.get()
+    if meter is not None:
+        meter.tokens += tokens
+
+
+class UpstreamLimiter:
+    """Requests/min and tokens/min buckets plus an adaptive concurrency limit, shared by every upstream call."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float,
+                 concurrency: AdaptiveConcurrencyLimiter, bucket: Callable[[str, float], TokenBucket] = local_bucket):
+        self.requests = bucket("upstream:requests", requests_per_minute)
+        self.tokens = bucket("upstream:tokens", tokens_per_minute)
+        self.concurrency = concurrency
+        self.throttled = 0
+        self.overloads = 0
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int = 0) -> AsyncIterator[UpstreamUsage]:
+        """Hold an upstream slot; set `usage.tokens` inside the block to reconcile the token estimate."""
+        taken: list[tuple[TokenBucket, float]] = []
+        try:
+            waited = await self.requests.acquire(1)
+            taken.append((self.requests, 1))
+            if estimated_tokens:
+                waited += await self.tokens.acquire(estimated_tokens)
+                taken.append((self.tokens, estimated_tokens))
+            if waited:
+                self.throttled += 1
+            await self.concurrency.acquire()
+        except BaseException:
+            # Cancelled before the call was made (e.g. the client went away while queued): give back what was taken.
+            for bucket, amount in taken:
+                await call_backend(bucket, "adjust", -amount)
+            raise
+        usage = UpstreamUsage()
+        try:
+            yield usage
+        except BaseException as e:
+            overloaded = is_overload_error(e)
+            self.overloads += overloaded
+            await self.concurrency.release(overloaded=overloaded, succeeded=False)
+            raise
+        else:
+            await self.concurrency.release()
+        finally:
+            if usage.tokens is not None:
+                await call_backend(self.tokens, "adjust", usage.tokens - estimated_tokens)
+                charge_usage(usage.tokens)
+
+    def stats(self) -> dict:
+        return {
+            "concurrencyLimit": self.concurrency.limit,
+            "inFlight": self.concurrency.in_flight,
+            "throttled": self.throttled,
+            "overloads": self.overloads,
+        }
+
+
+class ClientTokenBudgets:
+    """Per-client tokens/minute buckets, so one caller cannot take the whole upstream token budget.
+
+    Requests reserve their estimated tokens up front and are refused (not queued)
+    when the client's bucket is short; the estimate is reconciled against actual
+    usage afterwards. Only the `max_clients` most recently seen clients are tracked.
+    """
+
+    def __init__(self, tokens_per_minute: float, max_clients: int = 10_000,
+                 bucket: Callable[[str, float], TokenBucket] = local_bucket):
+        self.tokens_per_minute = tokens_per_minute
+        self.max_clients = max_clients
+        self.bucket = bucket
+        self.rejected = 0
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def _bucket(self, client: str) -> TokenBucket:
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            bucket = self._buckets[client] = self.bucket(f"client:{client}", self.tokens_per_minute)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(client)
+        return bucket
+
+    async def reserve(self, client: str, tokens: int) -> float:
+        """Reserve `tokens` for `client`; returns 0 on success or the seconds to wait before retrying."""
+        retry_after = await call_backend(self._bucket(client), "try_acquire", tokens)
+        self.rejected += retry_after > 0
+        return retry_after
+
+    async def adjust(self, client: str, tokens: int) -> None:
+        """Charge (or refund, if negative) the difference between the reservation and actual usage."""
+        await call_backend(self._bucket(client), "adjust", tokens)
+
+    def stats(self) -> dict:
+        return {"clients": len(self._buckets), "rejected": self.rejected}
@@ -0,0 +1,129 @@
+import asyncio
+import random
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+import openai
+
+from ratelimit import is_overload_error
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    return is_overload_error(error) or isinstance(error, openai.APIConnectionError)
+
+
+class StagePolicy:
+    """Deadline, retry and hedging settings for one pipeline stage.
+
+    `deadline` bounds the whole stage including retries. Retries use exponential
+    backoff with full jitter. With `hedge` set, a second identical call is fired
+    once the first has been outstanding longer than the stage's observed p95.
+    """
+
+    def __init__(self, deadline: float = 60, max_attempts: int = 3, base_delay: float = 0.5,
+                 max_delay: float = 8, hedge: bool = False, hedge_delay: float = 10):
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+
+
+class LatencyWindow:
+    """Recent successful latencies for a stage, used to pick the hedge delay."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples: deque[float] = deque(maxlen=size)
+        self.min_samples = min_samples
+
+    def record(self, latency: float) -> None:
+        self.samples.append(latency)
+
+    def percentile(self, q: float) -> float | None:
+        if len(self.samples) < self.min_samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Resilience:
+    def __init__(self, policies: dict[str, StagePolicy], default: StagePolicy | None = None,
+                 retryable: Callable[[BaseException], bool] = is_retryable_error):
+        self.policies = policies
+        self.default = default or StagePolicy()
+        self.retryable = retryable
+        self.latencies: dict[str, LatencyWindow] = {}
+        self.retries: dict[str, int] = {}
+        self.hedges: dict[str, int] = {}
+        self.hedge_wins: dict[str, int] = {}
+        self.deadlines_exceeded: dict[str, int] = {}
+
+    async def call(self, stage: str, fn: Callable[[], Awaitable]) -> Any:
+        """Run `fn` for `stage` under its deadline, retrying retryable errors with jittered backoff."""
+        policy = self.policies.get(stage, self.default)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy.deadline
+        attempt = 1
+        while True:
+            try:
+                return await asyncio.wait_for(self._attempt(stage, policy, fn), deadline - loop.time())
+            except asyncio.TimeoutError:
+                if loop.time() >= deadline:
+                    self._count(self.deadlines_exceeded, stage)
+                    raise
+                error = asyncio.TimeoutError()
+                if attempt >= policy.max_attempts:
+                    raise
+            except Exception as e:
+                error = e
+                if attempt >= policy.max_attempts or not self.retryable(e):
+                    raise
+            delay = random.uniform(0, min(policy.max_delay, policy.base_delay * 2 ** (attempt - 1)))
+            if loop.time() + delay >= deadline:
+                raise error
+            self._count(self.retries, stage)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _attempt(self, stage: str, policy: StagePolicy, fn: Callable[[], Awaitable]) -> Any:
+        window = self.latencies.setdefault(stage, LatencyWindow())
+        start = asyncio.get_running_loop().time()
+        if not policy.hedge:
+            result = await fn()
+            window.record(asyncio.get_running_loop().time() - start)
+            return result
+
+        primary = asyncio.ensure_future(fn())
+        pending = {primary}
+        try:
+            done, _ = await asyncio.wait(pending, timeout=window.percentile(0.95) or policy.hedge_delay)
+            if not done:
+                self._count(self.hedges, stage)
+                pending.add(asyncio.ensure_future(fn()))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._count(self.hedge_wins, stage)
+                        window.record(asyncio.get_running_loop().time() - start)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @staticmethod
+    def _count(counter: dict[str, int], stage: str) -> None:
+        counter[stage] = counter.get(stage, 0) + 1
+
+    def stats(self) -> dict:
+        return {
+            "retries": dict(self.retries),
+            "hedges": dict(self.hedges),
+            "hedgeWins": dict(self.hedge_wins),
+            "deadlinesExceeded": dict(self.deadlines_exceeded),
+        }
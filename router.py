@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable
+
+import httpx
+import openai
+
+from tracing import trace_http_request
+
+
+def is_failover_error(error: BaseException) -> bool:
+    """Errors worth trying on another backend; a 4xx other than 401/403/408/429 means the request itself is bad."""
+    status_code = getattr(error, "status_code", None)
+    return status_code is None or status_code in (401, 403, 408, 429) or status_code >= 500
+
+
+class Backend:
+    """One OpenAI-compatible endpoint/model pair with its own connection pool and health statistics."""
+
+    def __init__(self, name: str, base_url: str, model: str, api_key: str = "", weight: float = 1.0,
+                 max_connections: int = 200, max_keepalive_connections: int = 50, timeout: float = 60):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.weight = weight
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.timeout = timeout
+        self.latency_ewma: float | None = None
+        self.error_ewma = 0.0
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.ejected_until = 0.0
+        self._client: openai.AsyncOpenAI | None = None
+        self._client_loop: asyncio.AbstractEventLoop | None = None  # None for a client set from outside
+
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        # Created on first use so importing the app never needs credentials or an event loop. Its connection
+        # pool belongs to the loop that created it, so a new loop (a restarted app, or each request of a
+        # TestClient used without `with`) gets a new client; the old one's loop is gone, so it is just dropped.
+        loop = asyncio.get_running_loop()
+        if self._client is not None and self._client_loop not in (None, loop):
+            self._client = None
+        if self._client is None:
+            self._client_loop = loop
+            self._client = openai.AsyncOpenAI(
+                api_key=self.api_key,
+                base_url=self.base_url,
+                max_retries=0,  # retries are handled per stage by `resilience`
+                http_client=httpx.AsyncClient(
+                    timeout=httpx.Timeout(self.timeout, connect=10),
+                    event_hooks={"request": [trace_http_request]},  # connect/TTFB/transfer spans when tracing
+                    limits=httpx.Limits(max_connections=self.max_connections,
+                                        max_keepalive_connections=self.max_keepalive_connections)))
+        return self._client
+
+    @client.setter
+    def client(self, client: openai.AsyncOpenAI) -> None:
+        self._client = client
+        self._client_loop = None
+
+    async def aclose(self) -> None:
+        if self._client is not None and self._client_loop in (None, asyncio.get_running_loop()):
+            await self._client.close()
+        self._client = None
+
+    def stats(self) -> dict:
+        return {"model": self.model, "latencyEwma": self.latency_ewma, "errorRate": self.error_ewma,
+                "inFlight": self.in_flight, "calls": self.calls, "errors": self.errors,
+                "ejected": self.ejected_until > time.monotonic()}
+
+
+class ModelRouter:
+    """Routes each role (story, summary, image) to one of several backends.
+
+    `least-latency` prefers the backend with the lowest EWMA latency scaled by its
+    in-flight load and error rate; `weighted` picks randomly by weight. A backend
+    whose error EWMA passes `eject_error_rate` is skipped for `eject_seconds`, and
+    a failed call fails over to the next candidate.
+    """
+
+    def __init__(self, roles: dict[str, list[Backend]], strategy: str = "least-latency", alpha: float = 0.2,
+                 eject_error_rate: float = 0.5, eject_seconds: float = 30):
+        if strategy not in ("least-latency", "weighted"):
+            raise ValueError(f"Unknown routing strategy {strategy!r}")
+        self.roles = roles
+        self.strategy = strategy
+        self.alpha = alpha
+        self.eject_error_rate = eject_error_rate
+        self.eject_seconds = eject_seconds
+        self.failovers = 0
+
+    def backends(self) -> list[Backend]:
+        unique = {}
+        for backends in self.roles.values():
+            for backend in backends:
+                unique[id(backend)] = backend
+        return list(unique.values())
+
+    def models(self, role: str) -> list[str]:
+        return sorted(backend.model for backend in self.roles[role])
+
+    def candidates(self, role: str) -> list[Backend]:
+        now = time.monotonic()
+        backends = self.roles[role]
+        healthy = [b for b in backends if b.ejected_until <= now]
+        ejected = [b for b in backends if b.ejected_until > now]
+        if self.strategy == "weighted":
+            ordered = []
+            pool = list(healthy)
+            while pool:
+                pick = random.choices(pool, weights=[b.weight for b in pool])[0]
+                ordered.append(pick)
+                pool.remove(pick)
+        else:
+            # Backends with no samples yet score 0 so they get explored first.
+            ordered = sorted(healthy, key=lambda b: (b.latency_ewma or 0) * (1 + b.in_flight)
+                             * (1 + 4 * b.error_ewma) / b.weight)
+        return ordered + ejected  # ejected backends are a last resort rather than a hard failure
+
+    async def call(self, role: str, fn: Callable[[Backend], Awaitable]) -> Any:
+        """Run fn(backend) on the preferred backend for `role`, failing over on upstream errors."""
+        last_error = None
+        for attempt, backend in enumerate(self.candidates(role)):
+            if attempt:
+                self.failovers += 1
+                logging.warning("Failing over %s call to backend %s after: %s", role, backend.name, last_error)
+            backend.in_flight += 1
+            backend.calls += 1
+            start = time.perf_counter()
+            try:
+                result = await fn(backend)
+            except Exception as e:
+                self._record(backend, None)
+                if not is_failover_error(e):
+                    raise
+                last_error = e
+                continue
+            finally:
+                backend.in_flight -= 1
+            self._record(backend, time.perf_counter() - start)
+            return result
+        raise last_error
+
+    def _record(self, backend: Backend, latency: float | None) -> None:
+        failed = latency is None
+        backend.errors += failed
+        backend.error_ewma += self.alpha * (failed - backend.error_ewma)
+        if failed:
+            if backend.error_ewma >= self.eject_error_rate:
+                backend.ejected_until = time.monotonic() + self.eject_seconds
+                backend.error_ewma = self.eject_error_rate / 2  # re-enter on probation
+        else:
+            backend.latency_ewma = latency if backend.latency_ewma is None else \
+                backend.latency_ewma + self.alpha * (latency - backend.latency_ewma)
+
+    async def aclose(self) -> None:
+        for backend in self.backends():
+            await backend.aclose()
+
+    def stats(self) -> dict:
+        return {"failovers": self.failovers,
+                "roles": {role: {b.name: b.stats() for b in backends} for role, backends in self.roles.items()}}
+
+
+def load_router(path: str, default_roles: dict[str, list[Backend]]) -> ModelRouter:
+    """Build a router from a JSON file, falling back to `default_roles` for roles it omits.
+
+    {"strategy": "least-latency",
+     "roles": {"story": [{"name": "deepinfra", "baseUrl": "...", "model": "...",
+                          "apiKeyEnv": "DEEPINFRA_API_KEY", "weight": 2}]}}
+    """
+    with open(path) as f:
+        config = json.load(f)
+    roles = dict(default_roles)
+    for role, entries in config.get("roles", {}).items():
+        roles[role] = [
+            Backend(entry["name"], entry["baseUrl"], entry["model"],
+                    api_key=os.environ.get(entry["apiKeyEnv"], "") if "apiKeyEnv" in entry else entry.get("apiKey", ""),
+                    weight=entry.get("weight", 1.0),
+                    max_connections=entry.get("maxConnections", 200),
+                    max_keepalive_connections=entry.get("maxKeepaliveConnections", 50),
+                    timeout=entry.get("timeout", 60))
+            for entry in entries
+        ]
+    return ModelRouter(roles, strategy=config.get("strategy", "least-latency"))
@@ -1,68 +1,92 @@
-from pydantic import BaseModel, field_validator, model_validator, ValidationError
-from validators import sanitize_string
+from typing import Annotated, Literal
+
+from pydantic import AfterValidator, BaseModel, Field, PlainSerializer, StringConstraints, model_validator, ValidationError
+from prompts import prompt_registry
+from validators import sanitize_string, scale_temperature
+
+# Constraints are declared on the types so pydantic-core checks them in its compiled validator,
+# without calling back into Python per field.
+Text = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+# Markup in text the API hands back is escaped once, when the response is serialized to JSON;
+# the raw text is what is prompted with, cached and stored.
+OutputText = Annotated[str | None, PlainSerializer(sanitize_string, when_used="json")]
+StoryPromptVersion = Literal[tuple(prompt_registry.versions("story"))]  # versions are registered at import
+DevelopPromptVersion = Literal[tuple(prompt_registry.versions("develop"))]
 
 class StoryRequest(BaseModel):
-    plot: str
+    plot: Text
     imageNeeded: bool
-    genre: str
-    experimentBoundary: float = 0
-    totalStoryCharacters: int = 1
-    totalParagraphs: int = 1
-    totalWords: int = 100
-
-    @field_validator('plot', 'genre')
-    @classmethod
-    def sanitize_strings(cls, v):
-        return sanitize_string(v)
-
-    @field_validator('imageNeeded')
-    @classmethod
-    def validate_image_needed(cls, v):
-        if not isinstance(v, bool):
-            raise ValueError("Bad input: imageNeeded must be a boolean.")
-        return v
-
-    @field_validator('totalStoryCharacters')
-    @classmethod
-    def validate_total_story_characters(cls, v):
-        if not (1 <= v <= 10):
-            raise ValueError('totalStoryCharacters must be between 1 and 10')
-        return v
-
-    @field_validator('totalParagraphs')
-    @classmethod
-    def validate_total_paragraphs(cls, v):
-        if not (1 <= v <= 5):
-            raise ValueError('totalParagraphs must be between 1 and 5')
-        return v
-
-    @field_validator('totalWords')
-    @classmethod
-    def validate_total_words(cls, v):
-        if not (100 <= v <= 400):
-            raise ValueError('totalWords must be between 100 and 400')
-        return v
+    genre: Text
+    experimentBoundary: Annotated[float, AfterValidator(scale_temperature)] = 0
+    totalStoryCharacters: Annotated[int, Field(ge=1, le=10)] = 1
+    totalParagraphs: Annotated[int, Field(ge=1, le=5)] = 1
+    totalWords: Annotated[int, Field(ge=100, le=400)] = 100
+    bypassCache: bool = False
+    summaryMode: Literal["llm", "combined", "extractive"] = "llm"
+    promptVersion: StoryPromptVersion | None = None
+    imageSize: Literal["256x256", "512x512", "1024x1024", "1792x1024", "1024x1792"] = "1024x1024"
+
+
+class DevelopStoryRequest(StoryRequest):
+    promptVersion: DevelopPromptVersion | None = None
+    summary: str | None = None
+    storyId: str | None = None
 
     @model_validator(mode="after")
-    def adjust_experiment_boundary(self):
-        if self.experimentBoundary > 0:
-            object.__setattr__(self, "experimentBoundary", self.experimentBoundary / 10)
+    def require_summary_or_story_id(self):
+        if not self.summary and not self.storyId:
+            raise ValueError("Either summary or storyId is required")
         return self
-    
 
-class DevelopStoryRequest(StoryRequest):
-    summary: str
+
+BATCH_MAX_ITEMS = 100
+BATCH_MAX_CONCURRENCY = 32
+
+
+class BatchStoryRequest(BaseModel):
+    items: Annotated[list[StoryRequest], Field(min_length=1, max_length=BATCH_MAX_ITEMS)]
+    concurrency: Annotated[int, Field(ge=1, le=BATCH_MAX_CONCURRENCY)] | None = None
 
 
 class ModelStatistics(BaseModel):
     tokensUsedCount: int | None = None
+    promptTokensCount: int | None = None
+    completionTokensCount: int | None = None
     timeTakenToProcessPrompt: float | None = None
+    timeTakenToGenerateStory: float | None = None
+    timeTakenToGenerateSummary: float | None = None
+    timeToFirstToken: float | None = None
+    tokensPerSecond: float | None = None
+    summaryMode: str | None = None
+    promptVersion: str | None = None
 
 
 class StoryResponse(BaseModel):
-    story: str | None = None
-    storySummary: str | None = None
+    storyId: str | None = None
+    story: OutputText = None
+    storySummary: OutputText = None
     image: str | None = None
-    error: str | None = None
+    error: OutputText = None
     modelStatistics: ModelStatistics | None = None
 
+
+class BatchStoryResponse(BaseModel):
+    results: list[StoryResponse]
+
+
+class JobResponse(BaseModel):
+    id: str
+    kind: str
+    status: Literal["queued", "running", "succeeded", "failed"]
+    result: StoryResponse | None = None
+    createdAt: float | None = None
+    startedAt: float | None = None
+    finishedAt: float | None = None
+
+
+class StoredStoryResponse(BaseModel):
+    id: str
+    parentId: str | None = None
+    chainSummary: OutputText = None
+    result: StoryResponse
+    createdAt: float | None = None
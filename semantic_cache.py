@@ -0,0 +1,315 @@
+"""Near-duplicate caching: serve an earlier generation for a request that says the same thing in other words.
+
+Texts are embedded locally with feature hashing (word unigrams and bigrams plus
+character trigrams), so there is no model to download and an embedding costs
+microseconds. Neighbours are found in an in-memory index: brute force (with
+NumPy when it is installed) or random-hyperplane LSH for large stores.
+"""
+import functools
+import inspect
+import math
+import random
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Collection
+
+try:
+    import numpy
+except ImportError:  # optional dependency, speeds up brute-force search
+    numpy = None
+
+from cache import make_cache_key
+
+WORD = re.compile(r"[a-z0-9']+")
+# Words that do not change what a plot is about. Negations ("not", "never", "without") are deliberately absent.
+STOP_WORDS = frozenset("a an the and or of to in on at by for with from into onto as is are was were be been "
+                       "this that these those it its their his her".split())
+
+
+def normalize_text(text: str) -> list[str]:
+    """Lowercased words with punctuation dropped, so "A hero saves the world." == "a hero saves the world!"."""
+    return WORD.findall(text.lower())
+
+
+def content_words(text: str) -> tuple[str, ...]:
+    """The words that carry meaning, in order, with a plural/third-person "s" dropped ("saves" == "save")."""
+    return tuple(word[:-1] if len(word) > 3 and word.endswith("s") and not word.endswith("ss") else word
+                 for word in normalize_text(text) if word not in STOP_WORDS)
+
+
+def word_bigrams(words: tuple[str, ...]) -> frozenset[tuple[str, str]]:
+    """Adjacent word pairs, which tell "the king kills the queen" from "the queen kills the king"."""
+    return frozenset(zip(words, words[1:]))
+
+
+def word_overlap(a: Collection, b: Collection) -> float:
+    """Jaccard similarity of two collections, taken as sets."""
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+class HashingEmbedder:
+    """Maps text to an L2-normalized sparse vector {dimension: weight} by hashing its features."""
+
+    def __init__(self, dimensions: int = 512, char_weight: float = 0.5):
+        self.dimensions = dimensions
+        self.char_weight = char_weight
+
+    def features(self, words: list[str]) -> list[tuple[str, float]]:
+        features = [(word, 1.0) for word in words]
+        features += [(f"{first} {second}", 1.0) for first, second in zip(words, words[1:])]
+        for word in words:  # character trigrams keep typos and inflections close
+            padded = f"<{word}>"
+            features += [(padded[i:i + 3], self.char_weight) for i in range(len(padded) - 2)]
+        return features
+
+    def embed(self, text: str) -> dict[int, float]:
+        vector: dict[int, float] = {}
+        for feature, weight in self.features(normalize_text(text)):
+            digest = zlib.crc32(feature.encode("utf-8"))
+            index = digest % self.dimensions
+            vector[index] = vector.get(index, 0.0) + (weight if digest & 0x80000000 else -weight)
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        return {index: value / norm for index, value in vector.items() if value} if norm else {}
+
+
+def dot(a: dict[int, float], b: dict[int, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(index, 0.0) for index, value in a.items())
+
+
+class BruteForceIndex:
+    """Exact cosine search over every vector; a NumPy matrix product when NumPy is available."""
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+        self._vectors: dict[Any, dict[int, float]] = {}
+        self._slots: dict[Any, int] = {}
+        self._free: list[int] = []
+        self._ids: list[Any] = []
+        self._matrix = numpy.zeros((0, dimensions), dtype=numpy.float32) if numpy is not None else None
+
+    def add(self, entry_id: Any, vector: dict[int, float]) -> None:
+        self.remove(entry_id)
+        self._vectors[entry_id] = vector
+        if self._matrix is None:
+            return
+        if not self._free:
+            grown = max(16, 2 * len(self._matrix))
+            self._free = list(range(grown - 1, len(self._matrix) - 1, -1))
+            self._matrix = numpy.vstack([self._matrix, numpy.zeros((grown - len(self._matrix), self.dimensions),
+                                                                   dtype=numpy.float32)])
+            self._ids += [None] * (grown - len(self._ids))
+        slot = self._free.pop()
+        self._matrix[slot] = 0
+        self._matrix[slot, list(vector)] = list(vector.values())
+        self._slots[entry_id], self._ids[slot] = slot, entry_id
+
+    def remove(self, entry_id: Any) -> None:
+        if self._vectors.pop(entry_id, None) is None or self._matrix is None:
+            return
+        slot = self._slots.pop(entry_id)
+        self._matrix[slot] = 0
+        self._ids[slot] = None
+        self._free.append(slot)
+
+    def search(self, vector: dict[int, float], k: int) -> list[tuple[float, Any]]:
+        if not self._vectors:
+            return []
+        if self._matrix is None:
+            return sorted(((dot(vector, other), entry_id) for entry_id, other in self._vectors.items()),
+                          key=lambda pair: pair[0], reverse=True)[:k]
+        query = numpy.zeros(self.dimensions, dtype=numpy.float32)
+        query[list(vector)] = list(vector.values())
+        similarities = self._matrix @ query
+        top = numpy.argsort(-similarities)[:k + len(self._free)]  # free slots score 0 and are skipped below
+        return [(float(similarities[slot]), self._ids[slot]) for slot in top if self._ids[slot] is not None][:k]
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+
+class LshIndex:
+    """Approximate search: random-hyperplane signatures bucket similar vectors, and only bucket-mates are scored.
+
+    More `tables` find more true neighbours; more `bits` per table make buckets
+    smaller (faster, but near neighbours are split more often).
+    """
+
+    def __init__(self, dimensions: int, tables: int = 8, bits: int = 12, seed: int = 0):
+        rng = random.Random(seed)
+        self.dimensions = dimensions
+        self._planes = [[[rng.gauss(0, 1) for _ in range(dimensions)] for _ in range(bits)] for _ in range(tables)]
+        self._buckets: list[dict[int, set]] = [{} for _ in range(tables)]
+        self._vectors: dict[Any, tuple[dict[int, float], list[int]]] = {}
+
+    def signatures(self, vector: dict[int, float]) -> list[int]:
+        signatures = []
+        for planes in self._planes:
+            signature = 0
+            for plane in planes:
+                signature = (signature << 1) | (sum(value * plane[index] for index, value in vector.items()) > 0)
+            signatures.append(signature)
+        return signatures
+
+    def add(self, entry_id: Any, vector: dict[int, float]) -> None:
+        self.remove(entry_id)
+        signatures = self.signatures(vector)
+        self._vectors[entry_id] = (vector, signatures)
+        for buckets, signature in zip(self._buckets, signatures):
+            buckets.setdefault(signature, set()).add(entry_id)
+
+    def remove(self, entry_id: Any) -> None:
+        entry = self._vectors.pop(entry_id, None)
+        if entry is None:
+            return
+        for buckets, signature in zip(self._buckets, entry[1]):
+            bucket = buckets[signature]
+            bucket.discard(entry_id)
+            if not bucket:
+                del buckets[signature]
+
+    def search(self, vector: dict[int, float], k: int) -> list[tuple[float, Any]]:
+        candidates = set()
+        for buckets, signature in zip(self._buckets, self.signatures(vector)):
+            candidates |= buckets.get(signature, set())
+        return sorted(((dot(vector, self._vectors[entry_id][0]), entry_id) for entry_id in candidates),
+                      key=lambda pair: pair[0], reverse=True)[:k]
+
+    def __len__(self) -> int:
+        return len(self._vectors)
+
+
+class SemanticCache:
+    """Serves a cached result when a call's text is similar enough and its numeric parameters are close enough.
+
+    `text_fields` are joined and embedded; each of `tolerances` is a numeric
+    argument with the relative difference allowed (0 means it must match). Every
+    other argument (categorical ones such as a genre), plus key_extra(), must
+    match exactly: entries are kept in one index per such combination.
+
+    Embedding similarity alone cannot tell "befriends a dragon" from "kills a
+    dragon", or who does what to whom, so a match must also share at least
+    `min_word_overlap` of its content words and of their adjacent pairs (the
+    default 1.0 allows only differences in case, punctuation, articles and
+    plurals). Entries expire after ttl_seconds, and
+    the least recently used go once there are more than max_entries.
+    """
+
+    def __init__(self, embedder: HashingEmbedder | None = None, index_factory: Callable[[int], Any] = BruteForceIndex,
+                 threshold: float = 0.95, tolerances: dict[str, float] | None = None,
+                 text_fields: tuple[str, ...] = ("plot",), min_word_overlap: float = 1.0, max_entries: int = 10_000,
+                 ttl_seconds: float = 3600, enabled: bool = True, cache_nonzero_temperature: bool = False,
+                 candidates: int = 8, on_lookup: Callable[[str, float], None] | None = None):
+        self.embedder = embedder or HashingEmbedder()
+        self.index_factory = index_factory
+        self.threshold = threshold
+        self.tolerances = tolerances or {}
+        self.text_fields = text_fields
+        self.min_word_overlap = min_word_overlap
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.cache_nonzero_temperature = cache_nonzero_temperature
+        self.candidates = candidates
+        self.on_lookup = on_lookup  # told (kind, seconds) after each lookup
+        self._indexes: dict[str, Any] = {}
+        # entry id -> (partition, expires_at, numeric params, content words, value)
+        self._entries: OrderedDict[int, tuple[str, float, dict, tuple[str, ...], Any]] = OrderedDict()
+        self._next_id = 0
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+
+    def _split(self, kind: str, params: dict, extra: dict) -> tuple[str, str, dict]:
+        text = "\n".join(str(params[field]) for field in self.text_fields)
+        numeric = {name: params[name] for name in self.tolerances}
+        exact = {name: value for name, value in params.items() if name not in numeric and name not in self.text_fields}
+        return make_cache_key(kind, {**exact, **extra}), text, numeric
+
+    def _close(self, wanted: dict, cached: dict) -> bool:
+        return all(abs(wanted[name] - cached[name]) <= tolerance * max(abs(wanted[name]), 1e-9)
+                   for name, tolerance in self.tolerances.items())
+
+    def _same_words(self, wanted: tuple[str, ...], cached: tuple[str, ...]) -> bool:
+        return (word_overlap(wanted, cached) >= self.min_word_overlap
+                and word_overlap(word_bigrams(wanted), word_bigrams(cached)) >= self.min_word_overlap)
+
+    def lookup(self, partition: str, vector: dict[int, float], numeric: dict,
+               words: tuple[str, ...]) -> tuple[Any, float] | None:
+        """(value, similarity) of the most similar live entry that matches, or None."""
+        index = self._indexes.get(partition)
+        if index is None or not vector:
+            return None
+        now = time.monotonic()
+        for similarity, entry_id in index.search(vector, self.candidates):
+            if similarity < self.threshold:
+                break
+            _, expires_at, cached_numeric, cached_words, value = self._entries[entry_id]
+            if expires_at < now:
+                self._evict(entry_id)
+                continue
+            if self._close(numeric, cached_numeric) and self._same_words(words, cached_words):
+                self._entries.move_to_end(entry_id)
+                return value, similarity
+        return None
+
+    def add(self, partition: str, vector: dict[int, float], numeric: dict, words: tuple[str, ...], value: Any) -> None:
+        if not vector:
+            return
+        entry_id, self._next_id = self._next_id, self._next_id + 1
+        index = self._indexes.get(partition)
+        if index is None:
+            index = self._indexes[partition] = self.index_factory(self.embedder.dimensions)
+        index.add(entry_id, vector)
+        self._entries[entry_id] = (partition, time.monotonic() + self.ttl_seconds, numeric, words, value)
+        while len(self._entries) > self.max_entries:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, entry_id: int) -> None:
+        partition = self._entries.pop(entry_id)[0]
+        index = self._indexes[partition]
+        index.remove(entry_id)
+        if not len(index):
+            del self._indexes[partition]
+
+    def stats(self) -> dict:
+        return {"hits": dict(self.hits), "misses": dict(self.misses), "entries": len(self._entries)}
+
+    def cached(self, kind: str, key_extra: Callable[[], dict] = dict):
+        """Serve near-duplicate calls of an async function from earlier results.
+
+        Stack it on top of ResponseCache.cached: ``bypass_cache`` is passed down,
+        so the wrapped function must accept it. Calls with a non-zero
+        ``temperature`` skip this cache unless cache_nonzero_temperature is set.
+        """
+        def decorator(fn):
+            signature = inspect.signature(fn)
+
+            @functools.wraps(fn)
+            async def wrapper(*args, bypass_cache: bool = False, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                params = dict(bound.arguments)
+                if bypass_cache or not self.enabled or (params.get("temperature") and not self.cache_nonzero_temperature):
+                    return await fn(*args, bypass_cache=bypass_cache, **kwargs)
+                start = time.perf_counter()
+                partition, text, numeric = self._split(kind, params, key_extra())
+                vector, words = self.embedder.embed(text), content_words(text)
+                found = self.lookup(partition, vector, numeric, words)
+                if self.on_lookup is not None:
+                    self.on_lookup(kind, time.perf_counter() - start)
+                if found is not None:
+                    self.hits[kind] = self.hits.get(kind, 0) + 1
+                    return found[0]
+                self.misses[kind] = self.misses.get(kind, 0) + 1
+                value = await fn(*args, **kwargs)
+                if value is not None:
+                    self.add(partition, vector, numeric, words, value)
+                return value
+
+            return wrapper
+
+        return decorator
@@ -0,0 +1,140 @@
+import asyncio
+import functools
+import inspect
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable
+
+from cache import make_cache_key
+
+
+class SingleFlight:
+    """Collapse identical in-flight calls so followers await the leader's result.
+
+    The upstream call runs in its own task, so a leader whose client goes away
+    does not cancel the work the followers are waiting on.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Task] = {}
+        self.leaders: dict[str, int] = {}
+        self.coalesced: dict[str, int] = {}
+
+    async def do(self, kind: str, key: str, fn: Callable[[], Awaitable]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(functools.partial(self._finish, key))
+            self.leaders[kind] = self.leaders.get(kind, 0) + 1
+        else:
+            self.coalesced[kind] = self.coalesced.get(kind, 0) + 1
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()  # mark as retrieved when every waiter has gone away
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> dict:
+        return {"leaders": dict(self.leaders), "coalesced": dict(self.coalesced), "inFlight": self.in_flight()}
+
+    def coalesce(self, kind: str, key_extra: Callable[[], dict] = dict):
+        """Share one upstream call between concurrent callers with identical bound arguments."""
+        def decorator(fn):
+            signature = inspect.signature(fn)
+
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                key = make_cache_key(kind, {**bound.arguments, **key_extra()})
+                return await self.do(kind, key, lambda: fn(*args, **kwargs))
+
+            return wrapper
+
+        return decorator
+
+
+class SqliteSingleFlight(SingleFlight):
+    """SingleFlight that also coalesces identical calls made by other worker processes.
+
+    Calls are first collapsed in-process; the in-process leader then claims the
+    key in a shared SQLite file. If another process already holds it, this one
+    polls for that flight's result instead of calling upstream (and takes over if
+    the flight ends without one). Claims expire after `lease_seconds` so a crashed
+    leader does not block the key. Results must be JSON-serializable; tuples come
+    back as lists.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 150, poll_interval: float = 0.05):
+        super().__init__()
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS flights (key TEXT PRIMARY KEY, flight TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS flight_results (flight TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    async def do(self, kind: str, key: str, fn: Callable[[], Awaitable]) -> Any:
+        return await super().do(kind, key, lambda: self._across_processes(kind, key, fn))
+
+    async def _across_processes(self, kind: str, key: str, fn: Callable[[], Awaitable]) -> Any:
+        flight = None
+        while True:
+            state, value = await asyncio.to_thread(self._claim, key, flight)
+            if state == "done":
+                self.coalesced[kind] = self.coalesced.get(kind, 0) + 1
+                return value
+            flight = value
+            if state == "leader":
+                break
+            await asyncio.sleep(self.poll_interval)
+        try:
+            result = await fn()
+        except BaseException:
+            await asyncio.to_thread(self._release, key, flight, None)
+            raise
+        await asyncio.to_thread(self._release, key, flight, result)
+        return result
+
+    def _claim(self, key: str, flight: str | None) -> tuple[str, Any]:
+        """("done", result) once the flight we waited on has published, else ("wait" or "leader", flight id)."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                if flight is not None:
+                    row = self._conn.execute("SELECT value FROM flight_results WHERE flight = ?", (flight,)).fetchone()
+                    if row is not None:
+                        self._conn.execute("COMMIT")
+                        return "done", json.loads(row[0])
+                row = self._conn.execute("SELECT flight FROM flights WHERE key = ? AND expires_at >= ?", (key, now)).fetchone()
+                if row is not None:
+                    self._conn.execute("COMMIT")
+                    return "wait", row[0]
+                flight = uuid.uuid4().hex
+                self._conn.execute("INSERT OR REPLACE INTO flights (key, flight, expires_at) VALUES (?, ?, ?)",
+                                   (key, flight, now + self.lease_seconds))
+                self._conn.execute("DELETE FROM flight_results WHERE expires_at < ?", (now,))
+                self._conn.execute("COMMIT")
+                return "leader", flight
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _release(self, key: str, flight: str, result: Any) -> None:
+        with self._lock:
+            if result is not None:
+                # kept for one lease so every waiter gets a chance to read it
+                self._conn.execute("INSERT OR REPLACE INTO flight_results (flight, value, expires_at) VALUES (?, ?, ?)",
+                                   (flight, json.dumps(result), time.time() + self.lease_seconds))
+            self._conn.execute("DELETE FROM flights WHERE key = ? AND flight = ?", (key, flight))
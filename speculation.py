@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+from ratelimit import TokenBucket
+
+
+class Speculator:
+    """Starts calls a request is likely to be followed by, so the follow-up can take the result instead of waiting.
+
+    A speculation only starts while `idle()` says upstream has spare capacity,
+    fewer than `max_in_flight` are running and the `budget` bucket covers its
+    estimated tokens. Results are kept for `ttl_seconds` (at most `max_entries`);
+    a speculation that expires unused counts its tokens (via `usage(result)`) as wasted.
+    """
+
+    def __init__(self, budget: TokenBucket, idle: Callable[[], bool] = lambda: True,
+                 usage: Callable[[Any], int] = lambda result: 0, max_in_flight: int = 4,
+                 ttl_seconds: float = 600, max_entries: int = 1000):
+        self.budget = budget
+        self.idle = idle
+        self.usage = usage
+        self.max_in_flight = max_in_flight
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, asyncio.Task]] = OrderedDict()
+        self.launched = 0
+        self.skipped: dict[str, int] = {}
+        self.hits = 0  # served from a finished speculation
+        self.joined = 0  # waited on one still running
+        self.misses = 0
+        self.wasted_tokens = 0
+
+    def in_flight(self) -> int:
+        return sum(not task.done() for _, task in self._entries.values())
+
+    def speculate(self, key: str, estimated_tokens: int, fn: Callable[[], Awaitable]) -> bool:
+        """Start fn() in the background under `key` if capacity and budget allow; returns whether it started."""
+        self._expire()
+        if key in self._entries:
+            return False
+        if self.in_flight() >= self.max_in_flight or not self.idle():
+            return self._skip("busy")
+        if self.budget.try_acquire(estimated_tokens):
+            return self._skip("budget")
+        task = asyncio.create_task(fn())
+        task.add_done_callback(lambda task: self._settle(task, estimated_tokens))
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, task)
+        self.launched += 1
+        return True
+
+    def take(self, key: str) -> asyncio.Future | None:
+        """The speculation for `key`, finished or still running, or None if there is none to use."""
+        self._expire()
+        entry = self._entries.pop(key, None)
+        task = entry[1] if entry else None
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+            self.misses += 1
+            return None
+        if task.done():
+            self.hits += 1
+        else:
+            self.joined += 1
+        return asyncio.shield(task)
+
+    def _skip(self, reason: str) -> bool:
+        self.skipped[reason] = self.skipped.get(reason, 0) + 1
+        return False
+
+    def _settle(self, task: asyncio.Task, estimated_tokens: int) -> None:
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logging.warning("Speculative call failed: %r", task.exception())
+            self.budget.adjust(-estimated_tokens)
+            return
+        self.budget.adjust(self.usage(task.result()) - estimated_tokens)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while self._entries:
+            key, (expires_at, task) = next(iter(self._entries.items()))
+            if expires_at >= now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+            self._discard(task)
+
+    def _discard(self, task: asyncio.Task) -> None:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled() and task.exception() is None:
+            self.wasted_tokens += self.usage(task.result())
+
+    async def aclose(self) -> None:
+        tasks = [task for _, task in self._entries.values()]
+        self._entries.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {"launched": self.launched, "hits": self.hits, "joined": self.joined, "misses": self.misses,
+                "wastedTokens": self.wasted_tokens, "inFlight": self.in_flight(), "entries": len(self._entries)}
@@ -0,0 +1,120 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from prompts import trim_to_tokens
+from ratelimit import call_backend
+from summarizer import extractive_summary
+from tokens import count_tokens
+
+
+class StoryNotFound(LookupError):
+    pass
+
+
+def roll_summary(previous: str | None, latest: str | None, max_tokens: int) -> str | None:
+    """Append the latest part's summary to a chain's summary, condensing the earlier parts locally once it is too long.
+
+    The newest summary is kept verbatim; older parts are reduced extractively and,
+    as a last resort, trimmed from the start, so the chain summary stays within
+    max_tokens however long the chain grows.
+    """
+    if not previous or not latest:
+        return latest or previous
+    combined = f"{previous} {latest}"
+    if count_tokens(combined) <= max_tokens:
+        return combined
+    budget = max_tokens - count_tokens(latest)
+    if budget <= 0:
+        return trim_to_tokens(latest, max_tokens)
+    for sentences in (4, 3, 2, 1):
+        condensed = extractive_summary(previous, max_sentences=sentences)
+        if count_tokens(condensed) <= budget:
+            return f"{condensed} {latest}"
+    return f"{trim_to_tokens(previous, budget)} {latest}"
+
+
+class MemoryStoryStore:
+    """Keeps the most recent max_entries stories in process."""
+    blocking = False
+
+    def __init__(self, max_entries: int = 10_000):
+        self.max_entries = max_entries
+        self._stories: OrderedDict[str, dict] = OrderedDict()
+
+    def save(self, story: dict) -> None:
+        self._stories[story["id"]] = dict(story)
+        while len(self._stories) > self.max_entries:
+            self._stories.popitem(last=False)
+
+    def get(self, story_id: str) -> dict | None:
+        story = self._stories.get(story_id)
+        return dict(story) if story else None
+
+
+class SqliteStoryStore:
+    """File-backed story table, so story chains survive restarts."""
+    blocking = True
+
+    COLUMNS = ("id", "parentId", "chainSummary", "result", "createdAt")
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stories (id TEXT PRIMARY KEY, parentId TEXT, chainSummary TEXT, "
+            "result TEXT NOT NULL, createdAt REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def save(self, story: dict) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stories (id, parentId, chainSummary, result, createdAt) VALUES (?, ?, ?, ?, ?)",
+                (story["id"], story["parentId"], story["chainSummary"], json.dumps(story["result"]), story["createdAt"]),
+            )
+            self._conn.commit()
+
+    def get(self, story_id: str) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM stories WHERE id = ?", (story_id,)).fetchone()
+        if row is None:
+            return None
+        story = dict(zip(self.COLUMNS, row))
+        story["result"] = json.loads(story["result"])
+        return story
+
+
+class StoryChains:
+    """Persists generated stories and links develop-story results to the story they continue.
+
+    `backend` is any object with save(story) and get(story_id), such as
+    MemoryStoryStore or SqliteStoryStore; a `blocking` backend is called from
+    a worker thread.
+    """
+
+    def __init__(self, backend, chain_summary_max_tokens: int = 600):
+        self.backend = backend
+        self.chain_summary_max_tokens = chain_summary_max_tokens
+
+    async def get(self, story_id: str) -> dict | None:
+        return await call_backend(self.backend, "get", story_id)
+
+    async def require(self, story_id: str) -> dict:
+        story = await call_backend(self.backend, "get", story_id)
+        if story is None:
+            raise StoryNotFound(f"Story {story_id} not found")
+        return story
+
+    async def save(self, result: dict, previous_summary: str | None = None, parent_id: str | None = None) -> dict:
+        """Store a finished response; `previous_summary` is the summary of the story so far that it continues."""
+        story_id = uuid.uuid4().hex
+        story = {"id": story_id, "parentId": parent_id,
+                 "chainSummary": roll_summary(previous_summary, result.get("storySummary"), self.chain_summary_max_tokens),
+                 "result": {**result, "storyId": story_id}, "createdAt": time.time()}
+        await call_backend(self.backend, "save", story)
+        return story
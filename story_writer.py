@@ -1,135 +1,832 @@
-import openai
+import asyncio
+import base64
+import json
 import logging
+import os
 import time
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable
+
 import httpx
 
+import metrics
+import tokens
+from cache import MemoryCache, ResponseCache, SqliteCache, make_cache_key
+from images import BlobStore, ImageStore
+from resilience import Resilience, StagePolicy
+from router import Backend, ModelRouter, load_router
+from ratelimit import AdaptiveConcurrencyLimiter, SqliteBuckets, UpstreamLimiter, charge_usage, local_bucket, metering
+from prompts import PromptTemplate, PromptTooLarge, estimate_tokens, prompt_registry, trim_to_tokens
+from singleflight import SingleFlight, SqliteSingleFlight
+from speculation import Speculator
+from stories import MemoryStoryStore, SqliteStoryStore, StoryChains
+from summarizer import extractive_summary
+from tracing import JsonLinesExporter, Tracer
+from semantic_cache import BruteForceIndex, LshIndex, SemanticCache
 from schemas import DevelopStoryRequest, StoryRequest, StoryResponse, ModelStatistics
+from validators import sanitize_string
 
 API_KEY = ""#Enter API KEy here
 MODEL_NAME = "meta-llama/Llama-3.2-3B-Instruct"
+IMAGE_MODEL_NAME = "dall-e-3"
 BASE_URL = "https://api.deepinfra.com/v1/openai"
 
-openai_client = openai.OpenAI(api_key=API_KEY, 
-                              base_url=BASE_URL, 
-                              http_client=httpx.Client(timeout=60))
+MAX_CONNECTIONS = 200
+MAX_KEEPALIVE_CONNECTIONS = 50
+
+MODEL_BACKENDS_PATH = None  # JSON file adding backends per role, see router.load_router
+ROUTING_STRATEGY = "least-latency"
+
+# Which router role serves each pipeline stage.
+STAGE_ROLES = {"story": "story", "develop": "story", "summary": "summary", "image": "image"}
+
+
+def default_backends() -> dict[str, list[Backend]]:
+    text_backend = Backend("deepinfra", BASE_URL, MODEL_NAME, API_KEY,
+                           max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+    image_backend = Backend("deepinfra-image", BASE_URL, IMAGE_MODEL_NAME, API_KEY,
+                            max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS)
+    return {"story": [text_backend], "summary": [text_backend], "image": [image_backend]}
+
+
+model_router = (load_router(MODEL_BACKENDS_PATH, default_backends()) if MODEL_BACKENDS_PATH
+                else ModelRouter(default_backends(), strategy=ROUTING_STRATEGY))
+
+# Set SHARED_STATE_DIR (here or in the environment) when running several worker processes: the response cache,
+# rate limits, single-flight, stories and jobs are then shared through SQLite files in it. A relative path is
+# taken relative to this file, not the working directory.
+SHARED_STATE_DIR = os.environ.get("SHARED_STATE_DIR") or None
+# Worker processes on this host; only used to split the upstream concurrency limit between them.
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+if SHARED_STATE_DIR:
+    SHARED_STATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), SHARED_STATE_DIR)
+    os.makedirs(SHARED_STATE_DIR, exist_ok=True)
+elif WORKERS > 1:
+    logging.warning("WEB_CONCURRENCY=%d but SHARED_STATE_DIR is not set: each worker keeps its own cache, "
+                    "rate limits, single-flight, stories and jobs", WORKERS)
+
+
+def shared_path(name: str) -> str | None:
+    return os.path.join(SHARED_STATE_DIR, name) if SHARED_STATE_DIR else None
+
+
+shared_buckets = SqliteBuckets(shared_path("limits.sqlite3")) if SHARED_STATE_DIR else None
+
+CACHE_MAX_ENTRIES = 1024
+CACHE_TTL_SECONDS = 3600
+CACHE_DB_PATH = shared_path("cache.sqlite3")  # or e.g. "story_cache.sqlite3" to add an on-disk tier behind the in-process LRU
+CACHE_NONZERO_TEMPERATURE = False
+
+response_cache = ResponseCache(
+    [MemoryCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)] + ([SqliteCache(CACHE_DB_PATH, CACHE_TTL_SECONDS)] if CACHE_DB_PATH else []),
+    cache_nonzero_temperature=CACHE_NONZERO_TEMPERATURE,
+)
+
+# Near-duplicate /story plots ("A hero saves the world." / "a hero saves the world!") reuse an earlier story.
+# The index is per worker process; "lsh" trades exactness for speed on large stores, notably without NumPy.
+SEMANTIC_CACHE_ENABLED = False
+SEMANTIC_CACHE_THRESHOLD = 0.95  # cosine similarity of the hashed plot; genre and the other options must match exactly
+SEMANTIC_CACHE_MIN_WORD_OVERLAP = 1.0  # share of content words (and of their adjacent pairs) that must match; below 1.0 a one-word change of plot can hit
+SEMANTIC_CACHE_WORDS_TOLERANCE = 0.1  # relative totalWords difference allowed; characters and paragraphs must match
+SEMANTIC_CACHE_INDEX = "brute-force"  # or "lsh"
+
+semantic_cache = SemanticCache(
+    index_factory=LshIndex if SEMANTIC_CACHE_INDEX == "lsh" else BruteForceIndex,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    text_fields=("plot",),
+    min_word_overlap=SEMANTIC_CACHE_MIN_WORD_OVERLAP,
+    tolerances={"totalStoryCharacters": 0, "totalParagraphs": 0, "totalWords": SEMANTIC_CACHE_WORDS_TOLERANCE},
+    max_entries=CACHE_MAX_ENTRIES,
+    ttl_seconds=CACHE_TTL_SECONDS,
+    enabled=SEMANTIC_CACHE_ENABLED,
+    cache_nonzero_temperature=CACHE_NONZERO_TEMPERATURE,
+    on_lookup=lambda stage, seconds: metrics.semantic_cache_lookup.observe(seconds, stage),
+)
+
+single_flight = SqliteSingleFlight(shared_path("singleflight.sqlite3")) if SHARED_STATE_DIR else SingleFlight()
+
+BATCH_CONCURRENCY = 8
+
+UPSTREAM_REQUESTS_PER_MINUTE = 600
+UPSTREAM_TOKENS_PER_MINUTE = 400_000
+UPSTREAM_INITIAL_CONCURRENCY = 32
+UPSTREAM_MIN_CONCURRENCY = 2
+ESTIMATED_COMPLETION_TOKENS = 600  # for calls without max_tokens; reconciled against usage.total_tokens once the call returns
+
+# Requests/tokens per minute are shared buckets across workers; the concurrency limit is split between them.
+upstream_limiter = UpstreamLimiter(
+    UPSTREAM_REQUESTS_PER_MINUTE,
+    UPSTREAM_TOKENS_PER_MINUTE,
+    AdaptiveConcurrencyLimiter(max(UPSTREAM_MIN_CONCURRENCY, UPSTREAM_INITIAL_CONCURRENCY // WORKERS),
+                               UPSTREAM_MIN_CONCURRENCY, max(UPSTREAM_MIN_CONCURRENCY, MAX_CONNECTIONS // WORKERS)),
+    bucket=shared_buckets.bucket if shared_buckets else local_bucket,
+)
+
+HEDGE_REQUESTS = False  # fire a second identical chat call once the first outlives the stage's p95
+
+resilience = Resilience({
+    "story": StagePolicy(deadline=90, hedge=HEDGE_REQUESTS),
+    "develop": StagePolicy(deadline=90, hedge=HEDGE_REQUESTS),
+    "summary": StagePolicy(deadline=45, hedge=HEDGE_REQUESTS),
+    "image": StagePolicy(deadline=120, max_attempts=2),
+})
+
+IMAGE_DIR = "images"  # content-addressed image files, served by GET /images/{id}
+IMAGE_BASE_URL = ""  # prefix for image URLs in responses, e.g. "https://stories.example.com"
+
+image_store = ImageStore(BlobStore(IMAGE_DIR))
+
+STORY_DB_PATH = shared_path("stories.sqlite3")  # or e.g. "stories.sqlite3" to keep stories (and develop-story chains) across restarts
+CHAIN_SUMMARY_MAX_TOKENS = 600
+
+story_store = StoryChains(SqliteStoryStore(STORY_DB_PATH) if STORY_DB_PATH else MemoryStoryStore(),
+                          CHAIN_SUMMARY_MAX_TOKENS)
+
+# After /story, prewarm the continuation the UI's "continue this story" button asks for, so that /develop-story
+# (by storyId or with the returned summary, and the same settings) takes the result or joins the call in flight.
+SPECULATIVE_DEVELOP = False
+SPECULATIVE_DEVELOP_PLOT = "Continue the story."  # the direction the UI sends with "continue this story"
+SPECULATIVE_TOKENS_PER_MINUTE = 50_000  # upstream tokens speculation may spend, per worker
+SPECULATIVE_IDLE_FRACTION = 0.5  # only speculate while fewer than this share of upstream slots are busy
+SPECULATIVE_TTL_SECONDS = 600
+
+speculator = Speculator(
+    local_bucket("speculation", SPECULATIVE_TOKENS_PER_MINUTE),
+    idle=lambda: upstream_limiter.concurrency.in_flight < SPECULATIVE_IDLE_FRACTION * upstream_limiter.concurrency.limit,
+    usage=lambda result: result[1],  # (story result, upstream tokens) from speculative_develop
+    ttl_seconds=SPECULATIVE_TTL_SECONDS,
+)
+
+TRACE_EXPORT_PATH = None  # e.g. "traces.jsonl" to append OTLP/JSON spans to a file, or "-" for the console
+TRACE_SAMPLE_RATE = 1.0  # fraction of requests traced
+
+tracer = Tracer(JsonLinesExporter(TRACE_EXPORT_PATH) if TRACE_EXPORT_PATH else None, TRACE_SAMPLE_RATE)
+
+MAX_PROMPT_TOKENS = 3000  # larger prompts are rejected (or, for develop-story, have their summary trimmed) before any call
+
+COMBINED_SUMMARY_INSTRUCTION = (
+    " Respond only with a JSON object with two string fields: \"story\", containing the full story, "
+    "and \"summary\", summarizing the story in 3-4 sentences."
+)
+
+
+def labelled(counts: dict[str, float]) -> dict[tuple, float]:
+    return {(key,): value for key, value in counts.items()}
+
+
+metrics.registry.register(metrics.CallbackMetric(
+    "story_cache_hits_total", "Response cache hits by stage.", lambda: labelled(response_cache.hits), ("stage",), "counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_cache_misses_total", "Response cache misses by stage.", lambda: labelled(response_cache.misses), ("stage",), "counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_semantic_cache_hits_total", "Near-duplicate cache hits by stage.", lambda: labelled(semantic_cache.hits), ("stage",), "counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_semantic_cache_misses_total", "Near-duplicate cache misses by stage.", lambda: labelled(semantic_cache.misses), ("stage",), "counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_coalesced_calls_total", "Upstream calls served by joining an identical in-flight call.", lambda: labelled(single_flight.coalesced), ("stage",), "counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_upstream_limiter", "Upstream limiter state.", lambda: labelled(upstream_limiter.stats()), ("field",)))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_upstream_retries_total", "Retried upstream calls by stage.", lambda: labelled(resilience.retries), ("stage",), "counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_backend_latency_ewma_seconds", "Smoothed upstream latency per backend and role.",
+    lambda: {(role, b.name): b.latency_ewma for role, backends in model_router.roles.items() for b in backends if b.latency_ewma is not None},
+    ("role", "backend")))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_backend_errors_total", "Failed upstream calls per backend.",
+    lambda: {(b.name,): b.errors for b in model_router.backends()}, ("backend",), "counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_image_store", "Background image generations (pending, generated, deduplicated, abandoned).", lambda: labelled(image_store.stats()), ("field",)))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_speculation_total", "Speculative develop-story calls launched, and develop requests that hit, joined or missed one.",
+    lambda: {(outcome,): speculator.stats()[outcome] for outcome in ("launched", "hits", "joined", "misses")}, ("outcome",), "counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_speculation_skipped_total", "Speculations not started, by reason (busy upstream or spent budget).",
+    lambda: labelled(speculator.skipped), ("reason",), "counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_speculation_wasted_tokens_total", "Tokens spent on speculations that expired unused.",
+    lambda: {(): speculator.wasted_tokens}, type="counter"))
+metrics.registry.register(metrics.CallbackMetric(
+    "story_upstream_hedges_total", "Hedged upstream calls by stage.", lambda: labelled(resilience.hedges), ("stage",), "counter"))
+
+
+def model_cache_key() -> dict:
+    return {"models": {role: model_router.models(role) for role in model_router.roles}}
+
+
+class MalformedCombinedOutput(ValueError):
+    """A JSON-mode completion with no usable "story" (not JSON, e.g. cut off at max_tokens, or missing the key)."""
 
 
 class StoryWriter:
 
 
     @staticmethod
+    async def start() -> None:
+        """Open the upstream clients in the serving process (after any fork), rather than on the first request."""
+        for backend in model_router.backends():
+            backend.client
+
+
+    @staticmethod
+    async def aclose(drain_timeout: float = 0) -> None:
+        await speculator.aclose()
+        await image_store.aclose(drain_timeout)
+        await model_router.aclose()
+
 
     @staticmethod
-    def develop_story(request:DevelopStoryRequest) -> StoryResponse:
+    async def develop_story(request:DevelopStoryRequest) -> StoryResponse:
+        metrics.in_flight.inc("develop")
         try:
-            start_time = time.time()
-            story, tokens_used_story = StoryWriter.develop_story_from_summary(request)
-            story_summary, tokens_used_summary = StoryWriter.generate_summary(story, request.genre, request.experimentBoundary)
-            image_url = None
-            if request.imageNeeded:
-                image_url = StoryWriter.generate_image(request.plot, request.genre)
-            time_taken = time.time() - start_time
-            total_tokens = (tokens_used_story or 0) + (tokens_used_summary or 0)
-            return StoryResponse(
-                story=story,
-                storySummary=story_summary,
-                image=image_url,
-                modelStatistics=ModelStatistics(tokensUsedCount=total_tokens, timeTakenToProcessPrompt=time_taken)
-            )
+            request, parent_id = await StoryWriter.resolve_develop_request(request)
+            previous_summary = request.summary
+            template = prompt_registry.select("develop", request.promptVersion, key=request.plot)
+            request = StoryWriter.fit_develop_request(template, request)
+            speculation = speculator.take(StoryWriter.speculation_key(request, template.version)) \
+                if SPECULATIVE_DEVELOP and not request.bypassCache else None
+            develop_call = StoryWriter.develop_story_combined if request.summaryMode == "combined" \
+                else StoryWriter.develop_story_from_summary
+            if speculation is not None:
+                story_call = StoryWriter.prewarmed(speculation, lambda: develop_call(request, template.version))
+            else:
+                story_call = develop_call(request, template.version)
+            result = await StoryWriter.run_pipeline(request, story_call, template.version)
+            return await StoryWriter.store(result, previous_summary, parent_id)
         except Exception as e:
             logging.exception("Error in developing a story")
+            metrics.pipeline_errors.inc("develop", type(e).__name__)
             return StoryResponse(error=str(e))
+        finally:
+            metrics.in_flight.dec("develop")
 
 
     @staticmethod
-    def new_story(request:StoryRequest) -> StoryResponse:
+    async def new_story(request:StoryRequest) -> StoryResponse:
+        metrics.in_flight.inc("story")
         try:
-            start_time = time.time()
-            story, tokens_used_story = StoryWriter.generate_story(request.plot, request.genre, request.experimentBoundary, request.totalStoryCharacters, request.totalParagraphs, request.totalWords)
-            story_summary, tokens_used_summary = StoryWriter.generate_summary(story, request.genre, request.experimentBoundary)
-            image_url = None
-            if request.imageNeeded:
-                image_url = StoryWriter.generate_image(request.plot, request.genre)
-            time_taken = time.time() - start_time
-            total_tokens = (tokens_used_story or 0) + (tokens_used_summary or 0)
-            return StoryResponse(
-                story=story,
-                storySummary=story_summary,
-                image=image_url,
-                modelStatistics=ModelStatistics(tokensUsedCount=total_tokens, timeTakenToProcessPrompt=time_taken)
-            )
+            template = prompt_registry.select("story", request.promptVersion, key=request.plot)
+            StoryWriter.check_prompt_size(template, **StoryWriter.story_values(request.plot, request.genre, request.totalStoryCharacters, request.totalParagraphs, request.totalWords))
+            story_args = (request.plot, request.genre, request.experimentBoundary, request.totalStoryCharacters, request.totalParagraphs, request.totalWords, template.version)
+            if request.summaryMode == "combined":
+                story_call = StoryWriter.combined_or_plain(
+                    StoryWriter.generate_story_with_summary(*story_args, bypass_cache=request.bypassCache),
+                    lambda: StoryWriter.generate_story(*story_args, bypass_cache=request.bypassCache))
+            else:
+                story_call = StoryWriter.generate_story(*story_args, bypass_cache=request.bypassCache)
+            result = await StoryWriter.run_pipeline(request, story_call, template.version)
+            result = await StoryWriter.store(result)
+            if SPECULATIVE_DEVELOP and not result.error:
+                StoryWriter.speculate_develop(request, result)
+            return result
         except Exception as e:
             logging.exception("Error in generrating a new story")
+            metrics.pipeline_errors.inc("story", type(e).__name__)
             return StoryResponse(error=str(e))
+        finally:
+            metrics.in_flight.dec("story")
 
-    def develop_story_from_summary(request:DevelopStoryRequest):
-        prompt = (
-            f"Use the following summary of the story: {request.summary} of type {request.genre} and"
-            f"use the {request.plot} to develop the story further. "
-            f"Include {request.totalStoryCharacters} main character(s), {request.totalParagraphs} paragraph(s),"
-             f" and aim for about {request.totalWords} words."
-        )
-        response = openai_client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=request.experimentBoundary
-        )
-        story = response.choices[0].message.content.strip()
-        tokens_used = None
-        if hasattr(response, 'usage') and response.usage and hasattr(response.usage, 'total_tokens'):
-            tokens_used = response.usage.total_tokens
-        return story, tokens_used
-    
 
     @staticmethod
-    def generate_story(plot: str, genre: str, temperature: float = 0, totalStoryCharacters: int = 1, totalParagraphs: int = 1, totalWords: int = 100):
-        prompt = (
-            f"Write a {genre} story based on the following plot: {plot}. "
-            f"Include {totalStoryCharacters} main character(s), "
-            f"{totalParagraphs} paragraph(s), and aim for about {totalWords} words. "
-        )
-        print(f"Prompt for a new story : {prompt}")
-       
-        response = openai_client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=temperature,
+    async def new_stories(requests: list[StoryRequest], concurrency: int | None = None,
+                          runner: Callable[[StoryRequest], Awaitable[StoryResponse]] | None = None) -> AsyncIterator[tuple[int, StoryResponse]]:
+        """Yield (index, response) pairs as each story finishes, running at most `concurrency` at once.
+
+        `runner` generates one story (StoryWriter.new_story by default), e.g. wrapped in an admission slot.
+        """
+        semaphore = asyncio.Semaphore(concurrency or BATCH_CONCURRENCY)
+        runner = runner or StoryWriter.new_story
+
+        async def run(index: int, request: StoryRequest) -> tuple[int, StoryResponse]:
+            async with semaphore:
+                return index, await runner(request)
+
+        tasks = [asyncio.create_task(run(index, request)) for index, request in enumerate(requests)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+    @staticmethod
+    async def run_pipeline(request:StoryRequest, story_call: Awaitable, prompt_version: str | None = None) -> StoryResponse:
+        """Execute story -> summary; the image (which only needs plot and genre) is queued in the background at t=0
+        and cancelled again if the story or summary fails."""
+        start_time = time.perf_counter()
+        image_id = StoryWriter.start_image(request) if request.imageNeeded else None
+        try:
+            # combined-mode story calls return (story, tokens, summary) instead of (story, tokens)
+            (story, usage_story, *embedded_summary), story_time = await StoryWriter.timed(story_call, "story")
+            (story_summary, usage_summary, summary_mode), summary_time = await StoryWriter.timed(
+                StoryWriter.summarize(request, story, embedded_summary[0] if embedded_summary else None), "summary")
+        except BaseException:
+            if image_id:
+                image_store.abandon(image_id)
+            raise
+        time_taken = time.perf_counter() - start_time
+        metrics.stage_latency.observe(story_time, "story")
+        metrics.stage_latency.observe(summary_time, "summary")
+        metrics.stage_latency.observe(time_taken, "total")
+        usage = tokens.add_usage(usage_story, usage_summary)
+        return StoryResponse(
+            story=story,
+            storySummary=story_summary,
+            image=StoryWriter.image_url(image_id),
+            modelStatistics=ModelStatistics(tokensUsedCount=usage["total"],
+                                            promptTokensCount=usage["prompt"],
+                                            completionTokensCount=usage["completion"],
+                                            timeTakenToProcessPrompt=time_taken,
+                                            timeTakenToGenerateStory=story_time,
+                                            timeTakenToGenerateSummary=summary_time,
+                                            summaryMode=summary_mode,
+                                            promptVersion=prompt_version)
         )
+
+
+    @staticmethod
+    def speculation_key(request:DevelopStoryRequest, prompt_version: str) -> str:
+        """What a develop-story result depends on; storyId, image and cache flags do not change the story."""
+        return make_cache_key("develop-speculation", {
+            **StoryWriter.develop_values(request), "temperature": request.experimentBoundary,
+            "summaryMode": request.summaryMode, "prompt_version": prompt_version, **model_cache_key()})
+
+
+    @staticmethod
+    def speculate_develop(request:StoryRequest, result:StoryResponse) -> None:
+        """Start the likely continuation of a new story in the background, budget and upstream load permitting."""
+        develop_request = DevelopStoryRequest.model_construct(**{
+            **request.model_dump(), "plot": SPECULATIVE_DEVELOP_PLOT, "summary": result.storySummary,
+            "storyId": result.storyId, "imageNeeded": False, "bypassCache": False, "promptVersion": None})
+        try:
+            template = prompt_registry.select("develop", key=develop_request.plot)
+            develop_request = StoryWriter.fit_develop_request(template, develop_request)
+        except ValueError:
+            return
+        speculator.speculate(StoryWriter.speculation_key(develop_request, template.version),
+                             StoryWriter.estimate_request_tokens(develop_request),
+                             lambda: StoryWriter.speculative_develop(develop_request, template.version))
+
+
+    @staticmethod
+    async def speculative_develop(request:DevelopStoryRequest, prompt_version: str):
+        """Run the develop story call and warm the summary cache for its story; returns (story result, upstream tokens).
+
+        The tokens are charged to the develop request that takes the result, not the new-story request that started it.
+        The summary is skipped when the response cache would not keep it (non-zero temperature): the develop request
+        would pay for it and then generate its own anyway.
+        """
+        with metering() as meter:
+            if request.summaryMode == "combined":
+                story_result = await StoryWriter.develop_story_combined(request, prompt_version)
+            else:
+                story_result = await StoryWriter.develop_story_from_summary(request, prompt_version)
+            story, _, *embedded_summary = story_result
+            if not request.experimentBoundary or response_cache.cache_nonzero_temperature:
+                await StoryWriter.summarize(request, story, embedded_summary[0] if embedded_summary else None)
+        return story_result, meter.tokens
+
+
+    @staticmethod
+    async def prewarmed(speculation: Awaitable, fallback: Callable[[], Awaitable]):
+        """The speculative story result, or fallback() if the speculation fails or is cancelled after it was taken."""
+        try:
+            story_result, upstream_tokens = await speculation
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():  # this request is being cancelled, not just the speculation
+                raise
+            logging.warning("Speculative develop call was cancelled, calling upstream instead")
+        except Exception as e:
+            logging.warning("Speculative develop call failed, calling upstream instead: %r", e)
+        else:
+            charge_usage(upstream_tokens)
+            return story_result
+        return await fallback()
+
+
+    @staticmethod
+    async def resolve_develop_request(request:DevelopStoryRequest) -> tuple[DevelopStoryRequest, str | None]:
+        """Fill in the summary from the stored story when the request continues one by storyId."""
+        if not request.storyId:
+            return request, None
+        parent = await story_store.require(request.storyId)
+        if request.summary:
+            return request, parent["id"]
+        summary = parent["chainSummary"] or parent["result"].get("storySummary") or ""
+        return request.model_copy(update={"summary": summary}), parent["id"]
+
+
+    @staticmethod
+    async def store(result: StoryResponse, previous_summary: str | None = None, parent_id: str | None = None) -> StoryResponse:
+        if result.error:
+            return result
+        story = await story_store.save(result.model_dump(), previous_summary, parent_id)
+        return result.model_copy(update={"storyId": story["id"]})
+
+
+    @staticmethod
+    async def summarize(request:StoryRequest, story: str, embedded_summary: str | None = None, mode: str | None = None) -> tuple[str, int | None, str]:
+        """Return (summary, tokens, path used); combined falls back to extractive when no summary came back."""
+        mode = mode or request.summaryMode
+        if mode == "combined" and embedded_summary:
+            return embedded_summary, None, "combined"
+        if mode in ("combined", "extractive"):
+            return extractive_summary(story), None, "extractive"
+        story_summary, usage = await StoryWriter.generate_summary(story, request.genre, request.experimentBoundary, bypass_cache=request.bypassCache)
+        return story_summary, usage, "llm"
+
+
+    @staticmethod
+    async def timed(awaitable: Awaitable, stage: str):
+        start_time = time.perf_counter()
+        with tracer.span(f"pipeline.{stage}"):
+            result = await awaitable
+        return result, time.perf_counter() - start_time
+
+    @staticmethod
+    def check_prompt_size(template: PromptTemplate, **values) -> None:
+        estimated = template.estimate_tokens(**values)
+        if estimated > MAX_PROMPT_TOKENS:
+            raise PromptTooLarge(f"Prompt is about {estimated} tokens, the limit is {MAX_PROMPT_TOKENS}")
+
+
+    @staticmethod
+    def fit_develop_request(template: PromptTemplate, request:DevelopStoryRequest) -> DevelopStoryRequest:
+        """Trim an oversized summary (keeping its most recent part) so the develop prompt fits MAX_PROMPT_TOKENS."""
+        values = StoryWriter.develop_values(request)
+        overflow = template.estimate_tokens(**values) - MAX_PROMPT_TOKENS
+        if overflow <= 0:
+            return request
+        summary_budget = estimate_tokens(request.summary) - overflow
+        if summary_budget <= 0:
+            StoryWriter.check_prompt_size(template, **values)
+        return request.model_copy(update={"summary": trim_to_tokens(request.summary, summary_budget)})
+
+
+    @staticmethod
+    def develop_values(request:DevelopStoryRequest) -> dict:
+        return {"summary": request.summary or "", "genre": request.genre, "plot": request.plot,
+                "characters": request.totalStoryCharacters, "paragraphs": request.totalParagraphs,
+                "words": request.totalWords}
+
+
+    @staticmethod
+    def story_values(plot: str, genre: str, totalStoryCharacters: int = 1, totalParagraphs: int = 1, totalWords: int = 100) -> dict:
+        return {"plot": plot, "genre": genre, "characters": totalStoryCharacters,
+                "paragraphs": totalParagraphs, "words": totalWords}
+
+
+    @staticmethod
+    def develop_messages(request:DevelopStoryRequest, prompt_version: str | None = None) -> list[dict]:
+        template = prompt_registry.select("develop", prompt_version, key=request.plot)
+        return template.messages(**StoryWriter.develop_values(request))
+
+
+    @staticmethod
+    def story_messages(plot: str, genre: str, totalStoryCharacters: int = 1, totalParagraphs: int = 1, totalWords: int = 100, prompt_version: str | None = None) -> list[dict]:
+        template = prompt_registry.select("story", prompt_version, key=plot)
+        return template.messages(**StoryWriter.story_values(plot, genre, totalStoryCharacters, totalParagraphs, totalWords))
+
+
+    @staticmethod
+    @single_flight.coalesce("develop", model_cache_key)
+    async def develop_story_from_summary(request:DevelopStoryRequest, prompt_version: str | None = None):
+        messages = StoryWriter.develop_messages(request, prompt_version)
+        return await StoryWriter.complete(messages, request.experimentBoundary, "develop",
+                                          max_tokens=tokens.story_max_tokens(request.totalWords, request.totalParagraphs))
     
-        story = response.choices[0].message.content.strip()
-    
-        tokens_used = None
-        if hasattr(response, 'usage') and response.usage and hasattr(response.usage, 'total_tokens'):
-            tokens_used = response.usage.total_tokens
-        return story, tokens_used
+
+    @staticmethod
+    @semantic_cache.cached("story", model_cache_key)
+    @response_cache.cached("story", model_cache_key)
+    @single_flight.coalesce("story", model_cache_key)
+    async def generate_story(plot: str, genre: str, temperature: float = 0, totalStoryCharacters: int = 1, totalParagraphs: int = 1, totalWords: int = 100, prompt_version: str | None = None):
+        messages = StoryWriter.story_messages(plot, genre, totalStoryCharacters, totalParagraphs, totalWords, prompt_version)
+        logging.debug("Prompt for a new story : %s", messages)
+        return await StoryWriter.complete(messages, temperature, "story",
+                                          max_tokens=tokens.story_max_tokens(totalWords, totalParagraphs))
+
+
+    @staticmethod
+    @single_flight.coalesce("develop-combined", model_cache_key)
+    async def develop_story_with_summary(request:DevelopStoryRequest, prompt_version: str | None = None):
+        messages = StoryWriter.develop_messages(request, prompt_version)
+        return await StoryWriter.complete_with_summary(messages, request.experimentBoundary, "develop",
+                                                       tokens.combined_max_tokens(request.totalWords, request.totalParagraphs))
+
+
+    @staticmethod
+    async def develop_story_combined(request:DevelopStoryRequest, prompt_version: str | None = None):
+        return await StoryWriter.combined_or_plain(StoryWriter.develop_story_with_summary(request, prompt_version),
+                                                   lambda: StoryWriter.develop_story_from_summary(request, prompt_version))
+
+
+    @staticmethod
+    @semantic_cache.cached("story-combined", model_cache_key)
+    @response_cache.cached("story-combined", model_cache_key)
+    @single_flight.coalesce("story-combined", model_cache_key)
+    async def generate_story_with_summary(plot: str, genre: str, temperature: float = 0, totalStoryCharacters: int = 1, totalParagraphs: int = 1, totalWords: int = 100, prompt_version: str | None = None):
+        messages = StoryWriter.story_messages(plot, genre, totalStoryCharacters, totalParagraphs, totalWords, prompt_version)
+        return await StoryWriter.complete_with_summary(messages, temperature, "story",
+                                                       tokens.combined_max_tokens(totalWords, totalParagraphs))
+
+
+    @staticmethod
+    async def combined_or_plain(combined: Awaitable, plain: Callable[[], Awaitable]):
+        """The combined call's result, or plain() if its JSON was unusable; raising keeps the bad output out of the caches."""
+        try:
+            return await combined
+        except MalformedCombinedOutput as e:
+            logging.warning("%s, generating the story on its own", e)
+            return await plain()
+
+
+    @staticmethod
+    async def complete_with_summary(messages: list[dict], temperature: float, stage: str, max_tokens: int | None = None) -> tuple[str, dict | None, str | None]:
+        """One JSON-mode completion returning (story, usage, summary); summary is None if the JSON has none.
+
+        Raises MalformedCombinedOutput when there is no clean story text to return.
+        """
+        # The format instruction goes last so the shared system/parameter prefix stays cacheable.
+        messages = messages[:-1] + [{"role": "user", "content": messages[-1]["content"] + COMBINED_SUMMARY_INSTRUCTION}]
+        text, usage = await StoryWriter.complete(messages, temperature, stage, max_tokens=max_tokens,
+                                                 response_format={"type": "json_object"})
+        try:
+            data = json.loads(text)
+            story = data["story"].strip()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            story = None
+        if not story:
+            raise MalformedCombinedOutput(f"{stage} completion was not valid story/summary JSON")
+        summary = data.get("summary")
+        return story, usage, (summary.strip() or None) if isinstance(summary, str) else None
+
+
+    @staticmethod
+    async def complete(messages: list[dict], temperature: float = 0, stage: str = "story", **options) -> tuple[str, dict | None]:
+        """Run one chat completion under the stage's deadline/retry/hedge policy; returns (text, token usage)."""
+        return await resilience.call(stage, lambda: model_router.call(
+            STAGE_ROLES[stage], lambda backend: StoryWriter.complete_once(backend, messages, temperature, stage, **options)))
+
+
+    @staticmethod
+    async def complete_once(backend: Backend, messages: list[dict], temperature: float = 0, stage: str = "story", **options) -> tuple[str, dict | None]:
+        queued_ns = time.time_ns()
+        with tracer.span("upstream.call", **{"story.stage": stage, "upstream.backend": backend.name,
+                                             "gen_ai.request.model": backend.model,
+                                             "gen_ai.request.max_tokens": options.get("max_tokens")}) as span:
+            async with upstream_limiter.slot(StoryWriter.estimate_tokens(messages, options.get("max_tokens"))) as usage:
+                tracer.record("upstream.queue", queued_ns, time.time_ns())
+                try:
+                    response = await backend.client.chat.completions.create(
+                        model=backend.model,
+                        messages=messages,
+                        temperature=temperature,
+                        **options,
+                    )
+                except Exception as e:
+                    metrics.upstream_errors.inc(stage, type(e).__name__)
+                    raise
+                token_usage = tokens.usage_counts(getattr(response, 'usage', None))
+                if token_usage:
+                    StoryWriter.record_usage(stage, response.usage)
+                    usage.tokens = token_usage["total"]
+                    span.set_attribute("gen_ai.usage.input_tokens", token_usage["prompt"])
+                    span.set_attribute("gen_ai.usage.output_tokens", token_usage["completion"])
+            span.set_attribute("gen_ai.response.finish_reasons", response.choices[0].finish_reason)
+        StoryWriter.check_finish_reason(stage, response.choices[0].finish_reason)
+        return response.choices[0].message.content.strip(), token_usage
+
+
+    @staticmethod
+    def record_usage(stage: str, usage) -> None:
+        metrics.upstream_tokens.inc(stage, "prompt", amount=getattr(usage, 'prompt_tokens', None) or 0)
+        metrics.upstream_tokens.inc(stage, "completion", amount=getattr(usage, 'completion_tokens', None) or 0)
+
+
+    @staticmethod
+    def check_finish_reason(stage: str, finish_reason: str | None) -> None:
+        if finish_reason == "length":
+            logging.warning("%s completion was cut off at its max_tokens ceiling", stage)
+            metrics.truncated_completions.inc(stage)
+
+
+    @staticmethod
+    def estimate_tokens(messages: list[dict], max_tokens: int | None = None) -> int:
+        return sum(estimate_tokens(message["content"]) for message in messages) + (max_tokens or ESTIMATED_COMPLETION_TOKENS)
+
+
+    @staticmethod
+    def estimate_request_tokens(request:StoryRequest) -> int:
+        """Upper-bound estimate of the tokens a request can consume upstream, used to reserve client budgets."""
+        story_tokens = (tokens.combined_max_tokens if request.summaryMode == "combined" else tokens.story_max_tokens)(
+            request.totalWords, request.totalParagraphs)
+        if isinstance(request, DevelopStoryRequest):
+            values = StoryWriter.develop_values(request)
+            prompt_tokens = prompt_registry.select("develop", request.promptVersion, key=request.plot).estimate_tokens(**values)
+            if not request.summary:  # continues a stored story, whose chain summary is bounded
+                prompt_tokens += CHAIN_SUMMARY_MAX_TOKENS
+        else:
+            values = StoryWriter.story_values(request.plot, request.genre, request.totalStoryCharacters, request.totalParagraphs, request.totalWords)
+            prompt_tokens = prompt_registry.select("story", request.promptVersion, key=request.plot).estimate_tokens(**values)
+        summary_tokens = story_tokens + tokens.SUMMARY_MAX_TOKENS if request.summaryMode == "llm" else 0
+        return min(prompt_tokens, MAX_PROMPT_TOKENS) + story_tokens + summary_tokens
+
+
+    @staticmethod
+    async def stream_develop_story(request:DevelopStoryRequest) -> AsyncIterator[tuple[str, dict]]:
+        try:
+            request, parent_id = await StoryWriter.resolve_develop_request(request)
+            previous_summary = request.summary
+            template = prompt_registry.select("develop", request.promptVersion, key=request.plot)
+            request = StoryWriter.fit_develop_request(template, request)
+        except (ValueError, LookupError) as e:
+            yield "error", StoryResponse(error=str(e)).model_dump(mode="json")
+            return
+        messages = template.messages(**StoryWriter.develop_values(request))
+        # aclosing: closing this stream closes the pipeline's upstream call too, rather than leaving it to the GC
+        async with aclosing(StoryWriter.stream_pipeline(request, messages, template.version, previous_summary, parent_id)) as events:
+            async for event in events:
+                yield event
+
+
+    @staticmethod
+    async def stream_new_story(request:StoryRequest) -> AsyncIterator[tuple[str, dict]]:
+        values = StoryWriter.story_values(request.plot, request.genre, request.totalStoryCharacters, request.totalParagraphs, request.totalWords)
+        try:
+            template = prompt_registry.select("story", request.promptVersion, key=request.plot)
+            StoryWriter.check_prompt_size(template, **values)
+        except ValueError as e:
+            yield "error", StoryResponse(error=str(e)).model_dump(mode="json")
+            return
+        async with aclosing(StoryWriter.stream_pipeline(request, template.messages(**values), template.version)) as events:
+            async for event in events:
+                yield event
+
+
+    @staticmethod
+    async def stream_pipeline(request:StoryRequest, messages: list[dict], prompt_version: str | None = None,
+                              previous_summary: str | None = None, parent_id: str | None = None) -> AsyncIterator[tuple[str, dict]]:
+        """Yield (event, data) pairs: a "token" per story delta, then "summary", "image" and a final "done"."""
+        start_time = time.perf_counter()
+        image_id = StoryWriter.start_image(request) if request.imageNeeded else None
+        completed = False
+        metrics.in_flight.inc("stream")
+        max_tokens = tokens.story_max_tokens(request.totalWords, request.totalParagraphs)
+        # Not made the current span: the generator may be closed from another task's context.
+        upstream_span = tracer.start_span("upstream.call", **{"story.stage": "story", "upstream.stream": True,
+                                                              "gen_ai.request.max_tokens": max_tokens})
+        try:
+            parts = []
+            first_token_time = None
+            usage_story = None
+            finish_reason = None
+            async with upstream_limiter.slot(StoryWriter.estimate_tokens(messages, max_tokens)) as usage:
+                # Only opening the stream is retried; once tokens have been forwarded a failure is final.
+                response = await resilience.call("story", lambda: model_router.call(
+                    STAGE_ROLES["story"], lambda backend: backend.client.chat.completions.create(
+                        model=backend.model,
+                        messages=messages,
+                        temperature=request.experimentBoundary,
+                        max_tokens=max_tokens,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    )))
+                try:
+                    async for chunk in response:
+                        if getattr(chunk, 'usage', None):
+                            usage_story = tokens.usage_counts(chunk.usage)
+                            StoryWriter.record_usage("story", chunk.usage)
+                        if not chunk.choices:
+                            continue
+                        finish_reason = chunk.choices[0].finish_reason or finish_reason
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            if first_token_time is None:
+                                first_token_time = time.perf_counter()
+                            parts.append(delta)
+                            yield "token", {"text": sanitize_string(delta)}
+                finally:
+                    # A stream cut short (client gone, upstream error) never reports usage, so count what was streamed.
+                    usage.tokens = usage_story["total"] if usage_story else \
+                        sum(estimate_tokens(message["content"]) for message in messages) + estimate_tokens("".join(parts))
+            if usage_story:
+                upstream_span.set_attribute("gen_ai.usage.input_tokens", usage_story["prompt"])
+                upstream_span.set_attribute("gen_ai.usage.output_tokens", usage_story["completion"])
+            upstream_span.set_attribute("gen_ai.response.finish_reasons", finish_reason)
+            upstream_span.end()
+            StoryWriter.check_finish_reason("story", finish_reason)
+            story_end_time = time.perf_counter()
+            story = "".join(parts).strip()
+
+            # A JSON-mode completion cannot be forwarded token by token, so streams summarize locally instead.
+            summary_mode = "extractive" if request.summaryMode == "combined" else request.summaryMode
+            (story_summary, usage_summary, summary_mode), summary_time = await StoryWriter.timed(
+                StoryWriter.summarize(request, story, mode=summary_mode), "summary")
+            yield "summary", {"storySummary": sanitize_string(story_summary)}
+
+            completed = True  # from here on the client may hold the image URL, so the image is kept
+            if request.imageNeeded:
+                yield "image", {"image": StoryWriter.image_url(image_id)}
+
+            time_to_first_token = first_token_time - start_time if first_token_time else None
+            metrics.stage_latency.observe(story_end_time - start_time, "story")
+            metrics.stage_latency.observe(summary_time, "summary")
+            if time_to_first_token is not None:
+                metrics.stage_latency.observe(time_to_first_token, "first_token")
+            metrics.stage_latency.observe(time.perf_counter() - start_time, "total")
+            tokens_per_second = None
+            if first_token_time and story_end_time > first_token_time:
+                completion_tokens = usage_story["completion"] if usage_story else None
+                tokens_per_second = (completion_tokens or len(parts)) / (story_end_time - first_token_time)
+            token_usage = tokens.add_usage(usage_story, usage_summary)
+            result = StoryResponse(
+                story=story,
+                storySummary=story_summary,
+                image=StoryWriter.image_url(image_id),
+                modelStatistics=ModelStatistics(tokensUsedCount=token_usage["total"],
+                                                promptTokensCount=token_usage["prompt"],
+                                                completionTokensCount=token_usage["completion"],
+                                                timeTakenToProcessPrompt=time.perf_counter() - start_time,
+                                                timeTakenToGenerateStory=story_end_time - start_time,
+                                                timeTakenToGenerateSummary=summary_time,
+                                                timeToFirstToken=time_to_first_token,
+                                                tokensPerSecond=tokens_per_second,
+                                                summaryMode=summary_mode,
+                                                promptVersion=prompt_version)
+            )
+            result = await StoryWriter.store(result, previous_summary, parent_id)
+            yield "done", result.model_dump(mode="json")
+        except Exception as e:
+            logging.exception("Error in streaming a story")
+            metrics.pipeline_errors.inc("stream", type(e).__name__)
+            upstream_span.record_exception(e)
+            yield "error", StoryResponse(error=str(e)).model_dump(mode="json")
+        finally:
+            if image_id and not completed:
+                image_store.abandon(image_id)
+            upstream_span.end()
+            metrics.in_flight.dec("stream")
 
 
    
     
 
     @staticmethod
-    def generate_summary(story: str, genre: str, temperature: float = 0):
-        summary_prompt = f"Summarize the following {genre} story in 3-4 sentences: {story}"
-        summary_response = openai_client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[{"role": "user", "content": summary_prompt}],
-            temperature=temperature,
-        )
-        story_summary = summary_response.choices[0].message.content.strip()
-        tokens_used = None
-        if hasattr(summary_response, 'usage') and summary_response.usage and hasattr(summary_response.usage, 'total_tokens'):
-            tokens_used = summary_response.usage.total_tokens
-        return story_summary, tokens_used
+    @response_cache.cached("summary", model_cache_key)
+    @single_flight.coalesce("summary", model_cache_key)
+    async def generate_summary(story: str, genre: str, temperature: float = 0):
+        summary_messages = prompt_registry.select("summary", key=story).messages(genre=genre, story=story)
+        return await StoryWriter.complete(summary_messages, temperature, "summary", max_tokens=tokens.SUMMARY_MAX_TOKENS)
     
 
     @staticmethod
-    def generate_image(plot: str, genre: str) -> str | None:
-        image_prompt = f"Generate an illustration for this {genre} story: {plot}"
-        image_response = openai_client.images.generate(
-            model="dall-e-3", 
-            quality="standard",  
-            prompt=image_prompt,
-            n=1, size="1024x1024"
-        )
-        base64Data = image_response.data[0].b64_json;
-        return image_response.data[0].url if image_response.data else None
+    def start_image(request:StoryRequest) -> str:
+        """Queue the illustration in the background and return its stable ID straight away."""
+        image_prompt = prompt_registry.select("image", key=request.plot).text(genre=request.genre, plot=request.plot)
+        image_id = make_cache_key("image", {"prompt": image_prompt, "size": request.imageSize, **model_cache_key()})
+        image_store.submit(image_id, lambda: StoryWriter.generate_image(image_prompt, request.imageSize),
+                           replace=request.bypassCache)
+        return image_id
+
+
+    @staticmethod
+    def image_url(image_id: str | None) -> str | None:
+        return f"{IMAGE_BASE_URL}/images/{image_id}" if image_id else None
+
+
+    @staticmethod
+    async def generate_image(image_prompt: str, size: str = "1024x1024") -> bytes:
+        start_time = time.perf_counter()
+        async def request_image(backend: Backend):
+            queued_ns = time.time_ns()
+            with tracer.span("upstream.call", **{"story.stage": "image", "upstream.backend": backend.name,
+                                                 "gen_ai.request.model": backend.model}):
+                async with upstream_limiter.slot():
+                    tracer.record("upstream.queue", queued_ns, time.time_ns())
+                    try:
+                        return await backend.client.images.generate(
+                            model=backend.model, 
+                            quality="standard",  
+                            prompt=image_prompt,
+                            n=1, size=size,
+                            response_format="b64_json",
+                        )
+                    except Exception as e:
+                        metrics.upstream_errors.inc("image", type(e).__name__)
+                        raise
+        image_response = await resilience.call("image", lambda: model_router.call(STAGE_ROLES["image"], request_image))
+        if not image_response.data:
+            raise ValueError("The image response contained no image")
+        image = image_response.data[0]
+        if image.b64_json:
+            data = base64.b64decode(image.b64_json)
+        else:  # providers that ignore response_format return a short-lived URL instead
+            async with httpx.AsyncClient(timeout=60) as http_client:
+                download = await http_client.get(image.url)
+                download.raise_for_status()
+                data = download.content
+        metrics.stage_latency.observe(time.perf_counter() - start_time, "image")
+        return data
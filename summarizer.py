@@ -0,0 +1,39 @@
+import re
+from collections import Counter
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])[\"')\]]*\s+")
+WORD = re.compile(r"[a-z']+")
+STOPWORDS = frozenset("""
+a about after again against all also am an and any are as at be because been before being between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself
+him himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only
+or other our ours out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom why will
+with would you your yours
+""".split())
+
+
+def split_sentences(text: str) -> list[str]:
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text.strip()) if sentence.strip()]
+
+
+def extractive_summary(text: str, max_sentences: int = 4) -> str:
+    """Pick the highest-scoring sentences (content-word frequency, favouring the opening) in story order."""
+    sentences = split_sentences(text)
+    if len(sentences) <= max_sentences:
+        return " ".join(sentences)
+    frequencies = Counter(word for word in WORD.findall(text.lower()) if word not in STOPWORDS)
+    if not frequencies:
+        return " ".join(sentences[:max_sentences])
+    top = max(frequencies.values())
+
+    def score(index: int) -> float:
+        words = [word for word in WORD.findall(sentences[index].lower()) if word not in STOPWORDS]
+        if not words:
+            return 0.0
+        position_bonus = 0.25 if index == 0 else 0.1 if index == len(sentences) - 1 else 0.0
+        # sqrt length normalisation: long sentences are not rewarded for length alone, nor short ones for brevity
+        return sum(frequencies[word] for word in words) / (top * len(words) ** 0.5) + position_bonus
+
+    chosen = sorted(sorted(range(len(sentences)), key=score, reverse=True)[:max_sentences])
+    return " ".join(sentences[index] for index in chosen)
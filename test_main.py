@@ -1,6 +1,27 @@
+import asyncio
+import gc
+import json
+import sqlite3
+import time
+import httpx
+import openai
 from fastapi.testclient import TestClient
 import pytest
+import main
+import story_writer
+from admission import AdmissionController, AdmissionRejected, PriorityClass
+import cache as cache_module
+from cache import MemoryCache, ResponseCache, SqliteCache
+from images import BlobStore, ImageStore
+from prompts import prompt_registry
 from main import app
+from ratelimit import AdaptiveConcurrencyLimiter, ClientTokenBudgets, SqliteBuckets, TokenBucket, UpstreamLimiter
+from resilience import Resilience, StagePolicy
+from router import Backend, ModelRouter, load_router
+from schemas import DevelopStoryRequest, StoryRequest, StoryResponse
+from semantic_cache import LshIndex, SemanticCache
+from singleflight import SingleFlight, SqliteSingleFlight
+from tracing import JsonLinesExporter
 
 client = TestClient(app)
 
@@ -360,3 +381,1104 @@ def test_create_story_min_max_values():
     assert "storySummary" in data
     assert "modelStatistics" in data
     assert data["error"] is None
+
+def test_create_story_stream():
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure"
+    }
+    with client.stream("POST", "/story/stream", json=payload) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = [line.split(": ", 1)[1] for line in response.iter_lines() if line.startswith("event: ")]
+    assert "token" in events
+    assert events[-2:] == ["summary", "done"]
+
+def test_create_story_stream_invalid_totalWords():
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "totalWords": 50  # Invalid, should be between 100 and 400
+    }
+    response = client.post("/story/stream", json=payload)
+    assert response.status_code == 422
+
+def test_develop_story_stream():
+    payload = {
+        "plot": "A hero faces a new challenge.",
+        "imageNeeded": False,
+        "genre": "Drama",
+        "summary": "A hero saved the world but now must find peace."
+    }
+    with client.stream("POST", "/develop-story/stream", json=payload) as response:
+        assert response.status_code == 200
+        lines = list(response.iter_lines())
+    done = lines[lines.index("event: done") + 1]
+    data = json.loads(done.split(": ", 1)[1])
+    assert data["story"]
+    assert data["storySummary"]
+    assert data["modelStatistics"]["timeToFirstToken"] is not None
+    assert data["modelStatistics"]["tokensPerSecond"] is not None
+
+def test_create_stories_batch():
+    payload = {
+        "items": [
+            {"plot": "A hero saves the world.", "imageNeeded": False, "genre": "Adventure"},
+            {"plot": "A young wizard discovers her powers.", "imageNeeded": False, "genre": "Fantasy"}
+        ],
+        "concurrency": 2
+    }
+    response = client.post("/stories/batch", json=payload)
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert len(results) == 2
+    for data in results:
+        assert data["story"]
+        assert data["error"] is None
+
+def test_create_stories_batch_ndjson():
+    payload = {
+        "items": [
+            {"plot": "A hero saves the world.", "imageNeeded": False, "genre": "Adventure"},
+            {"plot": "A young wizard discovers her powers.", "imageNeeded": False, "genre": "Fantasy"}
+        ]
+    }
+    response = client.post("/stories/batch?stream=true", json=payload)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line["index"] for line in lines) == [0, 1]
+
+def test_create_stories_batch_invalid_item():
+    payload = {
+        "items": [
+            {"plot": "A hero saves the world.", "imageNeeded": False, "genre": "Adventure", "totalWords": 50}
+        ]
+    }
+    response = client.post("/stories/batch", json=payload)
+    assert response.status_code == 422
+
+def test_create_stories_batch_empty():
+    response = client.post("/stories/batch", json={"items": []})
+    assert response.status_code == 422
+
+def test_story_job():
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure"
+    }
+    with TestClient(app) as job_client:
+        response = job_client.post("/jobs/story", json=payload)
+        assert response.status_code == 202
+        job = response.json()
+        assert job["status"] == "queued"
+        for _ in range(600):
+            job = job_client.get(f"/jobs/{job['id']}").json()
+            if job["status"] in ("succeeded", "failed"):
+                break
+            time.sleep(0.1)
+    assert job["status"] == "succeeded"
+    assert job["result"]["story"]
+    assert job["result"]["storySummary"]
+
+def test_get_unknown_job():
+    response = client.get("/jobs/does-not-exist")
+    assert response.status_code == 404
+
+def test_develop_story_job_missing_summary():
+    payload = {
+        "plot": "A hero faces a new challenge.",
+        "imageNeeded": False,
+        "genre": "Drama"
+    }
+    response = client.post("/jobs/develop-story", json=payload)
+    assert response.status_code == 422
+
+def test_metrics():
+    client.post("/story", json={"plot": "A hero saves the world.", "imageNeeded": False, "genre": "Adventure"})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'story_stage_latency_seconds_count{stage="total"}' in response.text
+    assert "# TYPE story_upstream_tokens_total counter" in response.text
+
+@pytest.mark.parametrize("summary_mode", ["combined", "extractive"])
+def test_create_story_summary_modes(summary_mode):
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "summaryMode": summary_mode
+    }
+    response = client.post("/story", json=payload)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["story"]
+    assert data["storySummary"]
+    assert data["modelStatistics"]["summaryMode"] in (summary_mode, "extractive")
+
+@pytest.mark.parametrize("combined_text, story, expected_calls", [
+    # unusable JSON is never cached: the retry asks for the combined completion again, the plain story is cached
+    ('{"story": "Once upon a time the hero', "The hero saved the world.", ["combined", "plain", "combined"]),
+    ('{"summary": "A hero wins."}', "The hero saved the world.", ["combined", "plain", "combined"]),
+    ('{"story": "The hero saved the world, again."}', "The hero saved the world, again.", ["combined"]),
+])
+def test_combined_story_with_unusable_json(monkeypatch, combined_text, story, expected_calls):
+    calls = []
+
+    async def complete(messages, temperature=0, stage="story", **options):
+        calls.append("combined" if "response_format" in options else "plain")
+        return (combined_text if "response_format" in options else "The hero saved the world."), None
+    monkeypatch.setattr(story_writer.StoryWriter, "complete", complete)
+    payload = {
+        "plot": f"A hero saves the world from malformed JSON {len(combined_text)}.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "summaryMode": "combined"
+    }
+    for _ in range(2):
+        data = client.post("/story", json=payload).json()
+        assert data["story"] == story
+        assert data["storySummary"]
+        assert data["modelStatistics"]["summaryMode"] == "extractive"
+    assert calls == expected_calls
+
+def test_create_story_invalid_summary_mode():
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "summaryMode": "telepathy"
+    }
+    response = client.post("/story", json=payload)
+    assert response.status_code == 422
+
+def test_create_story_prompt_version():
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "promptVersion": "v1"
+    }
+    response = client.post("/story", json=payload)
+    assert response.status_code == 200
+    data = response.json()
+    assert data["story"]
+    assert data["modelStatistics"]["promptVersion"] == "v1"
+
+def test_create_story_invalid_prompt_version():
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "promptVersion": "v99"
+    }
+    response = client.post("/story", json=payload)
+    assert response.status_code == 422
+
+def test_develop_prompt_versions_come_from_develop_registry():
+    schema = DevelopStoryRequest.model_json_schema()["properties"]["promptVersion"]
+    assert schema["anyOf"][0]["enum"] == prompt_registry.versions("develop")
+
+def test_create_story_token_counts():
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "bypassCache": True
+    }
+    response = client.post("/story", json=payload)
+    assert response.status_code == 200
+    statistics = response.json()["modelStatistics"]
+    assert statistics["promptTokensCount"] > 0
+    assert statistics["completionTokensCount"] > 0
+    assert statistics["tokensUsedCount"] == statistics["promptTokensCount"] + statistics["completionTokensCount"]
+
+def test_client_token_budget_exceeded(monkeypatch):
+    # The first request is let through, and its actual usage overdraws the tiny budget.
+    monkeypatch.setattr(main, "client_budgets", ClientTokenBudgets(tokens_per_minute=100))
+    monkeypatch.setattr(main, "TRUST_CLIENT_ID_HEADER", True)
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "bypassCache": True
+    }
+    headers = {"X-Client-Id": "greedy-client"}
+    assert client.post("/story", json=payload, headers=headers).status_code == 200
+    response = client.post("/story", json=payload, headers=headers)
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+    assert client.post("/story", json=payload, headers={"X-Client-Id": "other-client"}).status_code == 200
+
+def test_client_token_budget_ignores_untrusted_client_id(monkeypatch):
+    monkeypatch.setattr(main, "client_budgets", ClientTokenBudgets(tokens_per_minute=100))
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "bypassCache": True
+    }
+    assert client.post("/story", json=payload, headers={"X-Client-Id": "first-id"}).status_code == 200
+    # A fresh ID does not get a fresh budget: the client is still known by its address
+    assert client.post("/story", json=payload, headers={"X-Client-Id": "second-id"}).status_code == 429
+
+async def record_charge(charges: list, tokens: int) -> None:
+    charges.append(tokens)
+
+async def reserve_1000(http_request, *requests):
+    return "test-client", 1000
+
+def test_admission_wait_cancelled_refunds_reservation(monkeypatch):
+    charges = []
+    monkeypatch.setattr(main.client_budgets, "adjust", lambda client, tokens: record_charge(charges, tokens))
+
+    async def queued(name):
+        await asyncio.sleep(60)
+    monkeypatch.setattr(main.admission, "acquire", queued)
+
+    async def run():
+        request = StoryRequest(plot="A hero saves the world.", imageNeeded=False, genre="Adventure")
+        waiting = asyncio.create_task(main.admit(request, "test-client", 1000))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(run())
+    assert charges == [-1000]
+
+@pytest.mark.parametrize("started", [False, True])
+def test_stream_dropped_before_it_starts_refunds_reservation(started):
+    refunds, released = [], []
+
+    class FakeTicket:
+        def release(self):
+            released.append(True)
+
+    async def events():
+        yield "token", {"text": "Once"}
+
+    async def refund():
+        refunds.append(True)
+
+    async def run():
+        stream = main.releasing(events(), FakeTicket(), refund)
+        if started:
+            async for _ in stream:
+                pass
+        del stream
+        gc.collect()
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert released
+    assert refunds == ([] if started else [True])
+
+def test_cached_story_is_not_charged_to_client_budget(monkeypatch):
+    charges = []
+    monkeypatch.setattr(main.client_budgets, "adjust", lambda client, tokens: record_charge(charges, tokens))
+    monkeypatch.setattr(main, "reserve_tokens", reserve_1000)
+    payload = {
+        "plot": "A baker wins a contest with a cake that sings.",
+        "imageNeeded": False,
+        "genre": "Comedy"
+    }
+    first = client.post("/story", json=payload).json()
+    second = client.post("/story", json=payload).json()
+    assert second["story"] == first["story"]
+    assert charges[0] > -1000
+    assert charges[1] == -1000
+
+def test_story_stream_cut_short_is_charged_for_streamed_tokens(monkeypatch):
+    charges = []
+    monkeypatch.setattr(main.client_budgets, "adjust", lambda client, tokens: record_charge(charges, tokens))
+    request = StoryRequest(plot="A sailor races a storm home.", imageNeeded=False, genre="Adventure")
+
+    async def read_some_tokens():
+        events = main.settle_events(story_writer.StoryWriter.stream_new_story(request), "streaming-client", 1000)
+        async for event, _ in events:
+            if event == "token":
+                break
+        await events.aclose()
+
+    asyncio.run(read_some_tokens())
+    assert charges and charges[0] > -1000
+
+def test_develop_story_chain_by_story_id():
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure"
+    }
+    first = client.post("/story", json=payload).json()
+    assert first["storyId"]
+
+    stored = client.get(f"/stories/{first['storyId']}")
+    assert stored.status_code == 200
+    assert stored.json()["result"]["story"] == first["story"]
+    assert stored.json()["chainSummary"] == first["storySummary"]
+
+    develop_payload = {
+        "plot": "The hero retires to a quiet village.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "storyId": first["storyId"]
+    }
+    response = client.post("/develop-story", json=develop_payload)
+    assert response.status_code == 200
+    second = response.json()
+    assert second["story"]
+    assert second["storyId"] not in (None, first["storyId"])
+
+    stored = client.get(f"/stories/{second['storyId']}").json()
+    assert stored["parentId"] == first["storyId"]
+    assert stored["chainSummary"].startswith(first["storySummary"])
+
+def test_develop_story_unknown_story_id():
+    payload = {
+        "plot": "The hero retires to a quiet village.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "storyId": "does-not-exist"
+    }
+    response = client.post("/develop-story", json=payload)
+    assert response.status_code == 404
+
+def test_develop_story_requires_summary_or_story_id():
+    payload = {
+        "plot": "The hero retires to a quiet village.",
+        "imageNeeded": False,
+        "genre": "Adventure"
+    }
+    response = client.post("/develop-story", json=payload)
+    assert response.status_code == 422
+
+def test_get_unknown_story():
+    response = client.get("/stories/does-not-exist")
+    assert response.status_code == 404
+
+def test_story_image_is_stored_and_served(monkeypatch, tmp_path):
+    monkeypatch.setattr(story_writer, "image_store", ImageStore(BlobStore(str(tmp_path))))
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": True,
+        "genre": "Adventure",
+        "imageSize": "512x512"
+    }
+    with TestClient(app) as image_client:
+        data = image_client.post("/story", json=payload).json()
+        assert data["image"].startswith("/images/")
+
+        response = image_client.get(data["image"])
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/png"
+        etag = response.headers["etag"]
+
+        assert image_client.get(data["image"], headers={"If-None-Match": etag}).status_code == 304
+        partial = image_client.get(data["image"], headers={"Range": "bytes=0-3"})
+        assert partial.status_code == 206
+        assert partial.content == response.content[:4]
+
+        # The same plot, genre and size reuse the stored image
+        assert image_client.post("/story", json=payload).json()["image"] == data["image"]
+
+def test_failed_story_cancels_its_image(monkeypatch, tmp_path):
+    store = ImageStore(BlobStore(str(tmp_path)))
+    monkeypatch.setattr(story_writer, "image_store", store)
+    started = []
+
+    async def slow_image(image_prompt, size="1024x1024"):
+        started.append(image_prompt)
+        await asyncio.sleep(60)
+        return b"never"
+    monkeypatch.setattr(story_writer.StoryWriter, "generate_image", slow_image)
+
+    async def failing_story():
+        await asyncio.sleep(0)
+        raise RuntimeError("upstream failed")
+
+    async def scenario():
+        request = StoryRequest(plot="A hero saves the world.", imageNeeded=True, genre="Adventure")
+        with pytest.raises(RuntimeError):
+            await story_writer.StoryWriter.run_pipeline(request, failing_story())
+        await asyncio.sleep(0)
+        return store.stats()
+
+    stats = asyncio.run(scenario())
+    assert started
+    assert stats == {"pending": 0, "generated": 0, "deduplicated": 0, "abandoned": 1}
+
+def test_abandoned_image_is_kept_while_another_request_wants_it(tmp_path):
+    store = ImageStore(BlobStore(str(tmp_path)))
+    image_id = "a" * 64
+
+    async def image():
+        await asyncio.sleep(0.01)
+        return b"png"
+
+    async def scenario():
+        store.submit(image_id, image)
+        store.submit(image_id, image)
+        store.abandon(image_id)
+        return await store.wait(image_id, 5)
+
+    assert asyncio.run(scenario()) is not None
+    assert store.stats()["abandoned"] == 0
+
+def test_get_unknown_image():
+    response = client.get("/images/" + "0" * 64)
+    assert response.status_code == 404
+
+def test_create_story_invalid_image_size():
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": True,
+        "genre": "Adventure",
+        "imageSize": "640x480"
+    }
+    response = client.post("/story", json=payload)
+    assert response.status_code == 422
+
+def test_single_flight_is_shared_between_workers(tmp_path):
+    # Two instances on one file stand in for two worker processes.
+    path = str(tmp_path / "singleflight.sqlite3")
+    workers = [SqliteSingleFlight(path), SqliteSingleFlight(path)]
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return ["A story.", {"total": 10}]
+
+    async def run():
+        return await asyncio.gather(*(worker.do("story", "same-key", generate) for worker in workers * 2))
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(result == ["A story.", {"total": 10}] for result in results)
+
+@pytest.mark.parametrize("shared", ["cache", "bucket"])
+def test_shared_state_lock_wait_does_not_block_event_loop(tmp_path, shared):
+    # Another worker holding the SQLite write lock must only delay this call, not every request on the loop.
+    path = str(tmp_path / "shared.sqlite3")
+    if shared == "cache":
+        cache = ResponseCache([SqliteCache(path)])
+        call = lambda: cache.set("key", ["A story.", {"total": 10}])
+    else:
+        budgets = ClientTokenBudgets(1000, bucket=SqliteBuckets(path).bucket)
+        call = lambda: budgets.reserve("client", 10)
+    other_worker = sqlite3.connect(path, isolation_level=None)
+
+    async def run():
+        other_worker.execute("BEGIN EXCLUSIVE")
+        pending = asyncio.create_task(call())
+        ticks = 0
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert not pending.done()
+        other_worker.execute("COMMIT")
+        await pending
+        return ticks
+
+    assert asyncio.run(run()) == 10
+
+def test_admission_rejects_when_queue_is_full(monkeypatch):
+    monkeypatch.setattr(main, "admission", AdmissionController(
+        0, {name: PriorityClass(0, max_queued=0) for name in main.ADMISSION_CLASSES}))
+    payload = {
+        "plot": "A hero saves the world.",
+        "imageNeeded": False,
+        "genre": "Adventure"
+    }
+    response = client.post("/story", json=payload)
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert main.admission.rejected == {("interactive", "full"): 1}
+
+    response = client.post("/stories/batch", json={"items": [payload]})
+    assert response.status_code == 200
+    assert response.json()["results"][0]["error"]
+
+def test_admission_serves_waiters_by_priority():
+    controller = AdmissionController(1, {
+        "interactive": PriorityClass(0),
+        "batch": PriorityClass(1),
+        "impatient": PriorityClass(1, max_wait=0.05),
+    })
+    order = []
+
+    async def run(name):
+        async with controller.slot(name):
+            order.append(name)
+            await asyncio.sleep(0.01)
+
+    async def scenario():
+        holder = await controller.acquire("batch")
+        tasks = [asyncio.create_task(run("batch")), asyncio.create_task(run("interactive"))]
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire("impatient")
+        holder.release()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+    assert order == ["interactive", "batch"]
+    assert controller.running == 0
+    assert controller.rejected == {("impatient", "timeout"): 1}
+
+def test_create_story_blank_plot():
+    payload = {
+        "plot": "   ",
+        "imageNeeded": False,
+        "genre": "Adventure"
+    }
+    response = client.post("/story", json=payload)
+    assert response.status_code == 422
+
+def test_story_response_escapes_markup_only_in_json():
+    result = StoryResponse(story="<b>Tom & Jerry's</b> tale")
+    assert result.model_dump()["story"] == "<b>Tom & Jerry's</b> tale"
+    assert json.loads(main.ModelResponse(result).body)["story"] == "&lt;b&gt;Tom &amp; Jerry's&lt;/b&gt; tale"
+
+def test_create_story_near_duplicate_plot_is_served_from_semantic_cache(monkeypatch):
+    monkeypatch.setattr(story_writer.semantic_cache, "enabled", True)
+    payload = {
+        "plot": "A lighthouse keeper befriends a lonely whale.",
+        "imageNeeded": False,
+        "genre": "Adventure",
+        "totalWords": 200
+    }
+    first = client.post("/story", json=payload).json()
+    hits = story_writer.semantic_cache.hits.get("story", 0)
+
+    near_duplicate = {**payload, "plot": "a lighthouse keeper befriends a lonely whale!", "totalWords": 210}
+    second = client.post("/story", json=near_duplicate).json()
+    assert story_writer.semantic_cache.hits.get("story", 0) == hits + 1
+    assert second["story"] == first["story"]
+
+    client.post("/story", json={**near_duplicate, "totalParagraphs": 3})
+    assert story_writer.semantic_cache.hits.get("story", 0) == hits + 1
+
+def test_create_story_other_genre_misses_semantic_cache(monkeypatch):
+    monkeypatch.setattr(story_writer.semantic_cache, "enabled", True)
+    payload = {
+        "plot": "A lighthouse keeper hears a voice in the fog.",
+        "imageNeeded": False,
+        "genre": "Adventure"
+    }
+    client.post("/story", json=payload)
+    hits = story_writer.semantic_cache.hits.get("story", 0)
+
+    response = client.post("/story", json={**payload, "genre": "Horror"})
+    assert response.status_code == 200
+    assert story_writer.semantic_cache.hits.get("story", 0) == hits
+
+@pytest.mark.parametrize("plot", ["A lonely girl kills a dragon in the mountains.",
+                                  "A lonely girl does not befriend a dragon in the mountains."])
+def test_semantic_cache_misses_plot_with_other_meaning(plot):
+    cache = SemanticCache(threshold=0.8)
+    calls = []
+
+    @cache.cached("story")
+    async def generate(plot: str, genre: str, bypass_cache: bool = False):
+        calls.append(plot)
+        return f"story {len(calls)}"
+
+    async def run():
+        return [await generate("A lonely girl befriends a dragon in the mountains.", "Fantasy"),
+                await generate("a lonely girl befriends a dragon in the mountains!", "Fantasy"),
+                await generate(plot, "Fantasy")]
+
+    assert asyncio.run(run()) == ["story 1", "story 1", "story 2"]
+
+@pytest.mark.parametrize("first, second", [("The king kills the queen.", "The queen kills the king."),
+                                           ("A cat chases a dog.", "A dog chases a cat.")])
+def test_semantic_cache_misses_plot_with_roles_swapped(first, second):
+    cache = SemanticCache(threshold=0.8)
+    calls = []
+
+    @cache.cached("story")
+    async def generate(plot: str, genre: str, bypass_cache: bool = False):
+        calls.append(plot)
+        return f"story {len(calls)}"
+
+    async def run():
+        return [await generate(first, "Drama"), await generate(second, "Drama")]
+
+    assert asyncio.run(run()) == ["story 1", "story 2"]
+
+@pytest.mark.parametrize("index_factory", [None, LshIndex])
+def test_semantic_cache_matches_similar_text_and_close_parameters(index_factory):
+    cache = SemanticCache(tolerances={"words": 0.1}, text_fields=("plot",),
+                          **({"index_factory": index_factory} if index_factory else {}))
+    calls = []
+
+    @cache.cached("story")
+    async def generate(plot: str, words: int, bypass_cache: bool = False):
+        calls.append(plot)
+        return f"story {len(calls)}"
+
+    async def run():
+        return [await generate("A hero saves the world.", 100),
+                await generate("a hero saves the WORLD!", 105),
+                await generate("A hero saves the world.", 150),
+                await generate("A dragon burns the village.", 100),
+                await generate("A hero saves the world.", 100, bypass_cache=True)]
+
+    assert asyncio.run(run()) == ["story 1", "story 1", "story 2", "story 3", "story 4"]
+    assert cache.hits == {"story": 1}
+
+def test_develop_story_takes_speculative_continuation(monkeypatch):
+    monkeypatch.setattr(story_writer, "SPECULATIVE_DEVELOP", True)
+    payload = {
+        "plot": "A clockmaker builds a clock that runs backwards.",
+        "imageNeeded": False,
+        "genre": "Fantasy"
+    }
+    with TestClient(app) as speculative_client:
+        launched = story_writer.speculator.launched
+        story = speculative_client.post("/story", json=payload).json()
+        assert story_writer.speculator.launched == launched + 1
+        stats = story_writer.speculator.stats()
+
+        develop_payload = {**payload, "plot": story_writer.SPECULATIVE_DEVELOP_PLOT, "storyId": story["storyId"]}
+        response = speculative_client.post("/develop-story", json=develop_payload)
+        assert response.status_code == 200
+        assert response.json()["story"]
+        after = story_writer.speculator.stats()
+        assert after["hits"] + after["joined"] == stats["hits"] + stats["joined"] + 1
+
+        # A different direction is not what was speculated
+        response = speculative_client.post("/develop-story", json={**develop_payload, "plot": "The clock stops."})
+        assert response.status_code == 200
+        assert story_writer.speculator.stats()["misses"] == after["misses"] + 1
+
+@pytest.mark.parametrize("experiment_boundary, summaries", [(0, 1), (3, 0)])
+def test_speculation_only_warms_a_summary_that_will_be_cached(monkeypatch, experiment_boundary, summaries):
+    calls = []
+
+    async def develop(request, prompt_version=None):
+        return "The clock runs forwards again.", None
+
+    async def summary(story, genre, temperature=0, bypass_cache=False):
+        calls.append(temperature)
+        return "A clock is fixed.", None
+    monkeypatch.setattr(story_writer.StoryWriter, "develop_story_from_summary", develop)
+    monkeypatch.setattr(story_writer.StoryWriter, "generate_summary", summary)
+    request = DevelopStoryRequest(plot="The clock is fixed.", imageNeeded=False, genre="Fantasy",
+                                  summary="A clockmaker builds a clock that runs backwards.",
+                                  experimentBoundary=experiment_boundary)
+
+    story_result, _ = asyncio.run(story_writer.StoryWriter.speculative_develop(request, "v1"))
+    assert story_result[0] == "The clock runs forwards again."
+    assert len(calls) == summaries
+
+def test_create_story_is_traced(monkeypatch, tmp_path):
+    monkeypatch.setattr(story_writer.tracer, "exporter", JsonLinesExporter(str(tmp_path / "traces.jsonl")))
+    payload = {
+        "plot": "A lighthouse keeper finds a message in a bottle addressed to them.",
+        "imageNeeded": False,
+        "genre": "Mystery"
+    }
+    response = client.post("/story", json=payload)
+    assert response.status_code == 200
+
+    spans = [json.loads(line) for line in (tmp_path / "traces.jsonl").read_text().splitlines()]
+    names = [span["name"] for span in spans]
+    for name in ("POST /story", "request.validate", "endpoint.create_story", "pipeline.story", "upstream.call",
+                 "response.serialize"):
+        assert name in names
+    assert len({span["traceId"] for span in spans}) == 1
+    root = spans[names.index("POST /story")]
+    assert "parentSpanId" not in root
+    assert {"key": "http.response.status_code", "value": {"intValue": "200"}} in root["attributes"]
+
+
+def test_profile_disabled():
+    response = client.get("/debug/profile", params={"seconds": 0.1})
+    assert response.status_code == 404
+
+
+def test_profile_captures_slowest_requests(monkeypatch):
+    monkeypatch.setattr(main, "PROFILER_ENABLED", True)
+    payload = {
+        "plot": "A cartographer maps an island that moves every night.",
+        "imageNeeded": False,
+        "genre": "Adventure"
+    }
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            capture = asyncio.create_task(http.get("/debug/profile", params={"seconds": 0.5, "format": "json"}))
+            await asyncio.sleep(0.05)
+            assert (await http.get("/debug/profile", params={"seconds": 0.1})).status_code == 409
+            assert (await http.post("/story", json=payload)).status_code == 200
+            return await capture
+
+    response = asyncio.run(scenario())
+    assert response.status_code == 200
+    profiles = response.json()["profiles"]
+    assert profiles[0]["name"] == "POST /story"
+    assert profiles[0]["samples"] == sum(profiles[0]["stacks"].values()) > 0
+
+
+def test_backend_client_is_rebuilt_on_a_new_event_loop():
+    backend = Backend("test", "http://127.0.0.1:9", "model", api_key="key")
+
+    async def use():
+        return backend.client, backend.client
+
+    first, same = asyncio.run(use())
+    second, _ = asyncio.run(use())
+    assert first is same
+    assert second is not first
+
+
+@pytest.mark.parametrize("failure", [RuntimeError("upstream went away"), asyncio.CancelledError()])
+def test_develop_story_falls_back_when_speculation_fails(monkeypatch, failure):
+    monkeypatch.setattr(story_writer, "SPECULATIVE_DEVELOP", True)
+
+    async def failing_speculation(request, prompt_version):
+        await asyncio.sleep(0.3)
+        raise failure
+
+    monkeypatch.setattr(story_writer.StoryWriter, "speculative_develop", failing_speculation)
+    payload = {
+        "plot": f"A gardener grows a tree that remembers ({type(failure).__name__}).",
+        "imageNeeded": False,
+        "genre": "Fantasy"
+    }
+    with TestClient(app) as speculative_client:
+        story = speculative_client.post("/story", json=payload).json()
+        joined = story_writer.speculator.joined
+        develop_payload = {**payload, "plot": story_writer.SPECULATIVE_DEVELOP_PLOT, "storyId": story["storyId"]}
+        response = speculative_client.post("/develop-story", json=develop_payload)
+        assert story_writer.speculator.joined == joined + 1
+        assert response.status_code == 200
+        assert response.json()["story"]
+        assert response.json()["error"] is None
+
+
+class UpstreamError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"upstream returned {status_code}")
+        self.status_code = status_code
+
+
+def fake_upstream(*outcomes):
+    """An upstream call that plays `outcomes` in order: an exception to raise, a delay to wait, or a result."""
+    calls = []
+
+    async def call():
+        outcome = outcomes[min(len(calls), len(outcomes) - 1)]
+        calls.append(outcome)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        if isinstance(outcome, float):
+            await asyncio.sleep(outcome)
+            return f"after {outcome}"
+        return outcome
+
+    return call, calls
+
+
+def test_resilience_retries_then_succeeds():
+    resilience = Resilience({"story": StagePolicy(max_attempts=3, base_delay=0.01)})
+    call, calls = fake_upstream(UpstreamError(503), UpstreamError(429), "A story.")
+    assert asyncio.run(resilience.call("story", call)) == "A story."
+    assert len(calls) == 3
+    assert resilience.retries == {"story": 2}
+
+def test_resilience_gives_up_after_max_attempts():
+    resilience = Resilience({"story": StagePolicy(max_attempts=2, base_delay=0.01)})
+    call, calls = fake_upstream(UpstreamError(503))
+    with pytest.raises(UpstreamError):
+        asyncio.run(resilience.call("story", call))
+    assert len(calls) == 2
+
+def test_resilience_does_not_retry_a_bad_request():
+    resilience = Resilience({"story": StagePolicy(max_attempts=3, base_delay=0.01)})
+    call, calls = fake_upstream(UpstreamError(400), "A story.")
+    with pytest.raises(UpstreamError):
+        asyncio.run(resilience.call("story", call))
+    assert len(calls) == 1
+    assert resilience.retries == {}
+
+def test_resilience_deadline_bounds_the_stage():
+    resilience = Resilience({"story": StagePolicy(deadline=0.1, max_attempts=5, base_delay=0.01)})
+    call, calls = fake_upstream(1.0)
+    start = time.perf_counter()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(resilience.call("story", call))
+    assert time.perf_counter() - start < 0.5
+    assert len(calls) == 1
+    assert resilience.deadlines_exceeded == {"story": 1}
+
+def test_resilience_hedge_wins_and_loser_is_cancelled():
+    resilience = Resilience({"story": StagePolicy(hedge=True, hedge_delay=0.05)})
+    cancelled = []
+
+    async def slow_then_fast():
+        if not cancelled:
+            cancelled.append(False)
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled[0] = True
+                raise
+            return "primary"
+        return "hedge"
+
+    async def run():
+        result = await resilience.call("story", slow_then_fast)
+        await asyncio.sleep(0)  # let the cancelled primary unwind
+        return result
+
+    assert asyncio.run(run()) == "hedge"
+    assert cancelled == [True]
+    assert resilience.hedges == {"story": 1}
+    assert resilience.hedge_wins == {"story": 1}
+
+
+def test_concurrency_limit_grows_on_success_and_halves_on_overload():
+    limiter = AdaptiveConcurrencyLimiter(initial=4, minimum=1, maximum=5, backoff_interval=60)
+
+    async def run():
+        for _ in range(4):  # about +1 per window of `limit` successes
+            await limiter.acquire()
+            await limiter.release()
+        grown = limiter.limit
+        for _ in range(2):  # a burst of overloads within one backoff interval halves the limit once
+            await limiter.acquire()
+            await limiter.release(overloaded=True)
+        return grown, limiter.limit
+
+    grown, backed_off = asyncio.run(run())
+    assert 4.9 < grown <= 5
+    assert backed_off == pytest.approx(grown / 2)
+    assert limiter.in_flight == 0
+
+def test_upstream_slot_limit_ignores_cancellations_and_backs_off_on_provider_timeouts():
+    limiter = UpstreamLimiter(6000, 0, AdaptiveConcurrencyLimiter(initial=4, minimum=1, maximum=10, backoff_interval=60))
+    timeout = openai.APITimeoutError(request=httpx.Request("POST", "https://upstream.test/v1/chat/completions"))
+
+    async def run():
+        for error in [asyncio.CancelledError(), ValueError("bad request")] * 2:
+            with pytest.raises(type(error)):
+                async with limiter.slot():
+                    raise error
+        unchanged = limiter.concurrency.limit
+        for _ in range(2):
+            with pytest.raises(openai.APITimeoutError):
+                async with limiter.slot():
+                    raise timeout
+        return unchanged, limiter.concurrency.limit
+
+    unchanged, backed_off = asyncio.run(run())
+    assert unchanged == 4
+    assert backed_off == 2
+    assert limiter.overloads == 2
+    assert limiter.concurrency.in_flight == 0
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(rate_per_minute=600)  # 10 per second, capacity 600
+    assert bucket.try_acquire(600) == 0
+    assert bucket.try_acquire(1) == pytest.approx(0.1, abs=0.01)
+    waited = asyncio.run(bucket.acquire(1))
+    assert 0.05 < waited < 0.2
+    bucket.adjust(-1000)  # refunds never overfill the bucket
+    assert bucket.tokens == 600
+
+def test_upstream_slot_refunds_buckets_when_cancelled_while_queued():
+    limiter = UpstreamLimiter(60, 10_000, AdaptiveConcurrencyLimiter(initial=1, minimum=1, maximum=1))
+
+    async def run():
+        async with limiter.slot(1000):
+            queued = asyncio.create_task(limiter.slot(1000).__aenter__())
+            await asyncio.sleep(0.01)
+            assert limiter.tokens.tokens == pytest.approx(8000, abs=50)
+            queued.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await queued
+            return limiter.requests.tokens, limiter.tokens.tokens
+
+    requests_left, tokens_left = asyncio.run(run())
+    assert requests_left == pytest.approx(59, abs=0.1)
+    assert tokens_left == pytest.approx(9000, abs=50)  # only the slot still held is taken
+
+
+def stub_backends(*names: str, **options) -> list[Backend]:
+    return [Backend(name, f"http://{name}.invalid/v1", f"{name}-model", **options) for name in names]
+
+def test_router_fails_over_on_upstream_errors_but_not_bad_requests():
+    primary, secondary = stub_backends("primary", "secondary")
+    router = ModelRouter({"story": [primary, secondary]})
+
+    async def call(backend):
+        if backend is primary:
+            raise asyncio.TimeoutError()
+        return backend.name
+
+    assert asyncio.run(router.call("story", call)) == "secondary"
+    assert router.failovers == 1
+    assert primary.errors == 1 and secondary.errors == 0
+
+    async def bad_request(backend):
+        raise UpstreamError(400)
+
+    with pytest.raises(UpstreamError):
+        asyncio.run(router.call("story", bad_request))
+    assert router.failovers == 1
+
+def test_router_ejects_failing_backend_and_readmits_it():
+    flaky, healthy = stub_backends("flaky", "healthy")
+    router = ModelRouter({"story": [flaky, healthy]}, alpha=0.5, eject_error_rate=0.5, eject_seconds=60)
+
+    async def call(backend):
+        if backend is flaky:
+            raise UpstreamError(503)
+        return backend.name
+
+    assert asyncio.run(router.call("story", call)) == "healthy"
+    assert flaky.ejected_until > time.monotonic()
+    assert router.candidates("story") == [healthy, flaky]  # ejected backends are only a last resort
+
+    assert flaky.error_ewma == 0.25  # it comes back on probation rather than with a clean record
+
+    flaky.ejected_until = time.monotonic() - 1  # the ejection has run out
+    assert router.candidates("story")[0] is flaky  # no latency samples yet, so it is tried first again
+
+    async def recovered(backend):
+        return backend.name
+
+    assert asyncio.run(router.call("story", recovered)) == "flaky"
+    assert flaky.error_ewma == 0.125
+
+def test_router_orders_by_latency_or_weight():
+    fast, slow = stub_backends("fast", "slow")
+    fast.latency_ewma, slow.latency_ewma = 0.5, 2.0
+    assert ModelRouter({"story": [slow, fast]}).candidates("story") == [fast, slow]
+    fast.in_flight = 5  # busy enough that the slower backend is now the better bet
+    assert ModelRouter({"story": [slow, fast]}).candidates("story") == [slow, fast]
+
+    heavy, light = stub_backends("heavy", "light")
+    heavy.weight, light.weight = 1000, 0.001
+    router = ModelRouter({"story": [light, heavy]}, strategy="weighted")
+    picks = [router.candidates("story")[0] for _ in range(20)]
+    assert picks.count(heavy) >= 19
+
+def test_load_router_reads_backends_and_keeps_default_roles(tmp_path, monkeypatch):
+    monkeypatch.setenv("TEST_BACKEND_KEY", "secret")
+    config = {"strategy": "weighted", "roles": {"story": [
+        {"name": "a", "baseUrl": "http://a.invalid/v1", "model": "model-a", "apiKeyEnv": "TEST_BACKEND_KEY", "weight": 2},
+        {"name": "b", "baseUrl": "http://b.invalid/v1", "model": "model-b", "apiKey": "inline", "timeout": 5},
+    ]}}
+    path = tmp_path / "backends.json"
+    path.write_text(json.dumps(config))
+    image_backends = stub_backends("image")
+
+    router = load_router(str(path), {"story": stub_backends("default"), "image": image_backends})
+    assert router.strategy == "weighted"
+    assert [(b.name, b.model, b.api_key, b.weight, b.timeout) for b in router.roles["story"]] == [
+        ("a", "model-a", "secret", 2, 60), ("b", "model-b", "inline", 1.0, 5)]
+    assert router.roles["image"] is image_backends
+
+
+def test_response_cache_skips_nonzero_temperature_and_bypass():
+    cache = ResponseCache([MemoryCache()])
+    calls = []
+
+    @cache.cached("story")
+    async def generate(plot: str, temperature: float = 0):
+        calls.append((plot, temperature))
+        return f"story {len(calls)}"
+
+    async def run():
+        return [await generate("A hero saves the world."),
+                await generate("A  hero saves the world. "),  # whitespace is normalized in the key
+                await generate("A hero saves the world.", bypass_cache=True),
+                await generate("A hero saves the world.", temperature=0.7),
+                await generate("A hero saves the world.", temperature=0.7)]
+
+    assert asyncio.run(run()) == ["story 1", "story 1", "story 2", "story 3", "story 4"]
+    assert cache.hits == {"story": 1}
+
+def test_memory_cache_expires_and_evicts_least_recently_used(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, "monotonic", lambda: now[0])
+    tier = MemoryCache(max_entries=2, ttl_seconds=10)
+    tier.set("a", 1)
+    tier.set("b", 2)
+    assert tier.get("a") == 1  # "a" is now the most recently used
+    tier.set("c", 3)
+    assert (tier.get("a"), tier.get("b"), tier.get("c")) == (1, None, 3)
+    now[0] += 11
+    assert tier.get("a") is None
+    assert len(tier) == 1
+
+def test_sqlite_cache_prunes_expired_rows_on_write(monkeypatch, tmp_path):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, "time", lambda: now[0])
+    tier = SqliteCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=10)
+    tier.set("a", 1)
+    tier.set("b", 2)
+    now[0] += 11
+    tier.set("c", 3)  # never read again, "a" and "b" still go
+    assert len(tier) == 1
+    assert tier.get("c") == 3
+
+def test_response_cache_fills_faster_tier_from_slower(tmp_path):
+    memory, disk = MemoryCache(), SqliteCache(str(tmp_path / "cache.sqlite3"))
+    disk.set("key", ["A story.", {"total": 10}])
+    cache = ResponseCache([memory, disk])
+    assert asyncio.run(cache.get("story", "key")) == ["A story.", {"total": 10}]
+    assert memory.get("key") == ["A story.", {"total": 10}]
+
+
+@pytest.mark.parametrize("outcome", ["A story.", RuntimeError("upstream failed")])
+def test_single_flight_shares_one_call_result_or_error(outcome):
+    flight = SingleFlight()
+    calls = []
+
+    @flight.coalesce("story")
+    async def generate(plot: str):
+        calls.append(plot)
+        await asyncio.sleep(0.05)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    async def run():
+        return await asyncio.gather(*(generate("A hero saves the world.") for _ in range(3)),
+                                    generate("A dragon burns the village."), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert sorted(calls) == ["A dragon burns the village.", "A hero saves the world."]
+    assert all(result is outcome for result in results)
+    assert flight.leaders == {"story": 2}
+    assert flight.coalesced == {"story": 2}
+    assert flight.in_flight() == 0
+
+def test_single_flight_call_survives_a_cancelled_leader():
+    flight = SingleFlight()
+
+    async def generate():
+        await asyncio.sleep(0.05)
+        return "A story."
+
+    async def run():
+        leader = asyncio.create_task(flight.do("story", "key", generate))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("story", "key", generate))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(run()) == "A story."
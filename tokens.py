@@ -0,0 +1,65 @@
+"""Local token counting, completion budgets and usage bookkeeping.
+
+Counts use tiktoken's cl100k_base encoding when tiktoken is installed and its
+encoding file is available; otherwise a character/word heuristic that errs on
+the high side. Either way the numbers are estimates for the hosted models, good
+enough for limits and budgets but not for billing.
+"""
+import functools
+import math
+
+try:
+    import tiktoken
+except ImportError:  # optional dependency
+    tiktoken = None
+
+TOKENS_PER_WORD = 1.35  # English prose with common BPE vocabularies
+COMPLETION_HEADROOM = 1.5  # models overshoot "about N words"; the ceiling only stops runaways
+SUMMARY_MAX_TOKENS = 250  # 3-4 sentences with room to spare
+JSON_OVERHEAD_TOKENS = 40  # keys, quotes and escapes around a combined story/summary reply
+
+
+@functools.lru_cache(maxsize=1)
+def encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:  # the encoding file is fetched on first use and may be unreachable
+        return None
+
+
+def count_tokens(text: str) -> int:
+    enc = encoding()
+    if enc is not None:
+        return max(1, len(enc.encode(text, disallowed_special=())))
+    return max(1, len(text) // 4, math.ceil(len(text.split()) * TOKENS_PER_WORD))
+
+
+def story_max_tokens(total_words: int, total_paragraphs: int = 1) -> int:
+    """max_tokens ceiling for a story of about `total_words` words in `total_paragraphs` paragraphs."""
+    return math.ceil(total_words * TOKENS_PER_WORD * COMPLETION_HEADROOM) + 2 * total_paragraphs
+
+
+def combined_max_tokens(total_words: int, total_paragraphs: int = 1) -> int:
+    return story_max_tokens(total_words, total_paragraphs) + SUMMARY_MAX_TOKENS + JSON_OVERHEAD_TOKENS
+
+
+def usage_counts(usage) -> dict | None:
+    """Provider usage object -> {"prompt", "completion", "total"}; plain dicts (e.g. from the cache) pass through."""
+    if usage is None or isinstance(usage, dict):
+        return usage
+    if isinstance(usage, int):  # cache entries written before prompt/completion were tracked
+        return {"prompt": None, "completion": None, "total": usage}
+    total = getattr(usage, "total_tokens", None)
+    if total is None:
+        return None
+    return {"prompt": getattr(usage, "prompt_tokens", None),
+            "completion": getattr(usage, "completion_tokens", None),
+            "total": total}
+
+
+def add_usage(*usages) -> dict:
+    """Sum several usage dicts, treating missing ones (local summaries, cache misses of old entries) as zero."""
+    counts = [usage_counts(usage) for usage in usages]
+    return {field: sum((c or {}).get(field) or 0 for c in counts) for field in ("prompt", "completion", "total")}
@@ -0,0 +1,222 @@
+"""Per-request tracing with OpenTelemetry-compatible spans.
+
+Spans use OpenTelemetry's data model: a 32-hex-digit trace id, a 16-hex-digit
+span id, a parent, start/end times in Unix nanoseconds, attributes, events and
+a status. Each finished span is written as one OTLP/JSON span object per line,
+so span files can be loaded into OpenTelemetry tooling. The active span lives in
+a contextvar, so it follows the request into the tasks it starts.
+"""
+import contextvars
+import json
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+
+class Span:
+    recording = True
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent: "Span | None",
+                 attributes: dict[str, Any], start_ns: int | None = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent = parent
+        self.root = parent.root if parent else self
+        self.attributes = attributes
+        self.events: list[tuple[str, int, dict]] = []
+        self.error: str | None = None
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: int | None = None
+        self.pending: list[Span] = []  # on the root span: finished spans of the trace, exported with the root
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes) -> None:
+        self.events.append((name, time.time_ns(), attributes))
+
+    def record_exception(self, error: BaseException) -> None:
+        self.error = f"{type(error).__name__}: {error}"
+        self.add_event("exception", **{"exception.type": type(error).__name__, "exception.message": str(error)})
+
+    def end(self, end_ns: int | None = None) -> None:
+        if self.end_ns is None:
+            self.end_ns = end_ns or time.time_ns()
+            self.tracer._finish(self)
+
+    def to_otlp(self) -> dict:
+        span = {"traceId": self.trace_id, "spanId": self.span_id, "name": self.name, "kind": 1,
+                "startTimeUnixNano": str(self.start_ns), "endTimeUnixNano": str(self.end_ns),
+                "attributes": otlp_attributes(self.attributes),
+                "status": {"code": 2, "message": self.error} if self.error else {"code": 0}}
+        if self.parent:
+            span["parentSpanId"] = self.parent.span_id
+        if self.events:
+            span["events"] = [{"name": name, "timeUnixNano": str(at), "attributes": otlp_attributes(attributes)}
+                              for name, at, attributes in self.events]
+        return span
+
+
+class NoopSpan:
+    """Stands in when tracing is off or the trace is not sampled; child spans see it and stay no-ops too."""
+    recording = False
+    trace_id = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def add_event(self, name: str, **attributes) -> None:
+        pass
+
+    def record_exception(self, error: BaseException) -> None:
+        pass
+
+    def end(self, end_ns: int | None = None) -> None:
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+current_span: contextvars.ContextVar[Span | NoopSpan | None] = contextvars.ContextVar("current_span", default=None)
+
+
+def otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_attributes(attributes: dict[str, Any]) -> list[dict]:
+    return [{"key": key, "value": otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class JsonLinesExporter:
+    """Appends spans as OTLP/JSON lines to a file, or to stderr for the path "-"."""
+
+    def __init__(self, path: str, service_name: str = "story-maker"):
+        self.path = path
+        self.service_name = service_name
+        self._file = sys.stderr if path == "-" else open(path, "a", buffering=1, encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def export(self, spans: list[Span]) -> None:
+        lines = "".join(json.dumps({"service.name": self.service_name, **span.to_otlp()}) + "\n" for span in spans)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+
+
+class Tracer:
+    """Creates spans and hands finished traces to the exporter; with no exporter every span is a no-op.
+
+    A fraction `sample_rate` of root spans is recorded. A trace is exported when
+    its root span ends; spans that end later (background work the request
+    started) are exported on their own.
+    """
+
+    def __init__(self, exporter: JsonLinesExporter | None = None, sample_rate: float = 1.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span | NoopSpan]:
+        span = self.start_span(name, **attributes)
+        token = current_span.set(span)  # a no-op span too, so an unsampled request stays unsampled throughout
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def start_span(self, name: str, **attributes) -> Span | NoopSpan:
+        """A span that is not made current; call end() on it."""
+        parent = current_span.get()
+        if self.exporter is None or parent is NOOP_SPAN:
+            return NOOP_SPAN
+        if parent is None and random.random() >= self.sample_rate:
+            return NOOP_SPAN
+        trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        return Span(self, name, trace_id, parent, attributes)
+
+    def record(self, name: str, start_ns: int, end_ns: int, **attributes) -> None:
+        """Add an already-measured phase (e.g. a queue wait) as a child of the current span."""
+        parent = current_span.get()
+        if parent is not None and parent.recording:
+            Span(self, name, parent.trace_id, parent, attributes, start_ns).end(end_ns)
+
+    def _finish(self, span: Span) -> None:
+        root = span.root
+        if span is not root and root.end_ns is None:
+            root.pending.append(span)
+            return
+        spans, root.pending = [*root.pending, span] if span is root else [span], []
+        self.exporter.export(spans)
+
+
+class HttpPhases:
+    """httpcore trace callback that records connection setup, time to first byte and body transfer as spans."""
+
+    def __init__(self, span: Span):
+        self.span = span
+        self.started: dict[str, int] = {}
+        self.connected_ns: int | None = None
+
+    async def __call__(self, event: str, info: dict) -> None:
+        now = time.time_ns()
+        name = event.split(".", 1)[1] if "." in event else event
+        tracer = self.span.tracer
+        if name == "connect_tcp.started":
+            self.started["connect"] = now
+        elif name in ("connect_tcp.complete", "start_tls.complete"):
+            self.connected_ns = now
+        elif name == "send_request_headers.started":
+            if "connect" in self.started:
+                Span(tracer, "http.connect", self.span.trace_id, self.span, {}, self.started.pop("connect")).end(
+                    self.connected_ns or now)
+            self.span.set_attribute("http.connection_reused", self.connected_ns is None)
+            self.started["ttfb"] = now
+        elif name == "receive_response_headers.complete" and "ttfb" in self.started:
+            Span(tracer, "http.time_to_first_byte", self.span.trace_id, self.span, {}, self.started.pop("ttfb")).end(now)
+        elif name == "receive_response_body.started":
+            self.started["transfer"] = now
+        elif name in ("receive_response_body.complete", "receive_response_body.failed") and "transfer" in self.started:
+            Span(tracer, "http.transfer", self.span.trace_id, self.span, {}, self.started.pop("transfer")).end(now)
+
+
+async def trace_http_request(request) -> None:
+    """httpx request event hook: trace the phases of the call under the current span, if it is recorded."""
+    span = current_span.get()
+    if span is not None and span.recording:
+        request.extensions["trace"] = HttpPhases(span)
+
+
+class TracingMiddleware:
+    """ASGI middleware opening the root span of each HTTP request."""
+
+    def __init__(self, app, tracer: Tracer):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        with self.tracer.span(f"{scope['method']} {scope['path']}", **{
+                "http.request.method": scope["method"], "url.path": scope["path"]}) as span:
+            async def send_traced(message):
+                if message["type"] == "http.response.start":
+                    span.set_attribute("http.response.status_code", message["status"])
+                await send(message)
+
+            await self.app(scope, receive, send_traced)
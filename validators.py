@@ -1,10 +1,12 @@
 # filepath: validators.py
 import html
 
-def sanitize_string(v: str) -> str:
-    if not isinstance(v, str):
-        raise ValueError('Must be a string')
-    sanitized = html.escape(v.strip())
-    if not sanitized:
-        raise ValueError('Field cannot be empty')
-    return sanitized
\ No newline at end of file
+
+def sanitize_string(v: str | None) -> str | None:
+    """Escape markup in text returned to clients; quotes are left alone as the text never lands in an attribute."""
+    return html.escape(v, quote=False) if v else v
+
+
+def scale_temperature(v: float) -> float:
+    """experimentBoundary is sent on a 0-10 scale; the model takes 0-1."""
+    return v / 10 if v > 0 else v